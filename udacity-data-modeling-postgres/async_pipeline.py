@@ -0,0 +1,148 @@
+import io
+import asyncio
+import functools
+import concurrent.futures
+
+from metrics import run_metrics, measured
+
+# default number of batches each queue between the stages can hold
+QUEUE_DEPTH = 4
+
+
+def read_texts(filepaths):
+    """
+    Read the given files, returning their content as a list of strings
+    """
+
+    texts = []
+
+    for filepath in filepaths:
+        with open(filepath) as f:
+            texts.append(f.read())
+
+    return texts
+
+
+def transform_texts(transform, texts):
+    """
+    Run a transform over file content already read into memory, the
+    transforms accept file like objects in place of file paths
+    """
+
+    return transform([io.StringIO(text) for text in texts])
+
+
+async def read_stage(batches, read_queue):
+    """
+    Read the files of each batch of manifest entries in a thread, so the
+    event loop is free, and pass the content on to the transform stage
+    """
+
+    loop = asyncio.get_running_loop()
+
+    for batch in batches:
+        texts = await loop.run_in_executor(None, read_texts, [entry[0] for entry in batch])
+        await read_queue.put((batch, texts))
+
+    await read_queue.put(None)
+
+
+async def transform_stage(read_queue, write_queue, transform, executor, measure=False):
+    """
+    Submit each batch read to the transform executor, passing the future
+    straight on to the writer stage. The futures are queued in file order,
+    while the bounded queue limits how many transforms are in flight. With
+    measure set, the transforms run on worker processes and return their
+    stage metrics along with the payload
+    """
+
+    loop = asyncio.get_running_loop()
+
+    while True:
+        item = await read_queue.get()
+
+        if item is None:
+            break
+
+        batch, texts = item
+        if measure:
+            func = functools.partial(measured, transform_texts, transform)
+        else:
+            func = functools.partial(transform_texts, transform)
+
+        future = loop.run_in_executor(executor, func, texts)
+        await write_queue.put((batch, future))
+
+    await write_queue.put(None)
+
+
+async def write_stage(write_queue, loader, executor, measure=False):
+    """
+    Wait for each transformed batch in turn, and load it with the loader on
+    the single writer thread, which owns the loader's connection. With
+    measure set, the transform metrics are added to the run
+    """
+
+    loop = asyncio.get_running_loop()
+
+    while True:
+        item = await write_queue.get()
+
+        if item is None:
+            break
+
+        batch, future = item
+        payload = await future
+
+        if measure:
+            payload, stages = payload
+            run_metrics.merge(stages)
+
+        await loop.run_in_executor(executor, loader.load, batch, payload)
+        run_metrics.advance(len(batch))
+
+    await loop.run_in_executor(executor, loader.flush)
+
+
+async def run_pipeline(entries, transform, batch_size, loader, workers=0, initializer=None,
+                       options=(), depth=QUEUE_DEPTH):
+    """
+    Load the given manifest entries through a reader, transform and writer
+    stage, joined by queues of depth batches, so reading, transforming and
+    copying overlap while memory stays bounded.
+
+    The transforms run in a pool of worker processes, each set up by calling
+    initializer with the options, or on a thread when workers is 0. The
+    loader is only used from a single thread, which keeps the file order
+    """
+
+    batches = [entries[i:i + batch_size] for i in range(0, len(entries), batch_size)]
+
+    read_queue = asyncio.Queue(maxsize=depth)
+    write_queue = asyncio.Queue(maxsize=depth)
+
+    if workers > 0:
+        transform_executor = concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=initializer, initargs=options)
+    else:
+        transform_executor = concurrent.futures.ThreadPoolExecutor(1)
+
+    writer_executor = concurrent.futures.ThreadPoolExecutor(1)
+
+    # transforms on worker processes are measured there and merged here
+    measure = workers > 0
+
+    tasks = [asyncio.ensure_future(read_stage(batches, read_queue)),
+             asyncio.ensure_future(transform_stage(read_queue, write_queue, transform,
+                                                   transform_executor, measure)),
+             asyncio.ensure_future(write_stage(write_queue, loader, writer_executor, measure))]
+
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # a failed stage leaves the others waiting on their queues
+        for task in tasks:
+            task.cancel()
+
+        transform_executor.shutdown()
+        writer_executor.shutdown()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import time
+import argparse
+import psycopg2
+
+from sql_queries import unresolved_chunk_select, unresolved_count_select, songplay_backfill_update, unresolved_delete
+from rollups import refresh_days
+from create_tables import SPARKIFY_DSN as DSN
+
+# unresolved songplays updated per transaction
+BACKFILL_CHUNK_ROWS = 10000
+
+
+def backfill_chunk(cursor, low, high):
+    """
+    Resolve the unresolved songplays with a songplay_id after low, up to and
+    including high, against the current songs and artists, and refresh the
+    rollups for the days they fall on. Returns the number of songplays
+    updated
+    """
+
+    cursor.execute(songplay_backfill_update, (low, high))
+    updated = [row[0] for row in cursor.fetchall()]
+
+    cursor.execute(unresolved_delete, (low, high))
+    refresh_days(cursor, sorted(set(updated)))
+
+    return len(updated)
+
+
+def backfill(conn, chunk_rows=BACKFILL_CHUNK_ROWS):
+    """
+    Resolve the song and artist ids of every unresolved songplay, in chunks
+    of chunk_rows songplays by songplay_id, committing each chunk so the
+    row locks and WAL of a transaction stay bounded. Returns the number of
+    songplays updated
+    """
+
+    cursor = conn.cursor()
+    low = 0
+    total = 0
+
+    while True:
+        cursor.execute(unresolved_chunk_select, (low, chunk_rows))
+        high = cursor.fetchone()[0]
+
+        if high is None:
+            break
+
+        start = time.perf_counter()
+        updated = backfill_chunk(cursor, low, high)
+        conn.commit()
+
+        print("songplay_id {} to {}: resolved {} songplays in {:.2f}s".format(
+            low + 1, high, updated, time.perf_counter() - start))
+
+        total += updated
+        low = high
+
+    return total
+
+
+def main():
+    """
+    Fill in the song and artist ids of songplays loaded before their songs
+    """
+
+    parser = argparse.ArgumentParser(description="Backfill the unresolved songplay song and artist ids")
+
+    parser.add_argument("--chunk-rows", type=int, default=BACKFILL_CHUNK_ROWS,
+                        help="unresolved songplays updated per transaction")
+
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(DSN)
+    cursor = conn.cursor()
+
+    total = backfill(conn, args.chunk_rows)
+
+    cursor.execute(unresolved_count_select)
+    remaining = cursor.fetchone()[0]
+    conn.close()
+
+    print("Resolved {} songplays, {} still unresolved".format(total, remaining))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import math
+import struct
+
+# PostgreSQL binary copy format, see the COPY documentation. The header is
+# the signature followed by the flags field and the header extension length
+HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+TRAILER = struct.pack("!h", -1)
+NULL = struct.pack("!i", -1)
+
+_field_count = struct.Struct("!h")
+_int4 = struct.Struct("!ii")
+_int8 = struct.Struct("!iq")
+_float8 = struct.Struct("!id")
+_length = struct.Struct("!i")
+
+
+class BinaryCopyData(bytes):
+    """
+    Binary copy data, carrying the number of rows it holds in rows
+    """
+
+    rows = 0
+
+
+def is_null(value):
+    """
+    True for the values written as null, None and NaN
+    """
+
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def encode_int4(value):
+    return _int4.pack(4, int(value))
+
+
+def encode_int8(value):
+    return _int8.pack(8, int(value))
+
+
+def encode_float8(value):
+    return _float8.pack(8, float(value))
+
+
+def encode_text(value):
+    data = str(value).encode("utf-8")
+    return _length.pack(len(data)) + data
+
+
+encoders = {
+    "int4": encode_int4,
+    "int8": encode_int8,
+    "float8": encode_float8,
+    "text": encode_text
+}
+
+
+def encode_rows(rows, types):
+    """
+    Encode an iterable of row tuples as binary copy data. types gives the
+    type of each column, one of int4, int8, float8 or text, and must match
+    the column types of the table copied into. None and NaN values are
+    written as null, other values are written as is, so text never needs
+    escaping
+    """
+
+    column_encoders = [encoders[name] for name in types]
+    count = _field_count.pack(len(column_encoders))
+
+    chunks = [HEADER]
+    append = chunks.append
+    num_rows = 0
+
+    for row in rows:
+        append(count)
+
+        for encode, value in zip(column_encoders, row):
+            append(NULL if is_null(value) else encode(value))
+
+        num_rows += 1
+
+    append(TRAILER)
+
+    data = BinaryCopyData(b"".join(chunks))
+    data.rows = num_rows
+    return data
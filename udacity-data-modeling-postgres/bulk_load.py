@@ -0,0 +1,73 @@
+from sql_queries import (bulk_index_table_create, bulk_primary_key_select, bulk_index_select,
+                         bulk_index_insert, bulk_index_saved_select, bulk_index_delete,
+                         primary_key_drop, primary_key_add, index_drop, bulk_deduplicate,
+                         table_analyze)
+from metrics import run_metrics
+
+
+def defer_indexes(cursor, tables):
+    """
+    Save and drop the primary keys and indexes of the given tables, so a
+    bulk load copies into bare heaps. Returns the number dropped. Anything
+    already saved by an interrupted bulk load stays saved
+    """
+
+    cursor.execute(bulk_index_table_create)
+
+    cursor.execute(bulk_primary_key_select, (tables,))
+    keys = cursor.fetchall()
+
+    cursor.execute(bulk_index_select, (tables,))
+    indexes = cursor.fetchall()
+
+    for entry in keys + indexes:
+        cursor.execute(bulk_index_insert, entry)
+
+    # the indexes first, the brin index of a partitioned songplays has no
+    # dependency on the key, but other indexes could
+    for table, name, definition, key_columns in indexes:
+        cursor.execute(index_drop.format(name))
+
+    for table, name, definition, key_columns in keys:
+        cursor.execute(primary_key_drop.format(table, name))
+
+    return len(keys) + len(indexes)
+
+
+def restore_indexes(cursor, tables, deduplicate=True):
+    """
+    Rebuild the primary keys and indexes saved by defer_indexes for the
+    given tables, removing duplicate keys first, keeping the row loaded
+    first, unless deduplicate is False. Then analyze the tables, if
+    anything was rebuilt. Returns the number rebuilt
+    """
+
+    cursor.execute(bulk_index_table_create)
+    cursor.execute(bulk_index_saved_select, (tables,))
+    saved = cursor.fetchall()
+
+    for table, name, definition, key_columns in saved:
+        if key_columns is not None:
+            if deduplicate:
+                with run_metrics.stage(table + ".deduplicate") as stage:
+                    cursor.execute(bulk_deduplicate.format(table, key_columns))
+                    stage.rows_out = cursor.rowcount
+
+            with run_metrics.stage(table + ".primary_key"):
+                cursor.execute(primary_key_add.format(table, name, definition))
+        else:
+            # the definition of an index on a partitioned table only covers
+            # the parent, without ONLY it is built on every partition
+            with run_metrics.stage(table + ".index"):
+                cursor.execute(definition.replace(" ON ONLY ", " ON "))
+
+        cursor.execute(bulk_index_delete, (table, name))
+
+    if not saved:
+        return 0
+
+    for table in tables:
+        with run_metrics.stage(table + ".analyze"):
+            cursor.execute(table_analyze.format(table))
+
+    return len(saved)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import time
+import argparse
+import psycopg2
+import pandas as pd
+
+from etl import DSN, configure_transforms, compact_schema, load_payload, time_data, user_data, \
+    songplay_data, songplay_table
+from lookup import DimensionLookup
+from partitions import songplay_partitions
+
+# batch sizes timed by default
+BATCH_SIZES = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000]
+
+# insert cutoffs forcing each write strategy, see etl.insert_strategy
+STRATEGIES = {
+    "values": (float("inf"), float("inf")),
+    "csv": (-1, float("inf")),
+    "binary": (-1, 0)
+}
+
+
+def log_events(rows):
+    """
+    Build a dataframe of rows synthetic NextSong events, as read from a log
+    file, with distinct times and a few hundred users
+    """
+
+    ts = int(time.time() * 1000)
+
+    return pd.DataFrame({
+        "artist": ["Artist {}".format(i % 500) for i in range(rows)],
+        "firstName": ["First {}".format(i % 300) for i in range(rows)],
+        "gender": ["F" if i % 2 else "M" for i in range(rows)],
+        "lastName": ["Last {}".format(i % 300) for i in range(rows)],
+        "length": [180.0 + i % 97 for i in range(rows)],
+        "level": ["paid" if i % 3 else "free" for i in range(rows)],
+        "location": ["Town {}, ST".format(i % 50) for i in range(rows)],
+        "sessionId": [i % 1000 for i in range(rows)],
+        "song": ["Song {}".format(i % 2000) for i in range(rows)],
+        "ts": [ts + i for i in range(rows)],
+        "userAgent": ["Mozilla/5.0 (X11; Linux x86_64)"] * rows,
+        "userId": [1000000 + i % 300 for i in range(rows)]
+    })
+
+
+def time_load(conn, df, cutoffs):
+    """
+    Time preparing and loading the payload of a dataframe of log events with
+    the given insert cutoffs. The load is rolled back, along with any
+    locations and user agents added by the dimension lookup
+    """
+
+    cursor = conn.cursor()
+    partitions = songplay_partitions(cursor, DSN, conn)
+    compact = compact_schema(cursor)
+
+    configure_transforms(cutoffs=cutoffs, dimensions=DimensionLookup(DSN, conn) if compact else None)
+
+    start = time.perf_counter()
+
+    payload = [("time", time_data(df)), ("users", user_data(df)),
+               (songplay_table("songplays"), songplay_data(df))]
+    load_payload(cursor, payload, partitions, compact)
+
+    seconds = time.perf_counter() - start
+    conn.rollback()
+
+    return seconds
+
+
+def suggest_cutoffs(results):
+    """
+    Suggest the insert cutoffs from the best times of each strategy for
+    each batch size. The values max rows is the largest batch up to which
+    the multi row insert always wins, and the binary min rows the smallest
+    batch from which binary copy always beats csv
+    """
+
+    sizes = sorted(results)
+    values_max = 0
+
+    for size in sizes:
+        if min(results[size], key=results[size].get) != "values":
+            break
+
+        values_max = size
+
+    binary_min = None
+
+    for size in reversed(sizes):
+        if results[size]["binary"] > results[size]["csv"]:
+            break
+
+        binary_min = size
+
+    return values_max, binary_min
+
+
+def main():
+    """
+    Time each write strategy over a range of batch sizes, against the
+    sparkify database, and suggest the cutoffs for etl.py --adaptive. Every
+    load is rolled back, though the songplay_id sequence still advances
+    """
+
+    parser = argparse.ArgumentParser(description="Calibrate the etl.py insert strategy cutoffs")
+
+    parser.add_argument("--sizes", type=int, nargs="+", default=BATCH_SIZES,
+                        help="batch sizes, in log events, to time")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="times each load is repeated, the best time is kept")
+
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(DSN)
+    results = {}
+
+    print("{:>8} {:>12} {:>12} {:>12}".format("rows", *STRATEGIES))
+
+    for size in args.sizes:
+        df = log_events(size)
+        results[size] = {}
+
+        for name, cutoffs in STRATEGIES.items():
+            results[size][name] = min(time_load(conn, df, cutoffs) for i in range(args.repeat))
+
+        print("{:>8} {:>10.2f}ms {:>10.2f}ms {:>10.2f}ms".format(
+            size, *(results[size][name] * 1000 for name in STRATEGIES)))
+
+    conn.close()
+
+    values_max, binary_min = suggest_cutoffs(results)
+
+    if binary_min is None:
+        print("Suggested: --values-max-rows {} (binary copy never beat csv)".format(values_max))
+    else:
+        print("Suggested: --values-max-rows {} --binary-min-rows {}".format(values_max, binary_min))
+
+
+if __name__ == "__main__":
+    main()
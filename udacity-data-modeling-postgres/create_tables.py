@@ -1,7 +1,16 @@
 #!/usr/bin/env python3
 
+import hashlib
+import argparse
 import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+from sql_queries import *
+
+DEFAULT_DSN = "host=127.0.0.1 dbname=studentdb user=student password=student"
+SPARKIFY_DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+TEMPLATE_DSN = "host=127.0.0.1 dbname=sparkifydb_template user=student password=student"
+
+DATABASE = "sparkifydb"
+TEMPLATE_DATABASE = "sparkifydb_template"
 
 
 def create_database():
@@ -11,19 +20,19 @@ def create_database():
     """
     
     # connect to default database
-    conn = psycopg2.connect("host=127.0.0.1 dbname=studentdb user=student password=student")
+    conn = psycopg2.connect(DEFAULT_DSN)
     conn.set_session(autocommit=True)
     cur = conn.cursor()
     
     # create sparkify database with UTF8 encoding
-    cur.execute("DROP DATABASE IF EXISTS sparkifydb")
-    cur.execute("CREATE DATABASE sparkifydb WITH ENCODING 'utf8' TEMPLATE template0")
+    cur.execute(database_drop.format(DATABASE))
+    cur.execute(database_create.format(DATABASE, "template0"))
 
     # close connection to default database
     conn.close()    
     
     # connect to sparkify database
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+    conn = psycopg2.connect(SPARKIFY_DSN)
     cur = conn.cursor()
     
     return cur, conn
@@ -39,16 +48,109 @@ def drop_tables(cur, conn):
         conn.commit()
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, queries=create_table_queries):
     """
-    Creates each table using the queries in `create_table_queries` list. 
+    Creates each table using the queries in `create_table_queries` list, 
+    or the given list of queries. 
     """
-    for query in create_table_queries:
+    for query in queries:
         print("Creating: {}".format(query))
         cur.execute(query)
         conn.commit()
 
 
+def schema_version(queries):
+    """
+    Returns a hash of the table create queries, used to tell if the
+    template database is out of date
+    """
+    return hashlib.md5("".join(queries).encode("utf-8")).hexdigest()
+
+
+def build_template(cur, queries, version):
+    """
+    Creates the template database with all the tables, in a single
+    transaction, and tags it with the schema version
+    """
+    print("Building template database {}".format(TEMPLATE_DATABASE))
+
+    cur.execute(database_drop.format(TEMPLATE_DATABASE))
+    cur.execute(database_create.format(TEMPLATE_DATABASE, "template0"))
+
+    conn = psycopg2.connect(TEMPLATE_DSN)
+    template_cur = conn.cursor()
+
+    for query in queries:
+        template_cur.execute(query)
+
+    conn.commit()
+    conn.close()
+
+    cur.execute(database_comment.format(TEMPLATE_DATABASE), (version,))
+
+
+def clone_template(queries, rebuild=False):
+    """
+    - Builds the template database with the given create queries if it is
+    missing, out of date, or rebuild is set
+    
+    - Drops (if exists) the sparkify database and recreates it as a copy
+    of the template. The copy is a file level clone, so takes no time
+    compared to running the create queries
+    """
+    conn = psycopg2.connect(DEFAULT_DSN)
+    conn.set_session(autocommit=True)
+    cur = conn.cursor()
+
+    version = schema_version(queries)
+    cur.execute(database_comment_select, (TEMPLATE_DATABASE,))
+    row = cur.fetchone()
+
+    if rebuild or row is None or row[0] != version:
+        build_template(cur, queries, version)
+
+    # the template must have no other connections while being cloned
+    cur.execute(database_drop.format(DATABASE))
+    cur.execute(database_create.format(DATABASE, TEMPLATE_DATABASE))
+
+    conn.close()
+
+
+def truncate_tables(names=table_names, partitioned=False, compact=False):
+    """
+    Empties all the tables, or the given tables, of the existing sparkify
+    database in a single statement. Returns False, doing nothing, if any
+    table is missing, or the tables were created for another schema than
+    the one asked for, partitioned or compact
+    """
+    try:
+        conn = psycopg2.connect(SPARKIFY_DSN)
+    except psycopg2.OperationalError:
+        return False
+
+    cur = conn.cursor()
+    cur.execute(table_count_select, (names,))
+
+    if cur.fetchone()[0] != len(names):
+        conn.close()
+        return False
+
+    cur.execute(songplay_partitioned_select)
+    is_partitioned = cur.fetchone()[0]
+    cur.execute(compact_schema_select)
+    is_compact = cur.fetchone()[0]
+
+    if is_partitioned != partitioned or is_compact != compact:
+        conn.close()
+        return False
+
+    cur.execute(table_truncate.format(", ".join(names)))
+    conn.commit()
+    conn.close()
+
+    return True
+
+
 def main():
     """
     - Drops (if exists) and Creates the sparkify database. 
@@ -61,11 +163,58 @@ def main():
     - Creates all tables needed. 
     
     - Finally, closes the connection. 
+    
+    With --mode template the database is cloned from a template database
+    instead, and with --mode truncate the existing tables are emptied in
+    place, falling back to the template if the tables do not exist or are
+    of another schema. With
+    --partitioned the songplays table is partitioned by month, and with
+    --compact the tables are created with the compact schema.
     """
+    parser = argparse.ArgumentParser(description="Project 1 Create Tables Script")
+
+    parser.add_argument("--mode", choices=["full", "template", "truncate"], default="full",
+                        help="recreate the database and tables (full), clone it from a "
+                             "template database (template), or truncate the tables (truncate)")
+    parser.add_argument("--rebuild-template", action="store_true",
+                        help="rebuild the template database even if it is up to date")
+    parser.add_argument("--partitioned", action="store_true",
+                        help="partition the songplays table by month of start_time")
+    parser.add_argument("--compact", action="store_true",
+                        help="use narrower column types and dimension tables for the songplay "
+                             "locations and user agents")
+
+    args = parser.parse_args()
+
+    if args.partitioned and args.compact:
+        parser.error("--compact can't be combined with --partitioned")
+
+    queries = create_table_queries
+    names = table_names
+
+    if args.partitioned:
+        queries = create_table_queries_partitioned
+    elif args.compact:
+        queries = create_table_queries_compact
+        names = compact_table_names
+
+    if args.mode == "truncate":
+        if truncate_tables(names, args.partitioned, args.compact):
+            print("Truncated: {}".format(", ".join(names)))
+            return
+
+        print("Tables missing or of another schema, cloning from {}".format(TEMPLATE_DATABASE))
+        args.mode = "template"
+
+    if args.mode == "template":
+        clone_template(queries, args.rebuild_template)
+        print("Created {} from {}".format(DATABASE, TEMPLATE_DATABASE))
+        return
+
     cur, conn = create_database()
     
     drop_tables(cur, conn)
-    create_tables(cur, conn)
+    create_tables(cur, conn, queries)
 
     conn.close()
 
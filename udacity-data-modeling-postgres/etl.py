@@ -3,144 +3,727 @@
 import os
 import io
 import glob
+import queue
+import asyncio
+import hashlib
+import argparse
+import functools
+import contextlib
+import threading
+import multiprocessing
 import psycopg2
+import psycopg2.extras
 import pandas as pd
 
 from sql_queries import *
+from lookup import SongLookup, DimensionLookup
+from stream import stream_log_file
+from binary_copy import encode_rows, is_null
+from key_cache import KeyCache
+from partitions import songplay_partitions
+from bulk_load import defer_indexes, restore_indexes
+from rollups import refresh as refresh_rollups, writer_lock
+from async_pipeline import run_pipeline, QUEUE_DEPTH
+from metrics import run_metrics, measured, PROGRESS_INTERVAL
 
+# connection string for the sparkify database
+DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
 
-def process_song_file(cursor, filepath):
+# number of song files gathered into a single copy when loading songs
+SONG_BATCH_SIZE = 1000
+
+# default insert strategy cutoffs, see insert_strategy, as measured by
+# calibrate_inserts.py against a local database
+VALUES_MAX_ROWS = 25
+BINARY_MIN_ROWS = 100000
+
+# position of the start_time in the rows of each songplays payload table
+songplay_time_columns = {"songplays": 1, "songplays_resolved": 3, "songplays_unmatched": 3}
+
+# default commit thresholds when using persistent staging tables
+STAGING_BATCH_FILES = 100
+STAGING_BATCH_ROWS = 100000
+
+# the song lookup used to resolve songplay ids on the client, when set the
+# songplays are copied straight into the final table
+song_lookup = None
+
+# the dimension lookup used to resolve songplay locations and user agents to
+# their ids on the client, set for the compact schema, whose songplays
+# payloads then carry the ids
+dimension_lookup = None
+
+# when set the transforms prepare binary copy data rather than csv
+copy_binary = False
+
+# the run scoped time and users key caches, when set rows for keys already
+# loaded are dropped by the transforms
+key_caches = None
+
+# (values max rows, binary min rows) cutoffs picking the write strategy of
+# each batch by its size, set by configure_transforms. None always copies
+insert_cutoffs = None
+
+
+def open_source(source):
+    """
+    Open a file path for reading, or pass through a file like object, so the
+    transforms can also work on content already read into memory
+    """
+
+    if isinstance(source, str):
+        return open(source)
+
+    return contextlib.nullcontext(source)
+
+
+def read_song_files(filepaths):
+    """
+    Read a batch of song files into a single dataframe. The small json
+    documents are joined into one buffer and parsed in a single pass, using
+    the same reader as the log files so song durations compare equal
+    """
+
+    with run_metrics.stage("song.read", len(filepaths)) as stage:
+        buffer = io.StringIO()
+
+        for filepath in filepaths:
+            with open_source(filepath) as f:
+                for line in f:
+                    if line.strip():
+                        buffer.write(line.rstrip("\n"))
+                        buffer.write("\n")
+
+        stage.bytes = buffer.tell()
+
+        if buffer.tell() == 0:
+            return pd.DataFrame()
+
+        buffer.seek(0)
+        df = pd.read_json(buffer, lines=True, precise_float=True)
+        stage.rows_out = len(df)
+
+    return df
+
+
+def copy_source(data):
+    """
+    Return a file like object to copy the prepared data from. The data is
+    either a string, binary copy data, or already a file like object when
+    streaming
+    """
+
+    if isinstance(data, str):
+        return io.StringIO(data)
+
+    if isinstance(data, bytes):
+        return io.BytesIO(data)
+
+    return data
+
+
+def staging_queries(table):
+    """
+    Return the staging queries of the given table, the tables normally
+    copied straight into the final table are staged when songplays is
+    partitioned or the schema is compact
+    """
+
+    if table in staging_table_queries:
+        return staging_table_queries[table]
+
+    if table in compact_staging_queries:
+        return compact_staging_queries[table]
+
+    return partitioned_staging_queries[table]
+
+
+def staging_name(table):
+    """
+    Return the name of the staging table of the given table
+    """
+
+    if table in staging_table_names:
+        return staging_table_names[table]
+
+    if table in compact_staging_table_names:
+        return compact_staging_table_names[table]
+
+    return partitioned_staging_table_names[table]
+
+
+def copy_query(table, data, direct=True):
+    """
+    Return the copy query for the prepared data of the given table, into
+    either its staging table or straight into the final table, in binary
+    format for binary copy data. With direct False, the data is always
+    copied into the staging table
+    """
+
+    direct = direct and table in direct_copy_queries
+
+    if isinstance(data, bytes):
+        if not direct and table in partitioned_binary_copy_queries:
+            return partitioned_binary_copy_queries[table]
+
+        return binary_copy_queries[table]
+
+    if direct:
+        return direct_copy_queries[table]
+
+    return staging_queries(table)[1]
+
+
+def count_rows(data):
+    """
+    Return the number of rows in the prepared data, streamed data counts its
+    rows as they are read
+    """
+
+    if isinstance(data, str):
+        return data.count("\n")
+
+    if isinstance(data, bytes):
+        return data.rows
+
+    if isinstance(data, list):
+        return len(data)
+
+    return data.lines
+
+
+def count_bytes(data):
+    """
+    Return the size of the prepared data, streamed data counts its size as
+    it is read. Rows for a multi row insert are not encoded, so count as 0
+    """
+
+    if isinstance(data, (str, bytes)):
+        return len(data)
+
+    if isinstance(data, list):
+        return 0
+
+    return data.chars
+
+
+def copy_data(cursor, table, data, direct=True):
+    """
+    Copy the prepared data for the given table, into its staging table or
+    straight into the final table
+    """
+
+    with run_metrics.stage(table + ".copy") as stage:
+        cursor.copy_expert(copy_query(table, data, direct), copy_source(data))
+        stage.rows_in = count_rows(data)
+        stage.bytes = count_bytes(data)
+
+
+def compact_schema(cursor):
+    """
+    Return True if the database was created with the compact schema
+    """
+
+    cursor.execute(compact_schema_select)
+    return cursor.fetchone()[0]
+
+
+def insert_from_staging(cursor, table, compact=False):
+    """
+    Move the rows in the staging table of the given table into the final
+    table. With compact set, the moves for the compact schema are used
+    """
+
+    query = staging_queries(table)[2]
+
+    if compact and table in compact_insert_queries:
+        query = compact_insert_queries[table]
+
+    with run_metrics.stage(table + ".insert") as stage:
+        cursor.execute(query)
+        stage.rows_out = cursor.rowcount
+
+
+def copy_to_staging(cursor, table, data, compact=False):
+    """
+    Copy the prepared data for the given table into its staging table, and
+    then move it into the final table. The table must be a key of the
+    staging_table_queries dict, or of the compact_staging_queries or
+    partitioned_staging_queries dicts
+    """
+
+    create, copy, insert, drop = staging_queries(table)
+
+    # the copy to staging
+    cursor.execute(create)
+    copy_data(cursor, table, data, direct=False)
+
+    # now staging to final table
+    insert_from_staging(cursor, table, compact)
+    cursor.execute(drop)
+
+
+def insert_values(cursor, table, rows, compact=False):
+    """
+    Insert a small batch of rows, prepared as a list of tuples, with a
+    single multi row insert in place of the staging table
+    """
+
+    if not rows:
+        return
+
+    query = values_insert_queries[table]
+
+    if compact and table in compact_values_insert_queries:
+        query = compact_values_insert_queries[table]
+
+    with run_metrics.stage(table + ".values", len(rows)) as stage:
+        psycopg2.extras.execute_values(cursor, query, rows, values_templates[table], page_size=len(rows))
+        stage.rows_out = cursor.rowcount
+
+
+def ensure_partitions(cursor, partitions, tables, values):
+    """
+    Create the partitions for the songplays staged for the given tables and
+    in the given (table, rows) batches of values. Called before any of them
+    are moved into songplays, see SongplayPartitions
     """
-    Process song files and upload the data into postgres
+
+    staging = [songplay_staging_tables[table] for table in tables if table in songplay_staging_tables]
+    times = [row[songplay_time_columns[table]] for table, rows in values
+             if table in songplay_time_columns for row in rows]
+
+    for name in partitions.ensure(cursor, staging, times):
+        print("Created partition {}".format(name))
+
+
+def load_payload(cursor, payload, partitions=None, compact=False):
+    """
+    Load a payload, a list of (table, data) pairs as built by the
+    transform functions, into the database in order. When songplays is
+    partitioned, or the schema is compact, every copy goes through staging.
+    When partitioned, the songplays are staged first, so their partitions
+    can be created before anything is moved
+    """
+
+    staged = set()
+    moved = set()
+
+    if partitions is not None:
+        values = []
+
+        for table, data in payload:
+            if table not in songplay_staging_tables:
+                continue
+
+            if isinstance(data, list):
+                values.append((table, data))
+            else:
+                cursor.execute(staging_queries(table)[0])
+                copy_data(cursor, table, data, direct=False)
+                staged.add(table)
+
+        ensure_partitions(cursor, partitions, staged, values)
+
+    for table, data in payload:
+        if isinstance(data, list):
+            insert_values(cursor, table, data, compact)
+        elif table in staged:
+            # a payload of several files stages each table more than once,
+            # all of it is moved on the first
+            if table not in moved:
+                insert_from_staging(cursor, table, compact)
+                cursor.execute(staging_queries(table)[3])
+                moved.add(table)
+        elif table in direct_copy_queries and partitions is None and not compact:
+            copy_data(cursor, table, data)
+        else:
+            copy_to_staging(cursor, table, data, compact)
+
+
+def configure_transforms(lookup=None, binary=False, caches=None, cutoffs=None, dimensions=None):
+    """
+    Set the song lookup used by the log file transforms, whether the
+    transforms prepare binary copy data, the time and users key caches, the
+    insert strategy cutoffs, and the dimension lookup of the compact schema.
+    Also used as the initializer of the worker processes, which then each
+    hold their own copy of the key caches and dimension lookup
+    """
+
+    global song_lookup, copy_binary, key_caches, insert_cutoffs, dimension_lookup
+    song_lookup = lookup
+    copy_binary = binary
+    key_caches = caches
+    insert_cutoffs = cutoffs
+    dimension_lookup = dimensions
+
+
+def make_dimension_lookup():
+    """
+    Return a dimension lookup if the database was created with the compact
+    schema, otherwise None
+    """
+
+    conn = psycopg2.connect(DSN)
+    compact = compact_schema(conn.cursor())
+    conn.close()
+
+    return DimensionLookup(DSN) if compact else None
+
+
+def insert_strategy(rows):
+    """
+    Pick how a batch of the given number of rows is written. With the insert
+    cutoffs set, batches up to the values max rows are inserted as a multi
+    row insert (values), and batches of at least the binary min rows are
+    copied as binary copy data (binary). Otherwise the batch is copied as
+    csv (csv), or always as binary copy data with binary set
+    """
+
+    if insert_cutoffs is not None and rows <= insert_cutoffs[0]:
+        return "values"
+
+    if copy_binary or (insert_cutoffs is not None and rows >= insert_cutoffs[1]):
+        return "binary"
+
+    return "csv"
+
+
+def make_key_caches(max_keys=None, warm=False):
+    """
+    Build the time and users key caches, filling them from the existing
+    tables if warm is set
+    """
+
+    caches = {"time": KeyCache(max_keys), "users": KeyCache(max_keys)}
+
+    if warm:
+        conn = psycopg2.connect(DSN)
+        cursor = conn.cursor()
+        caches["time"].warm(cursor, time_key_select)
+        caches["users"].warm(cursor, user_key_select)
+        conn.close()
+
+    return caches
+
+
+def rewarm_key_caches():
+    """
+    Refill the key caches, if set, from the committed time and users
+    tables. Used after a rollback, as the transforms add the keys of a
+    batch to the caches before it is loaded, and the keys of rows which
+    were rolled back would otherwise be dropped as already loaded
+    """
+
+    if key_caches is None:
+        return
+
+    # replace the caches in place, the transforms hold the same dict
+    key_caches.update(make_key_caches(key_caches["time"].max_keys, warm=True))
+
+
+def binary_data(table, df):
+    """
+    Encode the rows of a dataframe as binary copy data for the given table.
+    The dataframe columns must be in table order
+    """
+
+    return encode_rows(df.itertuples(index=False, name=None), binary_copy_types[table])
+
+
+def value_rows(df):
+    """
+    Convert the rows of a dataframe to a list of tuples for a multi row
+    insert, with NaN values as None. The dataframe columns must be in table
+    order
+    """
+
+    return [tuple(None if is_null(value) else value for value in row)
+            for row in df.itertuples(index=False, name=None)]
+
+
+def encode_data(table, df, strategy=None, **kwargs):
+    """
+    Encode a prepared dataframe for the given table with the strategy from
+    insert_strategy, picked by its size if not given. Either as rows for a
+    multi row insert, as binary copy data, or as csv written with the given
+    to_csv arguments
     """
 
-    # open song file
-    df = pd.read_json(filepath, lines=True)
+    if strategy is None:
+        strategy = insert_strategy(len(df))
+
+    with run_metrics.stage(table + ".encode", len(df)) as stage:
+        if strategy == "values":
+            data = value_rows(df)
+        elif strategy == "binary":
+            data = binary_data(table, df)
+        else:
+            data = df.to_csv(index=False, header=False, **kwargs)
+
+        stage.bytes = count_bytes(data)
+
+    return data
 
-    # insert artist record
-    artist_data = list(df[["artist_id", "artist_name", "artist_location",
-                           "artist_latitude", "artist_longitude"]].values[0])
 
-    cursor.execute(artist_table_insert, artist_data)
+def artist_data(df):
+    """
+    Prepare the artist data from a song dataframe as csv, or binary copy
+    data, for copy
+    """
 
-    # insert song record
-    song_data = list(
-        df[["song_id", "artist_id", "title", "year", "duration"]].values[0])
+    with run_metrics.stage("artists.transform", len(df)) as stage:
+        # prepare a dataframe for the artist data
+        artist_df = df.loc[:, ["artist_id", "artist_name", "artist_location",
+                               "artist_latitude", "artist_longitude"]]
 
-    cursor.execute(song_table_insert, song_data)
+        artist_df.drop_duplicates(["artist_id"], inplace=True)
+        stage.rows_out = len(artist_df)
 
+    return encode_data("artists", artist_df)
 
-def upload_time_data(cursor, df):
+
+def song_data(df):
     """
-    Handle the time data, and insert it into postgres via a copy
+    Prepare the song data from a song dataframe as csv, or binary copy
+    data, for copy
     """
 
-    # convert timestamp column to datetime
-    t = pd.to_datetime(df["ts"], unit="ms")
+    with run_metrics.stage("songs.transform", len(df)) as stage:
+        # prepare a dataframe for the song data
+        song_df = df.loc[:, ["song_id", "artist_id", "title", "year", "duration"]]
+        song_df.drop_duplicates(["song_id"], inplace=True)
+        stage.rows_out = len(song_df)
+
+    return encode_data("songs", song_df)
 
-    # insert time data records
-    time_data = [df.ts.values, t.dt.hour.values, t.dt.day.values,
-                 t.dt.week.values, t.dt.month.values, t.dt.year.values, t.dt.dayofweek.values]
 
-    column_labels = ["start_time", "hour", "day",
-                     "week", "month", "year", "weekday"]
+def transform_song_files(filepaths):
+    """
+    Read a batch of song files and prepare the payload to load them. Does
+    not touch the database, so it can be run in a worker process
+    """
+
+    df = read_song_files(filepaths)
 
-    time_df = pd.DataFrame(dict(zip(column_labels, time_data)))
+    if df.empty:
+        return []
 
-    # trim any local duplicates
-    time_df.drop_duplicates(["start_time"], inplace=True)
+    # artists first, as the songs reference them
+    return [("artists", artist_data(df)), ("songs", song_data(df))]
 
-    # we will use this buffer to create csv files in memory, then
-    # copy them directly into the database
-    buffer = io.StringIO()
+
+def time_data(df):
+    """
+    Prepare the time data from a log dataframe as csv, or binary copy
+    data, for copy
+    """
+
+    with run_metrics.stage("time.transform", len(df)) as stage:
+        # convert timestamp column to datetime
+        t = pd.to_datetime(df["ts"], unit="ms")
+
+        # insert time data records
+        time_data = [df.ts.values, t.dt.hour.values, t.dt.day.values,
+                     t.dt.week.values, t.dt.month.values, t.dt.year.values, t.dt.dayofweek.values]
+
+        column_labels = ["start_time", "hour", "day",
+                         "week", "month", "year", "weekday"]
+
+        time_df = pd.DataFrame(dict(zip(column_labels, time_data)))
+
+        # trim any local duplicates
+        time_df.drop_duplicates(["start_time"], inplace=True)
+
+        # and any already loaded during this run
+        if key_caches is not None:
+            time_df = time_df[key_caches["time"].add_new(time_df["start_time"])]
+
+        stage.rows_out = len(time_df)
 
     # now we are going to copy directly into a staging table and then
     # move the data to the time table. This speeds up the process
     # greatly, and still allows the check on the primary key when copying
     # from staging to final table
-    time_df.to_csv(buffer, index=False, header=False)
-    buffer.seek(0)
+    return encode_data("time", time_df)
 
-    # the copy to staging
-    cursor.execute(time_staging_create)
-    cursor.copy_from(buffer, time_staging, sep=",")
 
-    # now staging to final table
-    cursor.execute(time_insert_from_staging)
-    cursor.execute(time_staging_drop)
+def user_data(df):
+    """
+    Prepare the user data from a log dataframe as csv, or binary copy
+    data, for copy
+    """
+
+    with run_metrics.stage("users.transform", len(df)) as stage:
+        # prepare a dataframe for the user data
+        user_df = df.loc[:, ["userId", "firstName", "lastName", "gender", "level"]]
+        user_df.drop_duplicates(["userId"], inplace=True)
 
+        if key_caches is not None:
+            user_df = user_df[key_caches["users"].add_new(user_df["userId"])]
 
-def upload_user_data(cursor, df):
+        stage.rows_out = len(user_df)
+
+    # like the time data, we load it directly into a staging table
+    return encode_data("users", user_df)
+
+
+def songplay_table(table):
     """
-    Process the user data, and insert it into postgres via a copy
+    Return the payload table of the songplays for the given payload table,
+    its compact version when the dimension lookup is set
     """
 
-    # prepare a dataframe for the user data
-    user_df = df.loc[:, ["userId", "firstName", "lastName", "gender", "level"]]
-    user_df.drop_duplicates(["userId"], inplace=True)
+    return table if dimension_lookup is None else table + "_compact"
 
-    # we will use this buffer to create csv files in memory, then
-    # copy them directly into the database
-    buffer = io.StringIO()
 
-    # like the time data, we load it directly into a staging table
-    user_df.to_csv(buffer, index=False, header=False)
-    buffer.seek(0)
+def songplay_dimensions(songplay_df, strategy):
+    """
+    With the dimension lookup set, return a songplay dataframe with the
+    location and user agent replaced by their ids, written for the given
+    strategy. Otherwise the dataframe is returned as it is
+    """
 
-    # the copy to staging
-    cursor.execute(user_staging_create)
-    cursor.copy_from(buffer, user_staging, sep=",")
+    if dimension_lookup is None:
+        return songplay_df
 
-    # now staging to final table
-    cursor.execute(user_insert_from_staging)
-    cursor.execute(user_staging_drop)
+    columns = {}
+
+    with run_metrics.stage("songplays.dimensions", len(songplay_df)):
+        for column, table in [("location", "locations"), ("userAgent", "user_agents")]:
+            ids = dimension_lookup.resolve(table, songplay_df[column])
+
+            # unresolved ids are written as the copy null marker in csv
+            if strategy == "csv":
+                ids = ["\\N" if i is None else i for i in ids]
 
+            columns[column] = pd.Series(ids, index=songplay_df.index, dtype=object)
 
-def upload_songplay_data(cursor, df):
+    return songplay_df.assign(**columns)
+
+
+def songplay_data(df):
     """
-    Process the songplay data, and insert it into postgres via a copy
+    Prepare the songplay data from a log dataframe as tab separated values,
+    binary copy data or rows, for copy
     """
 
-    # we will use this buffer to create csv files in memory, then
-    # copy them directly into the database
-    buffer = io.StringIO()
+    table = songplay_table("songplays")
+    strategy = insert_strategy(len(df))
+    columns = ["userId", "ts", "sessionId", "level", "location", "userAgent", "song", "artist", "length"]
+
+    songplay_df = songplay_dimensions(df.loc[:, columns], strategy)
 
     # dump the available column data to csv for copy import
-    df.to_csv(buffer, index=False, header=False, sep="\t",
-              columns=["userId", "ts", "sessionId", "level", "location", "userAgent", "song", "artist", "length"])
+    return encode_data(table, songplay_df, strategy, sep="\t")
 
-    buffer.seek(0)
 
-    # the copy to staging
-    cursor.execute(songplay_staging_create)
-    cursor.copy_from(buffer, songplay_staging, sep="\t")
+def songplay_data_resolved(df, lookup):
+    """
+    Prepare the songplay data from a log dataframe as tab separated values,
+    binary copy data or rows, with the song and artist ids resolved by the
+    lookup. Returns the payload entries of the songplays, those with both
+    ids for loading straight into the songplays table, and those missing
+    either id, along with their song, artist and duration, for recording in
+    songplays_unresolved as they are loaded
+    """
 
-    # now staging to final table
-    cursor.execute(songplay_insert_from_staging)
-    cursor.execute(songplay_staging_drop)
+    with run_metrics.stage("songplays.resolve", len(df)):
+        song_ids, artist_ids = lookup.resolve(df["artist"], df["song"], df["length"])
+
+        songplay_df = df.loc[:, ["userId", "ts", "sessionId", "level", "location", "userAgent",
+                                 "song", "artist", "length"]]
+        songplay_df.insert(1, "song_id", pd.Series(song_ids, index=df.index, dtype=object))
+        songplay_df.insert(2, "artist_id", pd.Series(artist_ids, index=df.index, dtype=object))
+
+        matched = songplay_df["song_id"].notna() & songplay_df["artist_id"].notna()
+
+    payload = []
+
+    for table, rows in [("songplays_resolved", songplay_df.loc[matched, songplay_df.columns[:8]]),
+                        ("songplays_unmatched", songplay_df.loc[~matched])]:
+        strategy = insert_strategy(len(rows))
+
+        # unresolved ids are written as the copy null marker in csv
+        if strategy == "csv":
+            rows = rows.fillna({"song_id": "\\N", "artist_id": "\\N"})
+
+        table = songplay_table(table)
+        payload.append((table, encode_data(table, songplay_dimensions(rows, strategy), strategy, sep="\t")))
 
+    return payload
 
-def process_log_file(cursor, filepath):
+
+def read_log_file(filepath):
+    """
+    Read an event log file, keeping only the NextSong events
+    """
+
+    with run_metrics.stage("log.read", 1) as stage:
+        if isinstance(filepath, str):
+            stage.bytes = os.path.getsize(filepath)
+
+        # open log file
+        df = pd.read_json(filepath, lines=True, precise_float=True)
+
+        # filter by NextSong action
+        df = df.loc[df["page"] == "NextSong"]
+        stage.rows_out = len(df)
+
+    return df
+
+
+def transform_log_file(filepath):
     """
-    Process the event log files and populate the database from them
+    Read an event log file and prepare the payload to load it. Does not
+    touch the database, so it can be run in a worker process
     """
 
-    # open log file
-    df = pd.read_json(filepath, lines=True)
+    df = read_log_file(filepath)
 
-    # filter by NextSong action
-    df = df.loc[df["page"] == "NextSong"]
+    if song_lookup is not None:
+        songplays = songplay_data_resolved(df, song_lookup)
+    else:
+        songplays = [(songplay_table("songplays"), songplay_data(df))]
 
     # break into separate functions for each table, to keep the code clean
-    upload_time_data(cursor, df)
-    upload_user_data(cursor, df)
-    upload_songplay_data(cursor, df)
+    payload = [("time", time_data(df)), ("users", user_data(df))] + songplays
 
+    # with the key caches most tables end up empty, so skip those
+    return [(table, data) for table, data in payload if count_rows(data) > 0]
 
-def process_data(cursor, conn, filepath, func):
+
+def transform_log_files(filepaths):
     """
-    Collect all the log files for the given filepath and pass them
-    to the func parameter
+    Prepare the payload for a list of event log files, one after another
+    """
+
+    payload = []
+
+    for filepath in filepaths:
+        payload.extend(transform_log_file(filepath))
+
+    return payload
+
+
+def stream_log_files(filepaths):
+    """
+    Build the payload for a list of event log files without pandas. The data
+    is streamed from the files as it is copied, so memory use stays flat
+    whatever the file size. The payload can only be loaded in this process
+    """
+
+    payload = []
+
+    for filepath in filepaths:
+        payload.extend(stream_log_file(filepath, song_lookup, key_caches, dimension_lookup))
+
+    return payload
+
+
+def get_files(filepath):
+    """
+    Collect the absolute path of all json files under the given filepath
     """
 
     # get all files matching extension from directory
@@ -150,24 +733,632 @@ def process_data(cursor, conn, filepath, func):
         for f in files:
             all_files.append(os.path.abspath(f))
 
+    return all_files
+
+
+def file_hash(filepath, size=None):
+    """
+    Return the sha256 hex digest of the given file's content, or of its
+    first size bytes
+    """
+
+    digest = hashlib.sha256()
+    remaining = size
+
+    with open(filepath, "rb") as f:
+        while remaining is None or remaining > 0:
+            chunk = f.read(65536 if remaining is None else min(65536, remaining))
+
+            if not chunk:
+                break
+
+            digest.update(chunk)
+
+            if remaining is not None:
+                remaining -= len(chunk)
+
+    return digest.hexdigest()
+
+
+def record_files(cursor, entries):
+    """
+    Record a list of (filepath, size, mtime, hash) entries in the manifest.
+    This is done on the same transaction as the data, so a file is only
+    marked as processed once its data is committed
+    """
+
+    with run_metrics.stage("manifest", len(entries)):
+        psycopg2.extras.execute_batch(cursor, manifest_upsert, entries)
+
+
+def commit(conn):
+    """
+    Commit the connection's transaction, timed as the commit stage
+    """
+
+    with run_metrics.stage("commit"):
+        conn.commit()
+
+
+def pending_files(cursor, conn, filepath, incremental=True):
+    """
+    Collect all the files for the given filepath which still need to be
+    loaded, as a list of (filepath, size, mtime, hash) entries.
+
+    A file is skipped when its size and mtime match the manifest. When only
+    the size or mtime changed, the content hash decides, and files with
+    unchanged content just have their manifest entry refreshed. Files
+    appended to since they were recorded, whose recorded hash matches their
+    start, are left for resume_appended, as loading them whole would load
+    the recorded part twice. When incremental is False every file is
+    returned
+    """
+
+    all_files = get_files(filepath)
+
     # get total number of files found
     num_files = len(all_files)
     print("{} files found in {}".format(num_files, filepath))
 
-    # iterate over files and process
-    for i, datafile in enumerate(all_files, 1):
-        func(cursor, datafile)
-        conn.commit()
-        print("{}/{} files processed.".format(i, num_files))
+    cursor.execute(manifest_table_create)
+    cursor.execute(manifest_select)
+    manifest = {row[0]: row[1:] for row in cursor.fetchall()}
 
+    pending = []
+    touched = []
+    appended = 0
 
-def main():
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+    for datafile in all_files:
+        stat = os.stat(datafile)
+        known = manifest.get(datafile) if incremental else None
+
+        # the quick check, no need to read the file
+        if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime:
+            continue
+
+        entry = (datafile, stat.st_size, stat.st_mtime, file_hash(datafile))
+
+        if known is not None and known[2] == entry[3]:
+            touched.append(entry)
+        elif known is not None and known[0] < stat.st_size and known[2] == file_hash(datafile, known[0]):
+            appended += 1
+        else:
+            pending.append(entry)
+
+    record_files(cursor, touched)
+    conn.commit()
+
+    print("{} files to process, {} unchanged.".format(len(pending), num_files - len(pending) - appended))
+
+    if appended:
+        print("{} files appended to, their new lines are loaded last.".format(appended))
+
+    run_metrics.begin(filepath, len(pending))
+    return pending
+
+
+def appended_tail(datafile, known):
+    """
+    Return the bytes appended to a file since it was recorded in the manifest
+    as known, a (size, mtime, hash) entry, along with the manifest entry for
+    the whole file. Returns None if nothing was appended, or if the recorded
+    bytes no longer match the recorded hash
+    """
+
+    stat = os.stat(datafile)
+
+    if known is None or stat.st_size <= known[0]:
+        return None
+
+    with open(datafile, "rb") as f:
+        content = f.read(stat.st_size)
+
+    if hashlib.sha256(content[:known[0]]).hexdigest() != known[2]:
+        return None
+
+    return content[known[0]:], (datafile, len(content), stat.st_mtime, hashlib.sha256(content).hexdigest())
+
+
+def resume_appended(filepath, make_loader, options=()):
+    """
+    Load the lines appended to the log files for the given filepath since
+    they were recorded in the manifest, by an earlier run or by watch.py,
+    from the recorded offset, as watch.py does. The appended lines are
+    usually few, so they are transformed with the pandas transforms on this
+    process, set up with the options, and loaded by a loader built by
+    make_loader. Returns the number of files resumed
+    """
+
+    conn = psycopg2.connect(DSN)
+    cursor = conn.cursor()
+
+    cursor.execute(manifest_table_create)
+    cursor.execute(manifest_select)
+    manifest = {row[0]: row[1:] for row in cursor.fetchall()}
+    conn.commit()
+
+    configure_transforms(*options)
+    loader = make_loader(conn)
+    resumed = 0
+
+    for datafile in get_files(filepath):
+        tail = appended_tail(datafile, manifest.get(datafile))
+
+        if tail is None:
+            continue
+
+        data, entry = tail
+        loader.load([entry], transform_log_file(io.StringIO(data.decode())))
+        resumed += 1
+
+    loader.flush()
+    conn.close()
+
+    if resumed:
+        print("Loaded the appended lines of {} files".format(resumed))
+
+    return resumed
+
+
+class PayloadLoader:
+    """
+    Loads payloads through a staging table created and dropped for every
+    copy, recording the files in the manifest and committing after each
+    payload
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.cursor = conn.cursor()
+
+        # None unless the songplays table is partitioned
+        self.partitions = songplay_partitions(self.cursor, DSN)
+        self.compact = compact_schema(self.cursor)
+        self.conn.commit()
+
+    def load(self, entries, payload):
+        """
+        Load the payload built from the given manifest entries
+        """
+
+        writer_lock(self.cursor)
+        load_payload(self.cursor, payload, self.partitions, self.compact)
+        record_files(self.cursor, entries)
+        commit(self.conn)
+
+    def flush(self):
+        """
+        Commit anything still pending, nothing to do for this loader
+        """
+
+        pass
+
+
+class StagingLoader(PayloadLoader):
+    """
+    Loads payloads through staging tables which are created once and then
+    reused. Payloads are copied into the staging tables as they arrive, and
+    only moved to the final tables, truncated and committed once batch_files
+    files or batch_rows rows have built up.
+
+    The staging tables are either unlogged tables, which persist between runs
+    but can only be used by one writer at a time, or temporary tables private
+    to the connection
+    """
+
+    def __init__(self, conn, unlogged=True, batch_files=STAGING_BATCH_FILES,
+                 batch_rows=STAGING_BATCH_ROWS):
+        super().__init__(conn)
+
+        self.batch_files = batch_files
+        self.batch_rows = batch_rows
+        self.entries = []
+        self.rows = 0
+        self.tables = set()
+        self.values = []
+
+        # the staged tables, in dependency order
+        self.staged = list(staging_table_queries)
+
+        if self.partitions is not None:
+            self.staged.extend(partitioned_staging_queries)
+
+        if self.compact:
+            self.staged.extend(compact_staging_queries)
+
+        for table in self.staged:
+            if not unlogged:
+                self.cursor.execute(staging_queries(table)[0])
+            elif table in unlogged_staging_create:
+                self.cursor.execute(unlogged_staging_create[table])
+            elif table in compact_unlogged_staging_create:
+                self.cursor.execute(compact_unlogged_staging_create[table])
+            else:
+                self.cursor.execute(partitioned_unlogged_staging_create[table])
+
+        # clear out anything left behind by an earlier run
+        self.cursor.execute(staging_truncate.format(
+            ", ".join(staging_name(table) for table in self.staged)))
+        self.conn.commit()
+
+    def load(self, entries, payload):
+        """
+        Copy the payload into the staging tables, flushing them if the batch
+        is now large enough
+        """
+
+        writer_lock(self.cursor)
+
+        for table, data in payload:
+            # small batches skip the staging tables altogether, the songplays
+            # of a partitioned table wait for the flush, which creates their
+            # partitions before this transaction moves anything into songplays
+            if isinstance(data, list) and self.partitions is not None and table in songplay_staging_tables:
+                self.values.append((table, data))
+            elif isinstance(data, list):
+                insert_values(self.cursor, table, data, self.compact)
+            else:
+                direct = table not in self.staged
+                copy_data(self.cursor, table, data, direct)
+
+                if not direct:
+                    self.tables.add(table)
+
+            # counted after the copy, as streamed data counts its rows as
+            # they are read
+            self.rows += count_rows(data)
+
+        self.entries.extend(entries)
+
+        if len(self.entries) >= self.batch_files or self.rows >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        """
+        Move the staged rows into the final tables, then truncate the staging
+        tables and commit, along with the manifest entries for the batch
+        """
+
+        if not self.entries and not self.tables and not self.values:
+            return
+
+        # keep the dependency order of the staged tables
+        tables = [table for table in self.staged if table in self.tables]
+
+        if self.partitions is not None:
+            ensure_partitions(self.cursor, self.partitions, tables, self.values)
+
+        for table in tables:
+            insert_from_staging(self.cursor, table, self.compact)
+
+        for table, data in self.values:
+            insert_values(self.cursor, table, data, self.compact)
+
+        if tables:
+            self.cursor.execute(staging_truncate.format(
+                ", ".join(staging_name(table) for table in tables)))
+
+        record_files(self.cursor, self.entries)
+        commit(self.conn)
+
+        self.entries = []
+        self.rows = 0
+        self.tables = set()
+        self.values = []
+
+
+def process_payloads(loader, filepath, transform, batch_size, incremental=True):
+    """
+    Collect all the files for the given filepath, transform them in lists of
+    up to batch_size files and pass the payloads to the loader. Files already
+    in the manifest are skipped unless incremental is False
+    """
+
+    entries = pending_files(loader.cursor, loader.conn, filepath, incremental)
+    num_files = len(entries)
+
+    # iterate over batches of files and process
+    for i in range(0, num_files, batch_size):
+        batch = entries[i:i + batch_size]
+        loader.load(batch, transform([entry[0] for entry in batch]))
+        run_metrics.advance(len(batch))
+
+    loader.flush()
+
+
+def payload_writer(payloads, errors, make_loader):
+    """
+    Writer thread body. Takes (entries, payload) pairs from the payloads queue
+    and passes them to a loader, built by make_loader on the writer's own
+    connection, counting the files as processed once loaded. A None entry
+    stops the writer. Any error is appended to errors, after which the writer
+    keeps draining the queue so the producer never blocks
+    """
+
+    conn = None
+
+    try:
+        conn = psycopg2.connect(DSN)
+        loader = make_loader(conn)
+
+        while True:
+            item = payloads.get()
+
+            if item is None:
+                break
+
+            if not errors:
+                loader.load(*item)
+                run_metrics.advance(len(item[0]))
+
+        if not errors:
+            loader.flush()
+    except (Exception, psycopg2.Error) as error:
+        errors.append(error)
+
+        # drain until told to stop, so the producer can finish cleanly
+        while payloads.get() is not None:
+            pass
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+def process_data_parallel(filepath, transform, batch_size, workers, writers, incremental=True,
+                          make_loader=PayloadLoader, options=()):
+    """
+    Collect all the files for the given filepath and transform them with a
+    pool of worker processes, in batches of batch_size files. The payloads
+    are loaded by a number of writer threads, each with its own connection
+    and a loader built by make_loader. The options are the arguments passed to
+    configure_transforms in each worker.
+
+    The payloads are passed to the writers in file order, so with a single
+    writer the result is identical to the serial path. With more writers the
+    same rows are loaded, but serial keys may be assigned in a different order
+    """
+
+    conn = psycopg2.connect(DSN)
+    entries = pending_files(conn.cursor(), conn, filepath, incremental)
+    conn.close()
+
+    num_files = len(entries)
+    batches = [entries[i:i + batch_size] for i in range(0, num_files, batch_size)]
+    filepaths = [[entry[0] for entry in batch] for batch in batches]
+
+    # a bounded queue, so workers can't run too far ahead of the writers
+    payloads = queue.Queue(maxsize=writers * 2)
+    errors = []
+
+    threads = [threading.Thread(target=payload_writer, args=(payloads, errors, make_loader))
+               for i in range(writers)]
+
+    for thread in threads:
+        thread.start()
+
+    try:
+        with multiprocessing.Pool(workers, configure_transforms, options) as pool:
+            results = pool.imap(functools.partial(measured, transform), filepaths)
+
+            for batch, (payload, stages) in zip(batches, results):
+                if errors:
+                    break
+
+                # the workers measure their transforms, add them to the run
+                run_metrics.merge(stages)
+
+                # progress is counted by the writers, as they load each payload
+                payloads.put((batch, payload))
+    finally:
+        for thread in threads:
+            payloads.put(None)
+
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+
+
+def process_data_async(conn, filepath, transform, batch_size, workers, incremental=True,
+                       make_loader=PayloadLoader, options=(), depth=QUEUE_DEPTH):
+    """
+    Collect all the files for the given filepath and load them through the
+    asyncio pipeline, which overlaps reading, transforming and copying. The
+    transforms run on worker processes set up with the options, or on a
+    thread if workers is 0. Files already in the manifest are skipped unless
+    incremental is False
+    """
+
+    entries = pending_files(conn.cursor(), conn, filepath, incremental)
+    loader = make_loader(conn)
+
+    asyncio.run(run_pipeline(entries, transform, batch_size, loader, workers,
+                             configure_transforms, options, depth))
+
+
+@contextlib.contextmanager
+def bulk_load(tables, defer=True):
+    """
+    Context manager for a bulk load of the given tables. With defer set the
+    primary keys and indexes are dropped for the load. On leaving, any keys
+    and indexes dropped, by this or an interrupted bulk load, are rebuilt in
+    one pass after removing duplicate keys, and the tables analyzed. If the
+    load fails they are left dropped, to be rebuilt by the next run
+    """
+
+    conn = psycopg2.connect(DSN)
     cursor = conn.cursor()
-    process_data(cursor, conn, filepath="data/song_data",func=process_song_file)
-    process_data(cursor, conn, filepath="data/log_data", func=process_log_file)
+
+    try:
+        if defer:
+            print("Deferred {} keys and indexes of {}".format(defer_indexes(cursor, tables),
+                                                             ", ".join(tables)))
+            commit(conn)
+
+        yield
+
+        rebuilt = restore_indexes(cursor, tables)
+        commit(conn)
+    finally:
+        conn.close()
+
+    if rebuilt:
+        print("Rebuilt {} keys and indexes of {}".format(rebuilt, ", ".join(tables)))
+
+
+def update_rollups():
+    """
+    Refresh the rollups for the days touched by the songplays loaded since
+    the last refresh
+    """
+
+    conn = psycopg2.connect(DSN)
+
+    with run_metrics.stage("rollups") as stage:
+        stage.rows_in = refresh_rollups(conn.cursor())
+
+    commit(conn)
     conn.close()
 
+    print("Rollups refreshed for {} days".format(stage.rows_in))
+
+
+def run_phase(args, make_loader, filepath, transform, batch_size, options):
+    """
+    Load the files for the given filepath in the mode selected by the
+    script arguments. The options are passed to configure_transforms
+    """
+
+    if args.use_async:
+        conn = psycopg2.connect(DSN)
+
+        configure_transforms(*options)
+        process_data_async(conn, filepath, transform, batch_size, args.workers, not args.full,
+                           make_loader, options, args.queue_depth)
+
+        conn.close()
+    elif args.workers > 0:
+        process_data_parallel(filepath, transform, batch_size, args.workers, args.writers,
+                              not args.full, make_loader, options)
+    else:
+        conn = psycopg2.connect(DSN)
+
+        configure_transforms(*options)
+        process_payloads(make_loader(conn), filepath, transform, batch_size, not args.full)
+
+        conn.close()
+
+
+def main():
+    """
+    Main function to handle entry and script arguments
+    """
+
+    parser = argparse.ArgumentParser(description="Project 1 ETL Script")
+
+    parser.add_argument("--workers", type=int, default=0,
+                        help="number of worker processes parsing files (0 runs serially)")
+    parser.add_argument("--writers", type=int, default=1,
+                        help="number of writer connections when running with workers")
+    parser.add_argument("--full", action="store_true",
+                        help="reload every file, ignoring the manifest of processed files")
+    parser.add_argument("--staging", choices=["transient", "temp", "unlogged"], default="transient",
+                        help="staging tables created per file (transient), or created once per "
+                             "connection (temp) or per run (unlogged) and committed in batches")
+    parser.add_argument("--batch-files", type=int, default=STAGING_BATCH_FILES,
+                        help="files per commit with temp or unlogged staging")
+    parser.add_argument("--batch-rows", type=int, default=STAGING_BATCH_ROWS,
+                        help="rows per commit with temp or unlogged staging")
+    parser.add_argument("--lookup", action="store_true",
+                        help="resolve songplay song and artist ids on the client and copy "
+                             "songplays straight into the final table")
+    parser.add_argument("--lookup-size", type=int, default=None,
+                        help="bound the lookup to this many entries per index, fetching misses "
+                             "from the database (default: load the whole catalog)")
+    parser.add_argument("--stream", action="store_true",
+                        help="stream the log files into copy without pandas, keeping memory "
+                             "flat (serial runs only)")
+    parser.add_argument("--key-cache", action="store_true",
+                        help="drop time and users rows whose keys were already loaded during the run")
+    parser.add_argument("--key-cache-size", type=int, default=None,
+                        help="bound each key cache to this many keys (default: unbounded)")
+    parser.add_argument("--warm-key-cache", action="store_true",
+                        help="fill the key caches from the existing time and users tables")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="overlap reading, transforming and copying in an asyncio pipeline, "
+                             "with --workers transform processes and a single writer")
+    parser.add_argument("--queue-depth", type=int, default=QUEUE_DEPTH,
+                        help="batches held between the stages of the asyncio pipeline")
+    parser.add_argument("--binary", action="store_true",
+                        help="copy in the binary format rather than csv (ignored when streaming)")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="pick the write strategy of each batch by its size: a multi row "
+                             "insert, a csv copy through staging, or a binary copy")
+    parser.add_argument("--values-max-rows", type=int, default=VALUES_MAX_ROWS,
+                        help="largest batch written as a multi row insert with --adaptive")
+    parser.add_argument("--binary-min-rows", type=int, default=BINARY_MIN_ROWS,
+                        help="smallest batch written as binary copy data with --adaptive")
+    parser.add_argument("--bulk", action="store_true",
+                        help="drop the primary keys and indexes of each table while loading it, "
+                             "then rebuild them and analyze (for initial loads)")
+    parser.add_argument("--report", default=None,
+                        help="write the per stage timings and row counts of the run as json to "
+                             "this file")
+    parser.add_argument("--progress-interval", type=float, default=PROGRESS_INTERVAL,
+                        help="minimum seconds between progress lines")
+
+    args = parser.parse_args()
+
+    if args.stream and (args.workers > 0 or args.use_async):
+        parser.error("streamed payloads are read as they are copied, so can't be used with "
+                     "workers or the asyncio pipeline")
+
+    if args.staging == "unlogged" and args.workers > 0 and args.writers > 1:
+        parser.error("unlogged staging tables are shared, so only a single writer can use them")
+
+    if args.staging == "transient":
+        make_loader = PayloadLoader
+    else:
+        make_loader = functools.partial(StagingLoader, unlogged=args.staging == "unlogged",
+                                        batch_files=args.batch_files, batch_rows=args.batch_rows)
+
+    run_metrics.progress_interval = args.progress_interval
+    caches = None
+
+    if args.key_cache:
+        caches = make_key_caches(args.key_cache_size, args.warm_key_cache)
+
+    cutoffs = (args.values_max_rows, args.binary_min_rows) if args.adaptive else None
+
+    if not args.bulk:
+        # finish off any interrupted bulk load before loading normally
+        with bulk_load(bulk_song_tables + bulk_log_tables, False):
+            pass
+
+    with bulk_load(bulk_song_tables) if args.bulk else contextlib.nullcontext():
+        run_phase(args, make_loader, "data/song_data", transform_song_files, SONG_BATCH_SIZE,
+                  (None, args.binary, None, cutoffs))
+
+    # the songs must be loaded before the lookup is built
+    lookup = SongLookup(DSN, args.lookup_size) if args.lookup else None
+    dimensions = make_dimension_lookup()
+
+    # the log files are not batched, each transform receives a list of one file
+    transform = stream_log_files if args.stream else transform_log_files
+
+    options = (lookup, args.binary, caches, cutoffs, dimensions)
+
+    with bulk_load(bulk_log_tables) if args.bulk else contextlib.nullcontext():
+        run_phase(args, make_loader, "data/log_data", transform, 1, options)
+        resume_appended("data/log_data", make_loader, options)
+
+    update_rollups()
+
+    if args.report is not None:
+        run_metrics.write_report(args.report)
+        print("Run report written to {}".format(args.report))
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+import io
+import csv
+import json
+import argparse
+import psycopg2
+
+from sql_queries import export_table_select, export_table_where_select, export_columns_select, export_copy
+from create_tables import SPARKIFY_DSN as DSN
+
+# rows fetched at a time by the server side cursor for json lines and parquet
+EXPORT_CHUNK_ROWS = 10000
+
+# parquet column types for the postgres type oids, anything else is written
+# as a string
+parquet_types = {
+    16: "bool_",
+    20: "int64",
+    21: "int16",
+    23: "int32",
+    700: "float32",
+    701: "float64"
+}
+
+
+class SplitWriter:
+    """
+    Writes the exported data to a single file named prefix.extension, or
+    with max_bytes set, to a series of files named prefix-00001.extension
+    and so on, starting a new file once the current one reaches max_bytes.
+    Each write must end on a row boundary, and the header, if given, is
+    written at the start of every file. Takes bytes, so it can be passed to
+    copy_expert
+    """
+
+    def __init__(self, prefix, extension, max_bytes=None, header=b""):
+        self.prefix = prefix
+        self.extension = extension
+        self.max_bytes = max_bytes
+        self.header = header
+        self.files = []
+        self.file = None
+        self.size = 0
+
+    def next_file(self):
+        """
+        Close the current file and open the next
+        """
+
+        self.close()
+
+        if self.max_bytes is None:
+            path = "{}.{}".format(self.prefix, self.extension)
+        else:
+            path = "{}-{:05d}.{}".format(self.prefix, len(self.files) + 1, self.extension)
+
+        self.files.append(path)
+        self.file = open(path, "wb")
+        self.file.write(self.header)
+        self.size = len(self.header)
+
+    def write(self, data):
+        if self.file is None or (self.max_bytes is not None and self.size >= self.max_bytes):
+            self.next_file()
+
+        self.file.write(data)
+        self.size += len(data)
+
+    def finish(self):
+        """
+        Close the last file, writing a file with just the header if there
+        was no data
+        """
+
+        if not self.files:
+            self.next_file()
+
+        self.close()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class ParquetSplitWriter:
+    """
+    Writes chunks of rows to parquet files, a row group per chunk, split
+    into files of max_bytes like SplitWriter. The schema comes from the
+    cursor description, so every chunk and file has the same column types
+    """
+
+    def __init__(self, prefix, description, max_bytes=None):
+        # only needed for parquet, so only required when exporting to it
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("parquet export requires the pyarrow package")
+
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.files = []
+        self.file = None
+        self.writer = None
+
+        self.schema = pyarrow.schema([
+            (column.name, getattr(pyarrow, parquet_types.get(column.type_code, "string"))())
+            for column in description])
+
+    def next_file(self):
+        """
+        Close the current file and open the next
+        """
+
+        self.close()
+
+        if self.max_bytes is None:
+            path = "{}.parquet".format(self.prefix)
+        else:
+            path = "{}-{:05d}.parquet".format(self.prefix, len(self.files) + 1)
+
+        self.files.append(path)
+        self.file = open(path, "wb")
+        self.writer = self.pq.ParquetWriter(self.file, self.schema)
+
+    def write_rows(self, rows):
+        """
+        Write a chunk of row tuples as a row group
+        """
+
+        if self.file is None or (self.max_bytes is not None and self.file.tell() >= self.max_bytes):
+            self.next_file()
+
+        columns = []
+
+        for i, field in enumerate(self.schema):
+            values = [row[i] for row in rows]
+
+            if field.type == self.pa.string():
+                values = [None if value is None else str(value) for value in values]
+
+            columns.append(self.pa.array(values, field.type))
+
+        self.writer.write_table(self.pa.Table.from_arrays(columns, schema=self.schema))
+
+    def finish(self):
+        """
+        Close the last file, writing a file with just the schema if there
+        was no data
+        """
+
+        if not self.files:
+            self.next_file()
+
+        self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.file.close()
+            self.writer = None
+            self.file = None
+
+
+def export_query(table, where=None, query=None):
+    """
+    Build the query to export, either a whole table, a table filtered by a
+    where clause, or any query
+    """
+
+    if query is not None:
+        return query
+
+    if where is not None:
+        return export_table_where_select.format(table, where)
+
+    return export_table_select.format(table)
+
+
+def export_columns(cursor, query):
+    """
+    Return the cursor description of the query's columns, without running it
+    """
+
+    cursor.execute(export_columns_select.format(query))
+    return cursor.description
+
+
+def export_csv(conn, query, prefix, max_bytes=None):
+    """
+    Stream the query out as csv with COPY TO, writing the rows to the files
+    as they arrive. Returns the files written
+    """
+
+    cursor = conn.cursor()
+
+    header = io.StringIO()
+    csv.writer(header, lineterminator="\n").writerow(
+        column.name for column in export_columns(cursor, query))
+
+    writer = SplitWriter(prefix, "csv", max_bytes, header.getvalue().encode())
+
+    try:
+        cursor.copy_expert(export_copy.format(query), writer)
+        writer.finish()
+    finally:
+        writer.close()
+
+    return writer.files
+
+
+def fetch_chunks(conn, query, chunk_rows=EXPORT_CHUNK_ROWS):
+    """
+    Generator over the rows of the query in chunks, read through a server
+    side cursor, so only one chunk is held at a time. Yields the cursor
+    description first
+    """
+
+    cursor = conn.cursor(name="export")
+    cursor.itersize = chunk_rows
+    cursor.execute(query)
+
+    rows = cursor.fetchmany(chunk_rows)
+    yield cursor.description
+
+    while rows:
+        yield rows
+        rows = cursor.fetchmany(chunk_rows)
+
+    cursor.close()
+
+
+def export_jsonl(conn, query, prefix, max_bytes=None, chunk_rows=EXPORT_CHUNK_ROWS):
+    """
+    Stream the query out as json lines, one object per row, a chunk of rows
+    at a time. Returns the files written
+    """
+
+    chunks = fetch_chunks(conn, query, chunk_rows)
+    columns = [column.name for column in next(chunks)]
+    writer = SplitWriter(prefix, "jsonl", max_bytes)
+
+    try:
+        for rows in chunks:
+            for row in rows:
+                writer.write((json.dumps(dict(zip(columns, row)), default=str) + "\n").encode())
+
+        writer.finish()
+    finally:
+        writer.close()
+
+    return writer.files
+
+
+def export_parquet(conn, query, prefix, max_bytes=None, chunk_rows=EXPORT_CHUNK_ROWS):
+    """
+    Stream the query out as parquet, a row group per chunk of rows. Returns
+    the files written
+    """
+
+    chunks = fetch_chunks(conn, query, chunk_rows)
+    writer = ParquetSplitWriter(prefix, next(chunks), max_bytes)
+
+    try:
+        for rows in chunks:
+            writer.write_rows(rows)
+
+        writer.finish()
+    finally:
+        writer.close()
+
+    return writer.files
+
+
+exporters = {
+    "csv": export_csv,
+    "jsonl": export_jsonl,
+    "parquet": export_parquet
+}
+
+
+def main():
+    """
+    Export a table, a filtered table or a query to csv, json lines or
+    parquet files
+    """
+
+    parser = argparse.ArgumentParser(description="Streaming export of sparkifydb tables")
+
+    parser.add_argument("output", help="output file prefix, the extension is added")
+    parser.add_argument("--table", default="songplays", help="table to export")
+    parser.add_argument("--where", default=None, help="filter the table by this condition")
+    parser.add_argument("--query", default=None, help="export this query in place of a table")
+    parser.add_argument("--format", choices=sorted(exporters), default="csv")
+    parser.add_argument("--max-bytes", type=int, default=None,
+                        help="split the output into files of about this size")
+
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(DSN)
+    query = export_query(args.table, args.where, args.query)
+
+    files = exporters[args.format](conn, query, args.output, args.max_bytes)
+    conn.close()
+
+    for path in files:
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
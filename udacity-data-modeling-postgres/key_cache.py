@@ -0,0 +1,60 @@
+import collections
+
+
+class KeyCache:
+    """
+    Cache of the dimension keys already loaded during a run, so rows for
+    known keys can be dropped on the client rather than being copied again
+    only to be skipped by ON CONFLICT DO NOTHING.
+
+    The keys are the integer primary keys of the time and users tables. With
+    max_keys of None the cache grows for the whole run, otherwise the least
+    recently seen keys are evicted once full. An evicted key is simply sent
+    again, which the conflict check still handles
+    """
+
+    def __init__(self, max_keys=None):
+        self.max_keys = max_keys
+        self.keys = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def warm(self, cursor, query):
+        """
+        Fill the cache from the existing table, the query selects the key
+        column and takes the row limit as its parameter
+        """
+
+        cursor.execute(query, (self.max_keys,))
+
+        for row in cursor:
+            self.add(row[0])
+
+    def add(self, key):
+        """
+        Add a key to the cache. Returns True if the key is new, or False if
+        it was already known
+        """
+
+        key = int(key)
+
+        if key in self.keys:
+            self.keys.move_to_end(key)
+            self.hits += 1
+            return False
+
+        self.keys[key] = None
+        self.misses += 1
+
+        if self.max_keys is not None and len(self.keys) > self.max_keys:
+            self.keys.popitem(last=False)
+
+        return True
+
+    def add_new(self, keys):
+        """
+        Add a sequence of keys to the cache, returning a list of booleans
+        which are True for the keys that were new
+        """
+
+        return [self.add(key) for key in keys]
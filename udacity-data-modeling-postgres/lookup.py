@@ -0,0 +1,250 @@
+import collections
+import psycopg2
+
+from sql_queries import artist_lookup_select, song_lookup_select, \
+    artist_lookup_select_names, song_lookup_select_keys, dimension_lookup_queries
+
+
+class SongLookup:
+    """
+    In memory index used to resolve the song and artist ids of songplays on
+    the client, instead of joining against the songs and artists tables.
+
+    The keys are the same as those used by songplay_insert_from_staging, the
+    artist id is found from the artist name, and the song id from the title
+    and duration, so both give the same ids for keys with a single match.
+    Where a key is repeated the join gives a row for each match, while the
+    lookup keeps the first match only.
+
+    With max_entries of None the whole of both tables is read once, up front.
+    Otherwise each index is a bounded least recently used cache, and misses
+    are fetched from the database in one query per resolve call. Misses are
+    cached as well, since most unmatched songs are played again
+    """
+
+    def __init__(self, dsn, max_entries=None):
+        self.dsn = dsn
+        self.max_entries = max_entries
+        self.conn = None
+        self.artists = collections.OrderedDict()
+        self.songs = collections.OrderedDict()
+
+        if max_entries is None:
+            cursor = self.connect().cursor()
+
+            # where keys are repeated the join gives a row for each match,
+            # here only the first is kept
+            cursor.execute(artist_lookup_select)
+            for name, artist_id in cursor:
+                self.artists.setdefault(name, artist_id)
+
+            cursor.execute(song_lookup_select)
+            for title, duration, song_id in cursor:
+                self.songs.setdefault((title, duration), song_id)
+
+            self.close()
+
+    def __getstate__(self):
+        """
+        Drop the connection when sent to a worker process, a new one is
+        opened there when needed
+        """
+
+        state = self.__dict__.copy()
+        state["conn"] = None
+        return state
+
+    def connect(self):
+        """
+        Return the connection, opening it if need be
+        """
+
+        if self.conn is None:
+            self.conn = psycopg2.connect(self.dsn)
+            self.conn.set_session(readonly=True, autocommit=True)
+
+        return self.conn
+
+    def close(self):
+        """
+        Close the connection, if open
+        """
+
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def cache(self, index, key, value):
+        """
+        Add a key to one of the bounded indexes, evicting the least recently
+        used keys once full
+        """
+
+        index[key] = value
+
+        while len(index) > self.max_entries:
+            index.popitem(last=False)
+
+    def fetch_missing(self, artists, songs):
+        """
+        Fetch the given artist names and (title, duration) keys from the
+        database. Returns artist and song dicts holding every requested key,
+        with None for those not found
+        """
+
+        cursor = self.connect().cursor()
+        found_artists = dict.fromkeys(artists)
+        found_songs = dict.fromkeys(songs)
+
+        if artists:
+            cursor.execute(artist_lookup_select_names, (list(artists),))
+            for name, artist_id in cursor:
+                if found_artists[name] is None:
+                    found_artists[name] = artist_id
+
+        if songs:
+            titles, durations = zip(*songs)
+            cursor.execute(song_lookup_select_keys, (list(titles), list(durations)))
+            for title, duration, song_id in cursor:
+                if found_songs.get((title, duration), 0) is None:
+                    found_songs[(title, duration)] = song_id
+
+        return found_artists, found_songs
+
+    def lookup(self, index, keys):
+        """
+        Look up the given keys in one of the bounded indexes. Returns a dict
+        of the keys found, marking them as recently used, and a set of the
+        keys which are missing. Only strings can match, so any missing values
+        are neither looked up nor fetched
+        """
+
+        found = {}
+        missing = set()
+
+        for key in keys:
+            if key in found or key in missing:
+                continue
+
+            if key in index:
+                index.move_to_end(key)
+                found[key] = index[key]
+            elif isinstance(key, str) or (isinstance(key, tuple) and isinstance(key[0], str)):
+                missing.add(key)
+
+        return found, missing
+
+    def resolve(self, artists, titles, durations):
+        """
+        Resolve sequences of artist names, song titles and durations to lists
+        of song ids and artist ids, with None where there is no match
+        """
+
+        artists = list(artists)
+        keys = list(zip(titles, durations))
+
+        if self.max_entries is None:
+            return ([self.songs.get(key) for key in keys],
+                    [self.artists.get(name) for name in artists])
+
+        # take the values found before adding anything, since adding to the
+        # indexes may evict entries this call still needs
+        found_artists, missing_artists = self.lookup(self.artists, artists)
+        found_songs, missing_songs = self.lookup(self.songs, keys)
+
+        if missing_artists or missing_songs:
+            fetched_artists, fetched_songs = self.fetch_missing(missing_artists, missing_songs)
+
+            for name, artist_id in fetched_artists.items():
+                self.cache(self.artists, name, artist_id)
+
+            for key, song_id in fetched_songs.items():
+                self.cache(self.songs, key, song_id)
+
+            found_artists.update(fetched_artists)
+            found_songs.update(fetched_songs)
+
+        return ([found_songs.get(key) for key in keys],
+                [found_artists.get(name) for name in artists])
+
+
+class DimensionLookup:
+    """
+    In memory index used to resolve the songplay locations and user agents
+    of the compact schema to their ids on the client, so only the ids are
+    copied rather than the strings.
+
+    Both dimension tables hold one row per distinct value, so they are read
+    whole, up front. Values not yet in a table are added to it and their ids
+    read back, in one pair of queries per resolve call.
+
+    By default the lookup opens its own connection, adding the new values in
+    autocommit, so they are visible to every writer at once. Given a
+    connection, the values are added in its transaction instead
+    """
+
+    def __init__(self, dsn, conn=None):
+        self.dsn = dsn
+        self.conn = conn
+        self.owned = conn is None
+        self.indexes = {table: {} for table in dimension_lookup_queries}
+
+        cursor = self.connect().cursor()
+
+        for table, queries in dimension_lookup_queries.items():
+            cursor.execute(queries[0])
+            self.indexes[table].update(cursor)
+
+        self.close()
+
+    def __getstate__(self):
+        """
+        Drop the connection when sent to a worker process, a new one is
+        opened there when needed
+        """
+
+        state = self.__dict__.copy()
+        state["conn"] = None
+        state["owned"] = True
+        return state
+
+    def connect(self):
+        """
+        Return the connection, opening it if need be
+        """
+
+        if self.conn is None:
+            self.conn = psycopg2.connect(self.dsn)
+            self.conn.set_session(autocommit=True)
+
+        return self.conn
+
+    def close(self):
+        """
+        Close the connection, if opened by the lookup
+        """
+
+        if self.conn is not None and self.owned:
+            self.conn.close()
+            self.conn = None
+
+    def resolve(self, table, values):
+        """
+        Resolve a sequence of values of the given dimension table to a list of
+        ids, adding any values the table is missing. Missing values, such as
+        None, give None
+        """
+
+        values = list(values)
+        index = self.indexes[table]
+        missing = sorted(set(value for value in values if isinstance(value, str) and value not in index))
+
+        if missing:
+            select, insert, select_values = dimension_lookup_queries[table]
+            cursor = self.connect().cursor()
+
+            cursor.execute(insert, (missing,))
+            cursor.execute(select_values, (missing,))
+            index.update(cursor)
+
+        return [index.get(value) for value in values]
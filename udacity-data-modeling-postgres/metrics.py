@@ -0,0 +1,203 @@
+import json
+import time
+import datetime
+import threading
+import contextlib
+
+# default seconds between progress lines
+PROGRESS_INTERVAL = 1.0
+
+
+class StageRecord:
+    """
+    Counters for one run of a stage, filled in by the code being measured
+    """
+
+    def __init__(self, rows_in=0):
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.bytes = 0
+
+
+class RunMetrics:
+    """
+    Collects the wall time, rows in and out, and bytes of every stage of the
+    etl, by stage name, along with the files processed in each phase. Safe
+    to use from the writer threads. Worker processes hold their own copy,
+    which is passed back with snapshot and added in with merge
+    """
+
+    def __init__(self, progress_interval=PROGRESS_INTERVAL):
+        self.progress_interval = progress_interval
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Clear all the collected metrics
+        """
+
+        self.started = time.time()
+        self.stages = {}
+        self.phases = []
+        self.samples = {}
+
+    @contextlib.contextmanager
+    def stage(self, name, rows_in=0):
+        """
+        Context manager timing a stage. Yields a StageRecord for the caller
+        to set rows_out and bytes on, rows_out defaults to rows_in
+        """
+
+        record = StageRecord(rows_in)
+        start = time.perf_counter()
+
+        yield record
+
+        seconds = time.perf_counter() - start
+        rows_out = record.rows_in if record.rows_out is None else record.rows_out
+
+        self.add(name, {"calls": 1, "seconds": seconds, "rows_in": record.rows_in,
+                        "rows_out": rows_out, "bytes": record.bytes})
+
+    def add(self, name, counters):
+        """
+        Add a set of counters to the totals of the named stage
+        """
+
+        with self.lock:
+            totals = self.stages.setdefault(
+                name, {"calls": 0, "seconds": 0.0, "rows_in": 0, "rows_out": 0, "bytes": 0})
+
+            for key, value in counters.items():
+                totals[key] += value
+
+    def observe(self, name, value):
+        """
+        Record a sample of the named measurement, such as a latency in
+        seconds, reported as percentiles
+        """
+
+        with self.lock:
+            self.samples.setdefault(name, []).append(value)
+
+    def summary(self, name):
+        """
+        Return the count, mean, median, 95th percentile and maximum of the
+        samples of the named measurement, or None if there are none
+        """
+
+        with self.lock:
+            values = sorted(self.samples.get(name, []))
+
+        if not values:
+            return None
+
+        return {"count": len(values),
+                "mean": sum(values) / len(values),
+                "p50": values[(len(values) - 1) // 2],
+                "p95": values[int((len(values) - 1) * 0.95)],
+                "max": values[-1]}
+
+    def snapshot(self):
+        """
+        Return the stage totals, to pass back from a worker process
+        """
+
+        with self.lock:
+            return {name: dict(totals) for name, totals in self.stages.items()}
+
+    def merge(self, stages):
+        """
+        Add in the stage totals from a worker process snapshot
+        """
+
+        for name, counters in stages.items():
+            self.add(name, counters)
+
+    def begin(self, name, total):
+        """
+        Start a phase of the run, processing total files
+        """
+
+        now = time.time()
+
+        with self.lock:
+            self.phases.append({"name": name, "files": total, "processed": 0,
+                                "started": now, "seconds": 0.0, "last_print": now})
+
+    def advance(self, count):
+        """
+        Mark count more files of the current phase as processed, printing a
+        progress line with the rate and an estimated time to completion if
+        one is due, or if the phase is complete
+        """
+
+        now = time.time()
+
+        with self.lock:
+            phase = self.phases[-1]
+            phase["processed"] += count
+            phase["seconds"] = now - phase["started"]
+
+            done = phase["processed"]
+            total = phase["files"]
+
+            if done < total and now - phase["last_print"] < self.progress_interval:
+                return
+
+            phase["last_print"] = now
+
+        rate = done / phase["seconds"] if phase["seconds"] > 0 else 0.0
+        eta = (total - done) / rate if rate > 0 else 0.0
+
+        print("{}/{} files processed. {:.1f} files/s, ETA {}".format(
+            done, total, rate, datetime.timedelta(seconds=round(eta))))
+
+    def report(self):
+        """
+        Build the run report, a dict ready to be written as json
+        """
+
+        with self.lock:
+            stages = {}
+
+            for name, totals in sorted(self.stages.items()):
+                stage = dict(totals)
+                seconds = stage["seconds"]
+                stage["rows_per_second"] = stage["rows_out"] / seconds if seconds > 0 else None
+                stages[name] = stage
+
+            phases = [{key: phase[key] for key in ("name", "files", "processed", "seconds")}
+                      for phase in self.phases]
+
+            names = sorted(self.samples)
+
+        return {"started": datetime.datetime.fromtimestamp(self.started).isoformat(),
+                "seconds": time.time() - self.started,
+                "phases": phases,
+                "stages": stages,
+                "samples": {name: self.summary(name) for name in names}}
+
+    def write_report(self, filepath):
+        """
+        Write the run report as json to the given file
+        """
+
+        with open(filepath, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+
+# the metrics of the current run
+run_metrics = RunMetrics()
+
+
+def measured(func, *args):
+    """
+    Run func in a worker process with fresh metrics, returning its result
+    along with the stage totals for the main process to merge
+    """
+
+    run_metrics.reset()
+    result = func(*args)
+    return result, run_metrics.snapshot()
@@ -0,0 +1,151 @@
+import datetime
+
+import psycopg2
+
+from sql_queries import (songplay_partitioned_select, songplay_partition_select,
+                         songplay_partition_months_select, songplay_partition_create,
+                         songplay_partition_lock)
+
+
+def month_start(ts):
+    """
+    Return the start of the month of an epoch millisecond timestamp, in
+    epoch milliseconds
+    """
+
+    month = datetime.datetime.utcfromtimestamp(ts // 1000).replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0)
+
+    return int((month - datetime.datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+def month_bounds(start):
+    """
+    Return the name and the (start, end) epoch millisecond bounds of the
+    monthly songplays partition starting at start
+    """
+
+    month = datetime.datetime.utcfromtimestamp(start / 1000)
+
+    if month.month == 12:
+        following = month.replace(year=month.year + 1, month=1)
+    else:
+        following = month.replace(month=month.month + 1)
+
+    end = int((following - datetime.datetime(1970, 1, 1)).total_seconds() * 1000)
+    return "songplays_{:%Y_%m}".format(month), start, end
+
+
+class SongplayPartitions:
+    """
+    Creates the monthly partitions of a partitioned songplays table as the
+    loader sees new months.
+
+    Creating a partition locks the whole songplays table until commit, so by
+    default the partitions are created on a connection of their own, each
+    batch in a short transaction, rather than in the loader's transaction,
+    which may be a long batch. The loader must then create the partitions
+    before it moves any rows into songplays in its transaction, or the create
+    would wait on the loader itself. Given a connection, the partitions are
+    created in its transaction instead
+    """
+
+    def __init__(self, dsn, conn=None):
+        self.dsn = dsn
+        self.conn = conn
+        self.owned = conn is None
+        self.known = set()
+        self.refresh(self.connect().cursor())
+
+        if self.owned:
+            self.conn.commit()
+
+    def connect(self):
+        """
+        Return the connection, opening it if need be
+        """
+
+        if self.conn is None:
+            self.conn = psycopg2.connect(self.dsn)
+
+        return self.conn
+
+    def close(self):
+        """
+        Close the connection, if opened by the partitions
+        """
+
+        if self.conn is not None and self.owned:
+            self.conn.close()
+            self.conn = None
+
+    def refresh(self, cursor):
+        """
+        Reload the names of the existing partitions
+        """
+
+        cursor.execute(songplay_partition_select)
+        self.known = {row[0] for row in cursor.fetchall()}
+
+    def ensure(self, cursor, staging=(), times=()):
+        """
+        Create the partitions for the months of the rows in the given staging
+        tables, read with the loader's cursor, and of the given start times,
+        for rows inserted without a staging table. Returns the names of the
+        partitions created
+        """
+
+        starts = {month_start(ts) for ts in times}
+
+        for table in staging:
+            cursor.execute(songplay_partition_months_select.format(table))
+            starts.update(row[0] for row in cursor.fetchall())
+
+        return self.create(starts)
+
+    def create(self, starts):
+        """
+        Create the missing partitions of the months with the given starts
+        """
+
+        months = [month_bounds(start) for start in sorted(starts)]
+        missing = [month for month in months if month[0] not in self.known]
+
+        if not missing:
+            return []
+
+        cursor = self.connect().cursor()
+
+        try:
+            # another writer may have created them while we waited for the lock
+            cursor.execute(songplay_partition_lock)
+            self.refresh(cursor)
+            missing = [month for month in missing if month[0] not in self.known]
+
+            for name, start, end in missing:
+                cursor.execute(songplay_partition_create.format(name, start, end))
+
+            if self.owned:
+                self.conn.commit()
+        except Exception:
+            if self.owned:
+                self.conn.rollback()
+            raise
+
+        self.known.update(month[0] for month in missing)
+        return [month[0] for month in missing]
+
+
+def songplay_partitions(cursor, dsn, conn=None):
+    """
+    Return a SongplayPartitions for the loader if the songplays table is
+    partitioned, otherwise None. The cursor is used to check whether it is
+    """
+
+    cursor.execute(songplay_partitioned_select)
+    row = cursor.fetchone()
+
+    if row is None or not row[0]:
+        return None
+
+    return SongplayPartitions(dsn, conn)
@@ -0,0 +1,154 @@
+# Rollup tables summarising the songplays, so the dashboard queries read a
+# few rows per hour or day rather than scanning the fact table. They are
+# refreshed by etl.py for only the days each load touched. Times are epoch
+# milliseconds, like the songplays start_time, truncated to the hour or day
+
+# DROP TABLES
+
+hourly_rollup_drop = "DROP TABLE IF EXISTS songplays_hourly"
+user_rollup_drop = "DROP TABLE IF EXISTS songplays_daily_users"
+song_rollup_drop = "DROP TABLE IF EXISTS songplays_daily_songs"
+rollup_state_drop = "DROP TABLE IF EXISTS rollup_state"
+
+# CREATE TABLES
+
+hourly_rollup_create = ("""
+CREATE TABLE IF NOT EXISTS songplays_hourly (
+    hour_start bigint NOT NULL,
+    plays integer NOT NULL,
+    users integer NOT NULL,
+    PRIMARY KEY (hour_start)
+);
+""")
+
+user_rollup_create = ("""
+CREATE TABLE IF NOT EXISTS songplays_daily_users (
+    day_start bigint NOT NULL,
+    user_id integer NOT NULL,
+    level text NOT NULL,
+    plays integer NOT NULL,
+    PRIMARY KEY (day_start, user_id, level)
+);
+""")
+
+# Only the songplays resolved to a song are counted
+song_rollup_create = ("""
+CREATE TABLE IF NOT EXISTS songplays_daily_songs (
+    day_start bigint NOT NULL,
+    song_id text NOT NULL,
+    plays integer NOT NULL,
+    PRIMARY KEY (day_start, song_id)
+);
+""")
+
+# The last songplay_id covered by the rollups
+rollup_state_create = ("""
+CREATE TABLE IF NOT EXISTS rollup_state (
+    name text NOT NULL,
+    value bigint NOT NULL,
+    PRIMARY KEY (name)
+);
+""")
+
+# REFRESH
+
+# The songplay_id serial is handed out on insert, not in commit order, so a
+# lower id can commit after a higher one. Every transaction loading
+# songplays holds this lock shared until it commits, and a refresh holds it
+# exclusively, so the refresh only reads the maximum songplay_id once every
+# id below it is committed
+rollup_writer_lock = "SELECT pg_advisory_xact_lock_shared(hashtext('rollup_state'))"
+rollup_refresh_lock = "SELECT pg_advisory_xact_lock(hashtext('rollup_state'))"
+
+rollup_state_select = "SELECT value FROM rollup_state WHERE name = 'songplay_id'"
+
+rollup_state_upsert = ("""
+INSERT INTO rollup_state (name, value) VALUES ('songplay_id', %s)
+ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value;
+""")
+
+songplay_max_id_select = "SELECT max(songplay_id) FROM songplays"
+
+# The days with songplays loaded since the last refresh, takes the last
+# refreshed and the current maximum songplay_id
+rollup_touched_days_select = ("""
+SELECT DISTINCT start_time - mod(start_time, 86400000)
+FROM songplays
+WHERE songplay_id > %s AND songplay_id <= %s
+ORDER BY 1
+""")
+
+# Each rollup is rebuilt from the songplays for a range of whole days, so a
+# refresh is idempotent and late rows for a day are picked up. All take the
+# start and end of the range
+hourly_rollup_delete = "DELETE FROM songplays_hourly WHERE hour_start >= %s AND hour_start < %s"
+user_rollup_delete = "DELETE FROM songplays_daily_users WHERE day_start >= %s AND day_start < %s"
+song_rollup_delete = "DELETE FROM songplays_daily_songs WHERE day_start >= %s AND day_start < %s"
+
+hourly_rollup_insert = ("""
+INSERT INTO songplays_hourly (hour_start, plays, users)
+    SELECT start_time - mod(start_time, 3600000), count(*), count(DISTINCT user_id)
+    FROM songplays
+    WHERE start_time >= %s AND start_time < %s
+    GROUP BY 1;
+""")
+
+user_rollup_insert = ("""
+INSERT INTO songplays_daily_users (day_start, user_id, level, plays)
+    SELECT start_time - mod(start_time, 86400000), user_id, level, count(*)
+    FROM songplays
+    WHERE start_time >= %s AND start_time < %s
+    GROUP BY 1, 2, 3;
+""")
+
+song_rollup_insert = ("""
+INSERT INTO songplays_daily_songs (day_start, song_id, plays)
+    SELECT start_time - mod(start_time, 86400000), song_id, count(*)
+    FROM songplays
+    WHERE start_time >= %s AND start_time < %s AND song_id IS NOT NULL
+    GROUP BY 1, 2;
+""")
+
+# QUERIES
+
+# All take the start and end of the time range, the daily rollups cover the
+# days starting within the range
+plays_per_hour_select = ("""
+SELECT hour_start, plays, users
+FROM songplays_hourly
+WHERE hour_start >= %s AND hour_start < %s
+ORDER BY hour_start
+""")
+
+plays_per_level_select = ("""
+SELECT level, sum(plays), count(DISTINCT user_id)
+FROM songplays_daily_users
+WHERE day_start >= %s AND day_start < %s
+GROUP BY level
+ORDER BY level
+""")
+
+# Also takes the number of songs
+top_songs_select = ("""
+SELECT r.song_id, s.title, a.name, sum(r.plays) AS plays
+FROM songplays_daily_songs r
+JOIN songs s ON s.song_id = r.song_id
+LEFT JOIN artists a ON a.artist_id = s.artist_id
+WHERE r.day_start >= %s AND r.day_start < %s
+GROUP BY r.song_id, s.title, a.name
+ORDER BY plays DESC, r.song_id
+LIMIT %s
+""")
+
+# QUERY LISTS
+
+rollup_create_queries = [hourly_rollup_create, user_rollup_create, song_rollup_create, rollup_state_create]
+rollup_drop_queries = [hourly_rollup_drop, user_rollup_drop, song_rollup_drop, rollup_state_drop]
+rollup_table_names = ["songplays_hourly", "songplays_daily_users", "songplays_daily_songs", "rollup_state"]
+
+# (delete, insert) for each rollup
+rollup_refresh_queries = [
+    (hourly_rollup_delete, hourly_rollup_insert),
+    (user_rollup_delete, user_rollup_insert),
+    (song_rollup_delete, song_rollup_insert)
+]
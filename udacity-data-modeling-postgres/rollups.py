@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+import argparse
+import datetime
+import psycopg2
+
+from rollup_queries import *
+from create_tables import SPARKIFY_DSN as DSN
+
+DAY = 86400000
+
+
+def day_ranges(days):
+    """
+    Merge a sorted list of day starts, in epoch milliseconds, into a list of
+    (start, end) ranges of consecutive days
+    """
+
+    ranges = []
+
+    for day in days:
+        if ranges and ranges[-1][1] == day:
+            ranges[-1][1] = day + DAY
+        else:
+            ranges.append([day, day + DAY])
+
+    return [tuple(r) for r in ranges]
+
+
+def writer_lock(cursor):
+    """
+    Take the lock held by every transaction loading songplays, until it
+    commits. Refreshes wait for these transactions to commit, and new ones
+    wait for a refresh to commit
+    """
+
+    cursor.execute(rollup_writer_lock)
+
+
+def refresh(cursor):
+    """
+    Bring the rollups up to date with the songplays loaded since the last
+    refresh. Each day with new songplays is rebuilt in full from the fact
+    table, so nothing else is scanned. Returns the number of days refreshed.
+
+    The refresh first waits for the transactions loading songplays to
+    commit, so the songplays it covers are all committed
+    """
+
+    cursor.execute(rollup_refresh_lock)
+
+    cursor.execute(rollup_state_select)
+    row = cursor.fetchone()
+    last_id = row[0] if row is not None else 0
+
+    cursor.execute(songplay_max_id_select)
+    max_id = cursor.fetchone()[0]
+
+    if max_id is None or max_id <= last_id:
+        return 0
+
+    cursor.execute(rollup_touched_days_select, (last_id, max_id))
+    days = [row[0] for row in cursor.fetchall()]
+
+    refresh_days(cursor, days)
+
+    cursor.execute(rollup_state_upsert, (max_id,))
+    return len(days)
+
+
+def refresh_days(cursor, days):
+    """
+    Rebuild the rollups for a sorted list of day starts, in epoch
+    milliseconds, from the songplays. Used for songplays updated in place,
+    which the songplay_id watermark doesn't see
+    """
+
+    for start, end in day_ranges(days):
+        for delete, insert in rollup_refresh_queries:
+            cursor.execute(delete, (start, end))
+            cursor.execute(insert, (start, end))
+
+
+def plays_per_hour(cursor, start, end):
+    """
+    Return (hour_start, plays, users) for each hour with plays between start
+    and end, in epoch milliseconds
+    """
+
+    cursor.execute(plays_per_hour_select, (start, end))
+    return cursor.fetchall()
+
+
+def plays_per_level(cursor, start, end):
+    """
+    Return (level, plays, users) for each user level, over the days starting
+    between start and end
+    """
+
+    cursor.execute(plays_per_level_select, (start, end))
+    return cursor.fetchall()
+
+
+def top_songs(cursor, start, end, limit=10):
+    """
+    Return (song_id, title, artist, plays) for the limit most played songs,
+    over the days starting between start and end
+    """
+
+    cursor.execute(top_songs_select, (start, end, limit))
+    return cursor.fetchall()
+
+
+def epoch_ms(date):
+    """
+    Convert a YYYY-MM-DD date, taken as UTC, to epoch milliseconds
+    """
+
+    day = datetime.datetime.strptime(date, "%Y-%m-%d")
+    return int((day - datetime.datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+def main():
+    """
+    Print the rollup reports for a range of days
+    """
+
+    parser = argparse.ArgumentParser(description="Songplay rollup reports")
+
+    parser.add_argument("report", choices=["hourly", "levels", "songs"],
+                        help="plays per hour, plays per user level, or the top songs")
+    parser.add_argument("--start", default="1970-01-01", help="first day, YYYY-MM-DD")
+    parser.add_argument("--end", default="9999-12-31", help="day after the last, YYYY-MM-DD")
+    parser.add_argument("--limit", type=int, default=10, help="number of top songs")
+
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(DSN)
+    cursor = conn.cursor()
+
+    start, end = epoch_ms(args.start), epoch_ms(args.end)
+
+    if args.report == "hourly":
+        for hour_start, plays, users in plays_per_hour(cursor, start, end):
+            hour = datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=hour_start)
+            print("{:%Y-%m-%d %H:00}  {} plays, {} users".format(hour, plays, users))
+    elif args.report == "levels":
+        for level, plays, users in plays_per_level(cursor, start, end):
+            print("{}  {} plays, {} users".format(level, plays, users))
+    else:
+        for song_id, title, artist, plays in top_songs(cursor, start, end, args.limit):
+            print("{}  {} - {}".format(plays, artist, title))
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import argparse
+import datetime
+import concurrent.futures
+import psycopg2
+
+from sql_queries import *
+from bulk_load import defer_indexes, restore_indexes
+from create_tables import SPARKIFY_DSN as DSN, clone_template, schema_version
+
+# default number of tables copied at once
+SNAPSHOT_JOBS = 4
+
+# the description of the snapshot, written alongside the table files
+MANIFEST = "snapshot.json"
+
+
+def export_table(snapshot, table, directory):
+    """
+    Copy a table to a binary copy file in the directory, on its own
+    connection, reading from the exported snapshot so every table is from
+    the same point in time
+    """
+
+    conn = psycopg2.connect(DSN)
+    conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+    cursor = conn.cursor()
+
+    # must be the first statement of the transaction
+    cursor.execute(set_snapshot, (snapshot,))
+
+    filename = table + ".bin"
+    start = time.perf_counter()
+
+    with open(os.path.join(directory, filename), "wb") as f:
+        cursor.copy_expert(snapshot_export.format(table), f)
+
+    rows = cursor.rowcount
+    conn.close()
+
+    return {"table": table, "file": filename, "rows": rows,
+            "bytes": os.path.getsize(os.path.join(directory, filename)),
+            "seconds": time.perf_counter() - start}
+
+
+def export_snapshot(directory, jobs=SNAPSHOT_JOBS):
+    """
+    Export every table of the sparkify database to the directory, jobs
+    tables at a time. The partitions of a partitioned songplays table are
+    exported separately, so they can be restored in parallel too
+    """
+
+    os.makedirs(directory, exist_ok=True)
+
+    # the leader transaction holds the snapshot open until all the tables
+    # have been copied
+    conn = psycopg2.connect(DSN)
+    conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+    cursor = conn.cursor()
+
+    cursor.execute(export_snapshot_select)
+    snapshot = cursor.fetchone()[0]
+
+    cursor.execute(songplay_partitioned_select)
+    partitioned = bool(cursor.fetchone()[0])
+
+    partitions = []
+
+    if partitioned:
+        cursor.execute(snapshot_partition_select)
+        partitions = cursor.fetchall()
+
+    cursor.execute(compact_schema_select)
+    compact = cursor.fetchone()[0]
+
+    cursor.execute(songplay_sequence_select)
+    sequence = cursor.fetchone()
+
+    names = compact_table_names if compact else table_names
+
+    # the songplays are copied a partition at a time
+    copies = [table for table in names if not (partitioned and table == "songplays")]
+    copies.extend(name for name, bound in partitions)
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        entries = list(executor.map(lambda table: export_table(snapshot, table, directory), copies))
+
+    conn.close()
+
+    manifest = {"created": datetime.datetime.now().isoformat(),
+                "schema": schema_version(snapshot_queries(partitioned, compact)),
+                "partitioned": partitioned,
+                "compact": compact,
+                "partitions": partitions,
+                "sequence": sequence,
+                "tables": entries}
+
+    with open(os.path.join(directory, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    return entries
+
+
+def snapshot_queries(partitioned, compact):
+    """
+    Return the create queries of the schema a snapshot was taken with
+    """
+
+    if partitioned:
+        return create_table_queries_partitioned
+
+    if compact:
+        return create_table_queries_compact
+
+    return create_table_queries
+
+
+def import_table(entry, directory):
+    """
+    Copy a binary copy file from the directory into its table, on its own
+    connection
+    """
+
+    conn = psycopg2.connect(DSN)
+    cursor = conn.cursor()
+    start = time.perf_counter()
+
+    with open(os.path.join(directory, entry["file"]), "rb") as f:
+        cursor.copy_expert(binary_copy.format(entry["table"]), f)
+
+    conn.commit()
+    conn.close()
+
+    return dict(entry, seconds=time.perf_counter() - start)
+
+
+def restore_snapshot(directory, jobs=SNAPSHOT_JOBS):
+    """
+    Recreate the sparkify database from a snapshot in the directory. The
+    tables are created from the template database, and loaded jobs at a
+    time with their primary keys and indexes dropped, which are then built
+    once all the data is in
+    """
+
+    with open(os.path.join(directory, MANIFEST)) as f:
+        manifest = json.load(f)
+
+    compact = manifest.get("compact", False)
+    queries = snapshot_queries(manifest["partitioned"], compact)
+    names = compact_table_names if compact else table_names
+
+    if manifest["schema"] != schema_version(queries):
+        raise ValueError("snapshot in {} was taken with a different schema".format(directory))
+
+    clone_template(queries)
+
+    conn = psycopg2.connect(DSN)
+    cursor = conn.cursor()
+
+    for name, bound in manifest["partitions"]:
+        cursor.execute(snapshot_partition_create.format(name, bound))
+
+    defer_indexes(cursor, names)
+    conn.commit()
+
+    # largest first, so one big table doesn't start last
+    entries = sorted(manifest["tables"], key=lambda entry: entry["bytes"], reverse=True)
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        entries = list(executor.map(lambda entry: import_table(entry, directory), entries))
+
+    # the snapshot has no duplicate keys, so skip the checks
+    restore_indexes(cursor, names, deduplicate=False)
+    cursor.execute(songplay_sequence_set, manifest["sequence"])
+
+    if compact:
+        for table, key in compact_dimension_tables.items():
+            cursor.execute(serial_sequence_reset.format(table, key))
+
+    conn.commit()
+    conn.close()
+
+    return entries
+
+
+def main():
+    """
+    Export the loaded sparkify database to a snapshot directory, or restore
+    it from one
+    """
+
+    parser = argparse.ArgumentParser(description="Snapshot export and restore of sparkifydb")
+
+    parser.add_argument("command", choices=["export", "restore"])
+    parser.add_argument("directory", help="directory holding the snapshot")
+    parser.add_argument("--jobs", type=int, default=SNAPSHOT_JOBS,
+                        help="number of tables copied at once")
+
+    args = parser.parse_args()
+    start = time.perf_counter()
+
+    if args.command == "export":
+        entries = export_snapshot(args.directory, args.jobs)
+    else:
+        entries = restore_snapshot(args.directory, args.jobs)
+
+    for entry in entries:
+        print("{}: {} rows, {} bytes in {:.2f}s".format(
+            entry["table"], entry["rows"], entry["bytes"], entry["seconds"]))
+
+    print("{} {} tables in {:.2f}s".format(
+        "Exported" if args.command == "export" else "Restored", len(entries),
+        time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
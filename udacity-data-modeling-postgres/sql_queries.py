@@ -1,3 +1,5 @@
+from rollup_queries import rollup_create_queries, rollup_drop_queries, rollup_table_names
+
 # DROP TABLES
 
 songplay_table_drop = "DROP TABLE IF EXISTS songplays"
@@ -5,12 +7,25 @@ user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+manifest_table_drop = "DROP TABLE IF EXISTS etl_manifest"
+songplay_unresolved_drop = "DROP TABLE IF EXISTS songplays_unresolved"
+location_table_drop = "DROP TABLE IF EXISTS locations"
+user_agent_table_drop = "DROP TABLE IF EXISTS user_agents"
+user_level_type_drop = "DROP TYPE IF EXISTS user_level"
+user_gender_type_drop = "DROP TYPE IF EXISTS user_gender"
 
 # DROP STAGING TABLES
 
 songplay_staging_drop = "DROP TABLE IF EXISTS songplays_staging"
 time_staging_drop = "DROP TABLE IF EXISTS time_staging"
 user_staging_drop = "DROP TABLE IF EXISTS users_staging"
+song_staging_drop = "DROP TABLE IF EXISTS songs_staging"
+artist_staging_drop = "DROP TABLE IF EXISTS artists_staging"
+songplay_resolved_staging_drop = "DROP TABLE IF EXISTS songplays_resolved_staging"
+songplay_unmatched_staging_drop = "DROP TABLE IF EXISTS songplays_unmatched_staging"
+songplay_compact_staging_drop = "DROP TABLE IF EXISTS songplays_compact_staging"
+songplay_resolved_compact_staging_drop = "DROP TABLE IF EXISTS songplays_resolved_compact_staging"
+songplay_unmatched_compact_staging_drop = "DROP TABLE IF EXISTS songplays_unmatched_compact_staging"
 
 # CREATE TABLES
 
@@ -77,11 +92,166 @@ CREATE TABLE IF NOT EXISTS time (
 );
 """)
 
+# The song and artist of each songplay whose ids could not be resolved when
+# it was loaded, so it can be backfilled once the songs have been loaded
+songplay_unresolved_create = ("""
+CREATE TABLE IF NOT EXISTS songplays_unresolved (
+    songplay_id integer NOT NULL,
+    song text,
+    artist text,
+    duration float8,
+    PRIMARY KEY (songplay_id)
+);
+""")
+
+# The songplay joins look songs up by title and duration, and artists by
+# name
+song_title_index_create = "CREATE INDEX IF NOT EXISTS songs_title_duration_idx ON songs (title, duration)"
+artist_name_index_create = "CREATE INDEX IF NOT EXISTS artists_name_idx ON artists (name)"
+
+# COMPACT SCHEMA
+
+# Variant of the tables with narrower column types: smallint date parts,
+# enums for the user level and gender, and the songplay locations and user
+# agents moved into dimension tables referenced by integer keys, as each is
+# repeated across thousands of songplays
+user_level_type_create = "CREATE TYPE user_level AS ENUM ('free', 'paid')"
+user_gender_type_create = "CREATE TYPE user_gender AS ENUM ('F', 'M')"
+
+user_table_create_compact = ("""
+CREATE TABLE IF NOT EXISTS users (
+    user_id integer NOT NULL, 
+    first_name text, 
+    last_name text, 
+    gender user_gender, 
+    level user_level,
+    PRIMARY KEY (user_id)
+);
+""")
+
+time_table_create_compact = ("""
+CREATE TABLE IF NOT EXISTS time (
+    start_time bigint NOT NULL, 
+    hour smallint NOT NULL, 
+    day smallint NOT NULL, 
+    week smallint NOT NULL, 
+    month smallint NOT NULL, 
+    year smallint NOT NULL, 
+    weekday smallint NOT NULL,
+    PRIMARY KEY (start_time)
+);
+""")
+
+location_table_create = ("""
+CREATE TABLE IF NOT EXISTS locations (
+    location_id serial,
+    location text NOT NULL,
+    PRIMARY KEY (location_id),
+    UNIQUE (location)
+);
+""")
+
+user_agent_table_create = ("""
+CREATE TABLE IF NOT EXISTS user_agents (
+    user_agent_id serial,
+    user_agent text NOT NULL,
+    PRIMARY KEY (user_agent_id),
+    UNIQUE (user_agent)
+);
+""")
+
+songplay_table_create_compact = ("""
+CREATE TABLE IF NOT EXISTS songplays (
+    songplay_id serial,  
+    user_id integer NOT NULL, 
+    song_id text,
+    artist_id text, 
+    start_time bigint NOT NULL,    
+    session_id integer NOT NULL, 
+    level user_level NOT NULL, 
+    location_id integer NOT NULL, 
+    user_agent_id integer NOT NULL,
+    PRIMARY KEY (songplay_id)
+);
+""")
+
+compact_schema_select = "SELECT to_regclass('user_agents') IS NOT NULL"
+
+# PARTITIONED SONGPLAYS
+
+# Variant of the songplays table range partitioned by month on start_time,
+# so time bounded queries only scan the months they need and old months can
+# be detached. The primary key of a partitioned table must include the
+# partition key. The partitions are created by etl.py as it loads new months
+songplay_table_create_partitioned = ("""
+CREATE TABLE IF NOT EXISTS songplays (
+    songplay_id serial,  
+    user_id integer NOT NULL, 
+    song_id text,
+    artist_id text, 
+    start_time bigint NOT NULL,    
+    session_id integer NOT NULL, 
+    level text NOT NULL, 
+    location text NOT NULL, 
+    user_agent text NOT NULL,
+    PRIMARY KEY (songplay_id, start_time)
+) PARTITION BY RANGE (start_time);
+""")
+
+# The songplays arrive roughly in time order, so a BRIN index on start_time
+# is tiny and still narrows a scan to the matching blocks of each partition
+songplay_start_time_brin = ("""
+CREATE INDEX IF NOT EXISTS songplays_start_time_brin ON songplays USING brin (start_time);
+""")
+
+songplay_partitioned_select = ("""
+SELECT relkind = 'p'
+FROM pg_class
+WHERE oid = to_regclass('songplays')
+""")
+
+songplay_partition_select = ("""
+SELECT c.relname
+FROM pg_inherits i
+JOIN pg_class c ON c.oid = i.inhrelid
+WHERE i.inhparent = 'songplays'::regclass
+""")
+
+# The start of each month, in epoch milliseconds, with rows in the given
+# staging table
+songplay_partition_months_select = ("""
+SELECT DISTINCT (extract(epoch FROM date_trunc('month', to_timestamp(start_time / 1000.0) AT TIME ZONE 'UTC')) * 1000)::bigint
+FROM {}
+""")
+
+songplay_partition_create = ("""
+CREATE TABLE IF NOT EXISTS {} PARTITION OF songplays FOR VALUES FROM ({}) TO ({})
+""")
+
+# Held until commit while creating partitions, so concurrent writers don't
+# race to create the same partition
+songplay_partition_lock = "SELECT pg_advisory_xact_lock(hashtext('songplays_partitions'))"
+
+# Record of each file loaded by etl.py, so reruns only load new or
+# changed files
+manifest_table_create = ("""
+CREATE TABLE IF NOT EXISTS etl_manifest (
+    filepath text NOT NULL,
+    size bigint NOT NULL,
+    mtime float8 NOT NULL,
+    hash text NOT NULL,
+    processed_at timestamp NOT NULL DEFAULT now(),
+    PRIMARY KEY (filepath)
+);
+""")
+
 # STAGING TABLES
 
 songplay_staging = "songplays_staging"
 user_staging = "users_staging"
 time_staging = "time_staging"
+song_staging = "songs_staging"
+artist_staging = "artists_staging"
 
 songplay_staging_create = ("""
 CREATE TEMP TABLE IF NOT EXISTS songplays_staging (
@@ -119,19 +289,203 @@ CREATE TEMP TABLE IF NOT EXISTS time_staging (
 );
 """)
 
+song_staging_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS songs_staging (
+    song_id text NOT NULL,
+    artist_id text NOT NULL, 
+    title text NOT NULL,  
+    year integer, 
+    duration float8
+);
+""")
+
+artist_staging_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS artists_staging (
+    artist_id text NOT NULL, 
+    name text NOT NULL, 
+    location text, 
+    latitude float8, 
+    longitude float8
+);
+""")
+
+# Staging for the songplays with client resolved ids, which are copied
+# through a staging table when songplays is partitioned, so the partitions
+# for the staged months can be created before the insert
+songplay_resolved_staging = "songplays_resolved_staging"
+
+songplay_resolved_staging_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS songplays_resolved_staging (
+    user_id integer NOT NULL, 
+    song_id text,
+    artist_id text, 
+    start_time bigint NOT NULL,    
+    session_id integer NOT NULL, 
+    level text, 
+    location text, 
+    user_agent text
+);
+""")
+
+# Staging for the songplays the song lookup left without a song or artist
+# id, along with the song, artist and duration they are recorded under in
+# songplays_unresolved
+songplay_unmatched_staging = "songplays_unmatched_staging"
+
+songplay_unmatched_staging_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS songplays_unmatched_staging (
+    user_id integer NOT NULL, 
+    song_id text,
+    artist_id text, 
+    start_time bigint NOT NULL,    
+    session_id integer NOT NULL, 
+    level text, 
+    location text, 
+    user_agent text,
+    song text,
+    artist text,
+    duration float8
+);
+""")
+
+# Staging for the songplays of the compact schema, with the location and
+# user agent already resolved to their ids on the client
+songplay_compact_staging = "songplays_compact_staging"
+songplay_resolved_compact_staging = "songplays_resolved_compact_staging"
+songplay_unmatched_compact_staging = "songplays_unmatched_compact_staging"
+
+songplay_compact_staging_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS songplays_compact_staging (
+    user_id integer NOT NULL, 
+    start_time bigint NOT NULL,    
+    session_id integer NOT NULL, 
+    level text, 
+    location_id integer, 
+    user_agent_id integer,
+    song text,
+    artist text,
+    duration float8
+);
+""")
+
+songplay_resolved_compact_staging_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS songplays_resolved_compact_staging (
+    user_id integer NOT NULL, 
+    song_id text,
+    artist_id text, 
+    start_time bigint NOT NULL,    
+    session_id integer NOT NULL, 
+    level text, 
+    location_id integer, 
+    user_agent_id integer
+);
+""")
+
+songplay_unmatched_compact_staging_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS songplays_unmatched_compact_staging (
+    user_id integer NOT NULL, 
+    song_id text,
+    artist_id text, 
+    start_time bigint NOT NULL,    
+    session_id integer NOT NULL, 
+    level text, 
+    location_id integer, 
+    user_agent_id integer,
+    song text,
+    artist text,
+    duration float8
+);
+""")
+
+# UNLOGGED STAGING TABLES
+
+# Persistent versions of the staging tables, created once and truncated
+# between batches rather than created and dropped for every file
+songplay_staging_create_unlogged = songplay_staging_create.replace("TEMP", "UNLOGGED")
+user_staging_create_unlogged = user_staging_create.replace("TEMP", "UNLOGGED")
+time_staging_create_unlogged = time_staging_create.replace("TEMP", "UNLOGGED")
+song_staging_create_unlogged = song_staging_create.replace("TEMP", "UNLOGGED")
+artist_staging_create_unlogged = artist_staging_create.replace("TEMP", "UNLOGGED")
+songplay_resolved_staging_create_unlogged = songplay_resolved_staging_create.replace("TEMP", "UNLOGGED")
+songplay_unmatched_staging_create_unlogged = songplay_unmatched_staging_create.replace("TEMP", "UNLOGGED")
+songplay_compact_staging_create_unlogged = songplay_compact_staging_create.replace("TEMP", "UNLOGGED")
+songplay_resolved_compact_staging_create_unlogged = songplay_resolved_compact_staging_create.replace(
+    "TEMP", "UNLOGGED")
+songplay_unmatched_compact_staging_create_unlogged = songplay_unmatched_compact_staging_create.replace(
+    "TEMP", "UNLOGGED")
+
+staging_truncate = "TRUNCATE {}"
+
+# DATABASE RESET
+
+database_drop = "DROP DATABASE IF EXISTS {}"
+database_create = "CREATE DATABASE {} WITH ENCODING 'utf8' TEMPLATE {}"
+
+# the template database is tagged with a hash of the schema it was built
+# with, so a changed schema rebuilds it
+database_comment = "COMMENT ON DATABASE {} IS %s"
+database_comment_select = ("""
+SELECT shobj_description(oid, 'pg_database')
+FROM pg_database
+WHERE datname = %s
+""")
+
+# reset the tables in place, restarting the songplay_id sequence
+table_truncate = "TRUNCATE {} RESTART IDENTITY"
+table_count_select = ("""
+SELECT count(*)
+FROM pg_tables
+WHERE schemaname = 'public' AND tablename = ANY(%s)
+""")
+
+# STAGING COPY
+
+songplay_staging_copy = "COPY songplays_staging FROM STDIN"
+user_staging_copy = "COPY users_staging FROM STDIN WITH DELIMITER ','"
+time_staging_copy = "COPY time_staging FROM STDIN WITH DELIMITER ','"
+songplay_resolved_staging_copy = "COPY songplays_resolved_staging FROM STDIN"
+songplay_unmatched_staging_copy = "COPY songplays_unmatched_staging FROM STDIN"
+songplay_compact_staging_copy = "COPY songplays_compact_staging FROM STDIN"
+songplay_resolved_compact_staging_copy = "COPY songplays_resolved_compact_staging FROM STDIN"
+songplay_unmatched_compact_staging_copy = "COPY songplays_unmatched_compact_staging FROM STDIN"
+
+# Song and artist names regularly contain commas, so these are copied
+# in csv format, which respects the quoting written by pandas
+song_staging_copy = "COPY songs_staging FROM STDIN WITH CSV"
+artist_staging_copy = "COPY artists_staging FROM STDIN WITH CSV"
+
+# DIRECT COPY
+
+# Used when the song and artist ids are resolved on the client, so the
+# songplays can skip the staging table and join
+songplay_direct_copy = ("""
+COPY songplays (
+    user_id, 
+    song_id, 
+    artist_id, 
+    start_time, 
+    session_id, 
+    level, 
+    location, 
+    user_agent) FROM STDIN
+""")
+
+# BINARY COPY
+
+# Binary format versions of the copy queries. The binary data is typed, so
+# it needs no escaping and no parsing on the server
+binary_copy = "COPY {} FROM STDIN WITH (FORMAT binary)"
+
+songplay_direct_copy_binary = songplay_direct_copy.replace("FROM STDIN", "FROM STDIN WITH (FORMAT binary)")
+
 # STAGING INSERTS
 
+# The songplay ids are taken up front, so the song and artist of the rows
+# left unresolved can be recorded against them for the backfill
 songplay_insert_from_staging = ("""
-INSERT INTO songplays (
-        user_id, 
-        song_id, 
-        artist_id, 
-        start_time, 
-        session_id, 
-        level, 
-        location, 
-        user_agent)
+WITH resolved AS (
     SELECT 
+        nextval('songplays_songplay_id_seq') AS songplay_id, 
         sp.user_id, 
         s.song_id, 
         a.artist_id, 
@@ -139,12 +493,94 @@ INSERT INTO songplays (
         sp.session_id, 
         sp.level, 
         sp.location, 
-        sp.user_agent
+        sp.user_agent, 
+        sp.song, 
+        sp.artist, 
+        sp.duration
     FROM songplays_staging sp
     LEFT JOIN artists a ON a.name = sp.artist
-    LEFT JOIN songs s ON s.title = sp.song AND s.duration = sp.duration;
+    LEFT JOIN songs s ON s.title = sp.song AND s.duration = sp.duration
+), unresolved AS (
+    INSERT INTO songplays_unresolved (songplay_id, song, artist, duration)
+        SELECT songplay_id, song, artist, duration
+        FROM resolved
+        WHERE song_id IS NULL OR artist_id IS NULL
+)
+INSERT INTO songplays (
+        songplay_id, 
+        user_id, 
+        song_id, 
+        artist_id, 
+        start_time, 
+        session_id, 
+        level, 
+        location, 
+        user_agent)
+    SELECT 
+        songplay_id, 
+        user_id, 
+        song_id, 
+        artist_id, 
+        start_time, 
+        session_id, 
+        level, 
+        location, 
+        user_agent
+    FROM resolved;
+""")
+
+songplay_resolved_insert_from_staging = ("""
+INSERT INTO songplays (
+        user_id, 
+        song_id, 
+        artist_id, 
+        start_time, 
+        session_id, 
+        level, 
+        location, 
+        user_agent)
+    SELECT * FROM songplays_resolved_staging;
 """)
 
+# The songplays left unmatched by the song lookup take their ids up front,
+# like those moved by songplay_insert_from_staging, so their song, artist and
+# duration can be recorded for the backfill
+songplay_unmatched_insert_from_staging = ("""
+WITH unmatched AS (
+    SELECT 
+        nextval('songplays_songplay_id_seq') AS songplay_id, 
+        sp.*
+    FROM songplays_unmatched_staging sp
+), unresolved AS (
+    INSERT INTO songplays_unresolved (songplay_id, song, artist, duration)
+        SELECT songplay_id, song, artist, duration
+        FROM unmatched
+)
+INSERT INTO songplays (
+        songplay_id, 
+        user_id, 
+        song_id, 
+        artist_id, 
+        start_time, 
+        session_id, 
+        level, 
+        location, 
+        user_agent)
+    SELECT 
+        songplay_id, 
+        user_id, 
+        song_id, 
+        artist_id, 
+        start_time, 
+        session_id, 
+        level, 
+        location, 
+        user_agent
+    FROM unmatched;
+""")
+
+# The dimension moves are sorted by key, so concurrent writers inserting
+# overlapping keys take them in the same order rather than deadlocking
 user_insert_from_staging = ("""
 INSERT INTO users (
         user_id, 
@@ -159,6 +595,7 @@ INSERT INTO users (
         gender, 
         level
     FROM users_staging
+    ORDER BY user_id
     ON CONFLICT DO NOTHING;
 """)
 
@@ -172,31 +609,187 @@ INSERT INTO time (
         year, 
         weekday)
     SELECT * FROM time_staging
+    ORDER BY start_time
     ON CONFLICT DO NOTHING;
 """)
 
-# INSERT RECORDS
-
-song_table_insert = ("""
+song_insert_from_staging = ("""
 INSERT INTO songs (
-    song_id, 
-    artist_id, 
-    title, 
-    year, 
-    duration) VALUES (%s, %s, %s, %s, %s)
+        song_id, 
+        artist_id, 
+        title, 
+        year, 
+        duration)
+    SELECT * FROM songs_staging
+    ORDER BY song_id
     ON CONFLICT DO NOTHING;
 """)
 
-artist_table_insert = ("""
+artist_insert_from_staging = ("""
 INSERT INTO artists (
-    artist_id, 
-    name, 
-    location, 
-    latitude, 
-    longitude) VALUES (%s, %s, %s, %s, %s)
+        artist_id, 
+        name, 
+        location, 
+        latitude, 
+        longitude)
+    SELECT * FROM artists_staging
+    ORDER BY artist_id
     ON CONFLICT DO NOTHING;
 """)
 
+# COMPACT STAGING INSERTS
+
+# The staging tables are the same for the compact schema, only the moves
+# into the users and songplays tables differ. Empty strings, as written by
+# pandas for missing values, are loaded as NULL rather than cast to an enum
+user_insert_from_staging_compact = ("""
+INSERT INTO users (
+        user_id, 
+        first_name, 
+        last_name, 
+        gender, 
+        level)
+    SELECT 
+        user_id, 
+        first_name, 
+        last_name, 
+        NULLIF(gender, '')::user_gender, 
+        NULLIF(level, '')::user_level
+    FROM users_staging
+    ORDER BY user_id
+    ON CONFLICT DO NOTHING;
+""")
+
+# The songplays arrive with their location and user agent ids resolved on
+# the client, see DimensionLookup in lookup.py, so only the song and artist
+# are joined
+songplay_insert_from_staging_compact = ("""
+WITH resolved AS (
+    SELECT 
+        nextval('songplays_songplay_id_seq') AS songplay_id, 
+        sp.user_id, 
+        s.song_id, 
+        a.artist_id, 
+        sp.start_time, 
+        sp.session_id, 
+        sp.level, 
+        sp.location_id, 
+        sp.user_agent_id, 
+        sp.song, 
+        sp.artist, 
+        sp.duration
+    FROM songplays_compact_staging sp
+    LEFT JOIN artists a ON a.name = sp.artist
+    LEFT JOIN songs s ON s.title = sp.song AND s.duration = sp.duration
+), unresolved AS (
+    INSERT INTO songplays_unresolved (songplay_id, song, artist, duration)
+        SELECT songplay_id, song, artist, duration
+        FROM resolved
+        WHERE song_id IS NULL OR artist_id IS NULL
+)
+INSERT INTO songplays (
+        songplay_id, 
+        user_id, 
+        song_id, 
+        artist_id, 
+        start_time, 
+        session_id, 
+        level, 
+        location_id, 
+        user_agent_id)
+    SELECT 
+        songplay_id, 
+        user_id, 
+        song_id, 
+        artist_id, 
+        start_time, 
+        session_id, 
+        NULLIF(level, '')::user_level, 
+        location_id, 
+        user_agent_id
+    FROM resolved;
+""")
+
+songplay_resolved_insert_from_staging_compact = ("""
+INSERT INTO songplays (
+        user_id, 
+        song_id, 
+        artist_id, 
+        start_time, 
+        session_id, 
+        level, 
+        location_id, 
+        user_agent_id)
+    SELECT 
+        user_id, 
+        song_id, 
+        artist_id, 
+        start_time, 
+        session_id, 
+        NULLIF(level, '')::user_level, 
+        location_id, 
+        user_agent_id
+    FROM songplays_resolved_compact_staging;
+""")
+
+songplay_unmatched_insert_from_staging_compact = ("""
+WITH unmatched AS (
+    SELECT 
+        nextval('songplays_songplay_id_seq') AS songplay_id, 
+        sp.*
+    FROM songplays_unmatched_compact_staging sp
+), unresolved AS (
+    INSERT INTO songplays_unresolved (songplay_id, song, artist, duration)
+        SELECT songplay_id, song, artist, duration
+        FROM unmatched
+)
+INSERT INTO songplays (
+        songplay_id, 
+        user_id, 
+        song_id, 
+        artist_id, 
+        start_time, 
+        session_id, 
+        level, 
+        location_id, 
+        user_agent_id)
+    SELECT 
+        songplay_id, 
+        user_id, 
+        song_id, 
+        artist_id, 
+        start_time, 
+        session_id, 
+        NULLIF(level, '')::user_level, 
+        location_id, 
+        user_agent_id
+    FROM unmatched;
+""")
+
+# INSERT RECORDS
+
+# Unused
+# song_table_insert = ("""
+# INSERT INTO songs (
+#    song_id, 
+#    artist_id, 
+#    title, 
+#    year, 
+#    duration) VALUES (%s, %s, %s, %s, %s)
+#    ON CONFLICT DO NOTHING;
+# """)
+
+# Unused
+# artist_table_insert = ("""
+# INSERT INTO artists (
+#    artist_id, 
+#    name, 
+#    location, 
+#    latitude, 
+#    longitude) VALUES (%s, %s, %s, %s, %s)
+#    ON CONFLICT DO NOTHING;
+# """)
+
 # Unused
 # songplay_table_insert = ("""
 # INSERT INTO users (
@@ -235,6 +828,229 @@ INSERT INTO artists (
 #    ON CONFLICT DO NOTHING;
 # """)
 
+# MANIFEST
+
+manifest_select = "SELECT filepath, size, mtime, hash FROM etl_manifest"
+
+manifest_upsert = ("""
+INSERT INTO etl_manifest (
+    filepath, 
+    size, 
+    mtime, 
+    hash) VALUES (%s, %s, %s, %s)
+    ON CONFLICT (filepath) DO UPDATE SET 
+        size = EXCLUDED.size, 
+        mtime = EXCLUDED.mtime, 
+        hash = EXCLUDED.hash, 
+        processed_at = now();
+""")
+
+# BULK LOAD
+
+# The primary keys and indexes dropped for a bulk load are saved here until
+# they are rebuilt, so an interrupted bulk load can still be finished
+bulk_index_table_create = ("""
+CREATE TABLE IF NOT EXISTS etl_bulk_indexes (
+    tablename text NOT NULL,
+    name text NOT NULL,
+    definition text NOT NULL,
+    key_columns text,
+    PRIMARY KEY (tablename, name)
+);
+""")
+
+bulk_index_table_drop = "DROP TABLE IF EXISTS etl_bulk_indexes"
+
+# Primary keys of the given tables, with their definition and key columns
+bulk_primary_key_select = ("""
+SELECT t.relname, c.conname, pg_get_constraintdef(c.oid),
+    (SELECT string_agg(quote_ident(a.attname), ', ' ORDER BY k.n)
+     FROM unnest(c.conkey) WITH ORDINALITY k(attnum, n)
+     JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = k.attnum)
+FROM pg_constraint c
+JOIN pg_class t ON t.oid = c.conrelid
+WHERE c.conrelid = ANY(%s::regclass[]) AND c.contype = 'p'
+""")
+
+# Other indexes of the given tables
+bulk_index_select = ("""
+SELECT t.relname, x.relname, pg_get_indexdef(i.indexrelid), NULL
+FROM pg_index i
+JOIN pg_class t ON t.oid = i.indrelid
+JOIN pg_class x ON x.oid = i.indexrelid
+WHERE i.indrelid = ANY(%s::regclass[])
+    AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid)
+""")
+
+bulk_index_insert = "INSERT INTO etl_bulk_indexes VALUES (%s, %s, %s, %s) ON CONFLICT DO NOTHING"
+bulk_index_saved_select = ("""
+SELECT tablename, name, definition, key_columns
+FROM etl_bulk_indexes
+WHERE tablename = ANY(%s)
+ORDER BY key_columns IS NULL, tablename
+""")
+bulk_index_delete = "DELETE FROM etl_bulk_indexes WHERE tablename = %s AND name = %s"
+
+primary_key_drop = "ALTER TABLE {} DROP CONSTRAINT IF EXISTS {}"
+primary_key_add = "ALTER TABLE {} ADD CONSTRAINT {} {}"
+index_drop = "DROP INDEX IF EXISTS {}"
+
+# Remove all but the first loaded row of each key, as ON CONFLICT DO NOTHING
+# would have. The tableoid keeps the row ids of each partition apart
+bulk_deduplicate = ("""
+DELETE FROM {0}
+WHERE (tableoid, ctid) IN (
+    SELECT tableoid, ctid
+    FROM (SELECT tableoid, ctid, row_number() OVER (PARTITION BY {1} ORDER BY tableoid, ctid) AS n
+          FROM {0}) d
+    WHERE d.n > 1)
+""")
+
+table_analyze = "ANALYZE {}"
+
+# SNAPSHOT
+
+snapshot_export = "COPY (SELECT * FROM {}) TO STDOUT WITH (FORMAT binary)"
+
+# The partitions of a partitioned songplays table, with their bounds
+snapshot_partition_select = ("""
+SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+FROM pg_inherits i
+JOIN pg_class c ON c.oid = i.inhrelid
+WHERE i.inhparent = 'songplays'::regclass
+ORDER BY c.relname
+""")
+
+snapshot_partition_create = "CREATE TABLE IF NOT EXISTS {} PARTITION OF songplays {}"
+
+songplay_sequence_select = "SELECT last_value, is_called FROM songplays_songplay_id_seq"
+songplay_sequence_set = "SELECT setval('songplays_songplay_id_seq', %s, %s)"
+
+# Move the sequence of a serial key past the restored rows, takes the table
+# and key column
+serial_sequence_reset = "SELECT setval(pg_get_serial_sequence('{0}', '{1}'), coalesce(max({1}), 0) + 1, false) FROM {0}"
+
+export_snapshot_select = "SELECT pg_export_snapshot()"
+set_snapshot = "SET TRANSACTION SNAPSHOT %s"
+
+# EXPORT
+
+export_table_select = "SELECT * FROM {}"
+export_table_where_select = "SELECT * FROM {} WHERE {}"
+export_columns_select = "SELECT * FROM ({}) AS export LIMIT 0"
+export_copy = "COPY ({}) TO STDOUT WITH (FORMAT csv)"
+
+# BACKFILL
+
+# The upper songplay_id of the next chunk of unresolved songplays, takes the
+# last songplay_id of the previous chunk and the chunk size
+unresolved_chunk_select = ("""
+SELECT max(songplay_id)
+FROM (SELECT songplay_id
+      FROM songplays_unresolved
+      WHERE songplay_id > %s
+      ORDER BY songplay_id
+      LIMIT %s) chunk
+""")
+
+unresolved_count_select = "SELECT count(*) FROM songplays_unresolved"
+
+# Fill in the song and artist ids of the unresolved songplays in a range of
+# songplay_id that now match a song or artist, returning the start of the
+# day of each updated songplay for the rollups. Takes the range start,
+# exclusive, and end
+songplay_backfill_update = ("""
+UPDATE songplays sp
+SET song_id = coalesce(sp.song_id, r.song_id),
+    artist_id = coalesce(sp.artist_id, r.artist_id)
+FROM (
+    SELECT u.songplay_id, s.song_id, a.artist_id
+    FROM songplays_unresolved u
+    LEFT JOIN artists a ON a.name = u.artist
+    LEFT JOIN songs s ON s.title = u.song AND s.duration = u.duration
+    WHERE u.songplay_id > %s AND u.songplay_id <= %s
+) r
+WHERE sp.songplay_id = r.songplay_id
+    AND ((sp.song_id IS NULL AND r.song_id IS NOT NULL)
+         OR (sp.artist_id IS NULL AND r.artist_id IS NOT NULL))
+RETURNING sp.start_time - mod(sp.start_time, 86400000)
+""")
+
+# Forget the songplays in the range that are now fully resolved, or that
+# are no longer loaded
+unresolved_delete = ("""
+DELETE FROM songplays_unresolved u
+WHERE u.songplay_id > %s AND u.songplay_id <= %s
+    AND NOT EXISTS (
+        SELECT 1
+        FROM songplays sp
+        WHERE sp.songplay_id = u.songplay_id
+            AND (sp.song_id IS NULL OR sp.artist_id IS NULL))
+""")
+
+# LOOKUP
+
+artist_lookup_select = "SELECT name, artist_id FROM artists"
+song_lookup_select = "SELECT title, duration, song_id FROM songs"
+
+artist_lookup_select_names = ("""
+SELECT name, artist_id 
+    FROM artists 
+    WHERE name = ANY(%s);
+""")
+
+song_lookup_select_keys = ("""
+SELECT s.title, s.duration, s.song_id 
+    FROM songs s
+    JOIN unnest(%s::text[], %s::float8[]) AS k (title, duration)
+        ON s.title = k.title AND s.duration = k.duration;
+""")
+
+# Used by the dimension lookup to resolve the songplay locations and user
+# agents of the compact schema to their ids. Missing values are added in
+# sorted order, so concurrent writers take the keys in the same order, then
+# all of them are read back, including any added by another writer
+location_lookup_select = "SELECT location, location_id FROM locations"
+user_agent_lookup_select = "SELECT user_agent, user_agent_id FROM user_agents"
+
+location_lookup_insert = ("""
+INSERT INTO locations (location)
+    SELECT location FROM unnest(%s::text[]) AS k (location)
+    ORDER BY location
+    ON CONFLICT DO NOTHING;
+""")
+
+user_agent_lookup_insert = ("""
+INSERT INTO user_agents (user_agent)
+    SELECT user_agent FROM unnest(%s::text[]) AS k (user_agent)
+    ORDER BY user_agent
+    ON CONFLICT DO NOTHING;
+""")
+
+location_lookup_select_values = ("""
+SELECT location, location_id 
+    FROM locations 
+    WHERE location = ANY(%s);
+""")
+
+user_agent_lookup_select_values = ("""
+SELECT user_agent, user_agent_id 
+    FROM user_agents 
+    WHERE user_agent = ANY(%s);
+""")
+
+# KEY CACHE
+
+# The most recent keys of the time and users tables, used to warm the
+# key caches. Takes the row limit as a parameter
+time_key_select = ("""
+SELECT start_time FROM (
+    SELECT start_time FROM time ORDER BY start_time DESC LIMIT %s
+) recent ORDER BY start_time;
+""")
+
+user_key_select = "SELECT user_id FROM users LIMIT %s;"
+
 # FIND SONGS
 
 # Unused
@@ -247,5 +1063,198 @@ INSERT INTO artists (
 
 # QUERY LISTS
 
-create_table_queries = [user_table_create, artist_table_create, song_table_create, time_table_create, songplay_table_create]
-drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
\ No newline at end of file
+create_table_queries = [user_table_create, artist_table_create, artist_name_index_create, song_table_create, song_title_index_create, time_table_create, songplay_table_create, songplay_unresolved_create, manifest_table_create] + rollup_create_queries
+drop_table_queries = [songplay_table_drop, songplay_unresolved_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, location_table_drop, user_agent_table_drop, manifest_table_drop, bulk_index_table_drop] + rollup_drop_queries + [user_level_type_drop, user_gender_type_drop]
+create_table_queries_compact = [user_level_type_create, user_gender_type_create, user_table_create_compact, artist_table_create, artist_name_index_create, song_table_create, song_title_index_create, time_table_create_compact, location_table_create, user_agent_table_create, songplay_table_create_compact, songplay_unresolved_create, manifest_table_create] + rollup_create_queries
+create_table_queries_partitioned = [user_table_create, artist_table_create, artist_name_index_create, song_table_create, song_title_index_create, time_table_create, songplay_table_create_partitioned, songplay_start_time_brin, songplay_unresolved_create, manifest_table_create] + rollup_create_queries
+table_names = ["songplays", "songplays_unresolved", "users", "songs", "artists", "time", "etl_manifest"] + rollup_table_names
+
+# The dimension tables of the compact schema, with their serial keys
+compact_dimension_tables = {"locations": "location_id", "user_agents": "user_agent_id"}
+compact_table_names = table_names + list(compact_dimension_tables)
+
+# The tables loaded by each phase of etl.py, whose keys and indexes a bulk
+# load defers
+bulk_song_tables = ["songs", "artists"]
+bulk_log_tables = ["time", "users", "songplays"]
+
+# Staging queries for each table loaded via copy, in the form:
+# table -> (create staging, copy to staging, insert from staging, drop staging)
+staging_table_queries = {
+    "artists": (artist_staging_create, artist_staging_copy, artist_insert_from_staging, artist_staging_drop),
+    "songs": (song_staging_create, song_staging_copy, song_insert_from_staging, song_staging_drop),
+    "time": (time_staging_create, time_staging_copy, time_insert_from_staging, time_staging_drop),
+    "users": (user_staging_create, user_staging_copy, user_insert_from_staging, user_staging_drop),
+    "songplays": (songplay_staging_create, songplay_staging_copy, songplay_insert_from_staging, songplay_staging_drop),
+    "songplays_unmatched": (songplay_unmatched_staging_create, songplay_unmatched_staging_copy,
+                            songplay_unmatched_insert_from_staging, songplay_unmatched_staging_drop)
+}
+
+# Tables loaded by copying straight into the final table:
+# payload table -> copy query
+direct_copy_queries = {
+    "songplays_resolved": songplay_direct_copy
+}
+
+# Binary copy queries and the column types the binary encoder writes, for
+# each payload table. The types must match the staging or final table
+binary_copy_queries = {
+    "artists": binary_copy.format(artist_staging),
+    "songs": binary_copy.format(song_staging),
+    "time": binary_copy.format(time_staging),
+    "users": binary_copy.format(user_staging),
+    "songplays": binary_copy.format(songplay_staging),
+    "songplays_resolved": songplay_direct_copy_binary,
+    "songplays_unmatched": binary_copy.format(songplay_unmatched_staging),
+    "songplays_compact": binary_copy.format(songplay_compact_staging),
+    "songplays_resolved_compact": binary_copy.format(songplay_resolved_compact_staging),
+    "songplays_unmatched_compact": binary_copy.format(songplay_unmatched_compact_staging)
+}
+
+binary_copy_types = {
+    "artists": ("text", "text", "text", "float8", "float8"),
+    "songs": ("text", "text", "text", "int4", "float8"),
+    "time": ("int8", "int4", "int4", "int4", "int4", "int4", "int4"),
+    "users": ("int4", "text", "text", "text", "text"),
+    "songplays": ("int4", "int8", "int4", "text", "text", "text", "text", "text", "float8"),
+    "songplays_resolved": ("int4", "text", "text", "int8", "int4", "text", "text", "text"),
+    "songplays_unmatched": ("int4", "text", "text", "int8", "int4", "text", "text", "text", "text", "text",
+                            "float8"),
+    "songplays_compact": ("int4", "int8", "int4", "text", "int4", "int4", "text", "text", "float8"),
+    "songplays_resolved_compact": ("int4", "text", "text", "int8", "int4", "text", "int4", "int4"),
+    "songplays_unmatched_compact": ("int4", "text", "text", "int8", "int4", "text", "int4", "int4", "text",
+                                    "text", "float8")
+}
+
+# Multi row inserts used in place of the staging table for small batches,
+# skipping the staging create, copy and drop. The VALUES list stands in for
+# the staging table, with the column types cast by the template
+values_insert_queries = {
+    "artists": artist_insert_from_staging.replace(
+        "FROM artists_staging", "FROM (VALUES %s) AS v(artist_id, name, location, latitude, longitude)"),
+    "songs": song_insert_from_staging.replace(
+        "FROM songs_staging", "FROM (VALUES %s) AS v(song_id, artist_id, title, year, duration)"),
+    "time": time_insert_from_staging.replace(
+        "FROM time_staging", "FROM (VALUES %s) AS v(start_time, hour, day, week, month, year, weekday)"),
+    "users": user_insert_from_staging.replace(
+        "FROM users_staging", "FROM (VALUES %s) AS v(user_id, first_name, last_name, gender, level)"),
+    "songplays": songplay_insert_from_staging.replace(
+        "FROM songplays_staging sp",
+        "FROM (VALUES %s) AS sp(user_id, start_time, session_id, level, location, user_agent, "
+        "song, artist, duration)"),
+    "songplays_resolved": songplay_resolved_insert_from_staging.replace(
+        "FROM songplays_resolved_staging", "FROM (VALUES %s) AS v"),
+    "songplays_unmatched": songplay_unmatched_insert_from_staging.replace(
+        "FROM songplays_unmatched_staging sp",
+        "FROM (VALUES %s) AS sp(user_id, song_id, artist_id, start_time, session_id, level, location, "
+        "user_agent, song, artist, duration)"),
+    "songplays_compact": songplay_insert_from_staging_compact.replace(
+        "FROM songplays_compact_staging sp",
+        "FROM (VALUES %s) AS sp(user_id, start_time, session_id, level, location_id, user_agent_id, "
+        "song, artist, duration)"),
+    "songplays_resolved_compact": songplay_resolved_insert_from_staging_compact.replace(
+        "FROM songplays_resolved_compact_staging",
+        "FROM (VALUES %s) AS v(user_id, song_id, artist_id, start_time, session_id, level, "
+        "location_id, user_agent_id)"),
+    "songplays_unmatched_compact": songplay_unmatched_insert_from_staging_compact.replace(
+        "FROM songplays_unmatched_compact_staging sp",
+        "FROM (VALUES %s) AS sp(user_id, song_id, artist_id, start_time, session_id, level, "
+        "location_id, user_agent_id, song, artist, duration)")
+}
+
+value_casts = {"int4": "integer", "int8": "bigint", "float8": "float8", "text": "text"}
+
+values_templates = {
+    table: "(" + ", ".join("%s::" + value_casts[name] for name in types) + ")"
+    for table, types in binary_copy_types.items()
+}
+
+# Staging table names and their unlogged create queries, as used for
+# persistent staging
+staging_table_names = {
+    "artists": artist_staging,
+    "songs": song_staging,
+    "time": time_staging,
+    "users": user_staging,
+    "songplays": songplay_staging,
+    "songplays_unmatched": songplay_unmatched_staging
+}
+
+unlogged_staging_create = {
+    "artists": artist_staging_create_unlogged,
+    "songs": song_staging_create_unlogged,
+    "time": time_staging_create_unlogged,
+    "users": user_staging_create_unlogged,
+    "songplays": songplay_staging_create_unlogged,
+    "songplays_unmatched": songplay_unmatched_staging_create_unlogged
+}
+
+# Staging used in place of the direct copy when songplays is partitioned,
+# and the staging tables whose rows go into
+# songplays, by payload table
+partitioned_staging_queries = {
+    "songplays_resolved": (songplay_resolved_staging_create, songplay_resolved_staging_copy,
+                           songplay_resolved_insert_from_staging, songplay_resolved_staging_drop)
+}
+
+partitioned_binary_copy_queries = {
+    "songplays_resolved": binary_copy.format(songplay_resolved_staging)
+}
+
+partitioned_staging_table_names = {
+    "songplays_resolved": songplay_resolved_staging
+}
+
+partitioned_unlogged_staging_create = {
+    "songplays_resolved": songplay_resolved_staging_create_unlogged
+}
+
+songplay_staging_tables = {
+    "songplays": songplay_staging,
+    "songplays_resolved": songplay_resolved_staging,
+    "songplays_unmatched": songplay_unmatched_staging
+}
+
+# Staging for the songplays payloads of the compact schema, whose location
+# and user agent are resolved to ids on the client, by payload table
+compact_staging_queries = {
+    "songplays_compact": (songplay_compact_staging_create, songplay_compact_staging_copy,
+                          songplay_insert_from_staging_compact, songplay_compact_staging_drop),
+    "songplays_resolved_compact": (songplay_resolved_compact_staging_create,
+                                   songplay_resolved_compact_staging_copy,
+                                   songplay_resolved_insert_from_staging_compact,
+                                   songplay_resolved_compact_staging_drop),
+    "songplays_unmatched_compact": (songplay_unmatched_compact_staging_create,
+                                    songplay_unmatched_compact_staging_copy,
+                                    songplay_unmatched_insert_from_staging_compact,
+                                    songplay_unmatched_compact_staging_drop)
+}
+
+compact_staging_table_names = {
+    "songplays_compact": songplay_compact_staging,
+    "songplays_resolved_compact": songplay_resolved_compact_staging,
+    "songplays_unmatched_compact": songplay_unmatched_compact_staging
+}
+
+compact_unlogged_staging_create = {
+    "songplays_compact": songplay_compact_staging_create_unlogged,
+    "songplays_resolved_compact": songplay_resolved_compact_staging_create_unlogged,
+    "songplays_unmatched_compact": songplay_unmatched_compact_staging_create_unlogged
+}
+
+# Moves out of staging that differ for the compact schema, by payload table
+compact_insert_queries = {
+    "users": user_insert_from_staging_compact
+}
+
+compact_values_insert_queries = {
+    "users": user_insert_from_staging_compact.replace(
+        "FROM users_staging", "FROM (VALUES %s) AS v(user_id, first_name, last_name, gender, level)")
+}
+
+# The lookup queries of each compact dimension table, (select all, insert
+# missing values, select values)
+dimension_lookup_queries = {
+    "locations": (location_lookup_select, location_lookup_insert, location_lookup_select_values),
+    "user_agents": (user_agent_lookup_select, user_agent_lookup_insert, user_agent_lookup_select_values)
+}
@@ -0,0 +1,265 @@
+import io
+import json
+import datetime
+
+# events are resolved against the song and dimension lookups in chunks of
+# this many rows
+LOOKUP_CHUNK_SIZE = 1000
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class IteratorFile(io.TextIOBase):
+    """
+    Read only file like object over an iterator of strings, so a generator
+    of copy rows can be passed to copy_from or copy_expert. Rows are only
+    pulled from the iterator as the copy reads, so memory use stays flat
+    whatever the size of the data. Counts the rows read in lines, and their
+    characters in chars
+    """
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = ""
+        self.lines = 0
+        self.chars = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        """
+        Read up to size characters, or everything if size is negative
+        """
+
+        chunks = [self.buffer]
+        length = len(self.buffer)
+
+        while size < 0 or length < size:
+            row = next(self.rows, None)
+
+            if row is None:
+                break
+
+            chunks.append(row)
+            length += len(row)
+            self.lines += 1
+            self.chars += len(row)
+
+        data = "".join(chunks)
+
+        if size < 0:
+            self.buffer = ""
+            return data
+
+        self.buffer = data[size:]
+        return data[:size]
+
+    def readline(self, size=-1):
+        """
+        Read the next row, the copy rows each end with a newline
+        """
+
+        if self.buffer:
+            line, _, self.buffer = self.buffer.partition("\n")
+            return line + "\n" if _ else line
+
+        row = next(self.rows, None)
+
+        if row is None:
+            return ""
+
+        self.lines += 1
+        self.chars += len(row)
+        return row
+
+
+def read_events(filepath):
+    """
+    Generator over the NextSong events of an event log file, one dict per
+    event, reading a line at a time
+    """
+
+    with open(filepath) as f:
+        for line in f:
+            if not line.strip():
+                continue
+
+            event = json.loads(line)
+
+            if event.get("page") == "NextSong":
+                yield event
+
+
+def copy_value(value, sep):
+    """
+    Format a single value for the copy text format, escaping the backslash,
+    the separator and line breaks, and writing None as the null marker
+    """
+
+    if value is None:
+        return "\\N"
+
+    value = str(value)
+
+    if "\\" in value:
+        value = value.replace("\\", "\\\\")
+
+    for char, escaped in ((sep, "\\" + sep), ("\n", "\\n"), ("\r", "\\r")):
+        if char in value:
+            value = value.replace(char, escaped)
+
+    return value
+
+
+def copy_row(values, sep):
+    """
+    Format a row of values as a line of copy text
+    """
+
+    return sep.join(copy_value(value, sep) for value in values) + "\n"
+
+
+def time_rows(filepath, cache=None):
+    """
+    Generator over the copy rows for the time staging table. Timestamps
+    already in the key cache, if given, are skipped. Duplicates within the
+    file are left to the ON CONFLICT DO NOTHING of the move out of staging,
+    as the rows for a timestamp are all the same, and holding every
+    timestamp of a large file would use memory in proportion to its size
+    """
+
+    for event in read_events(filepath):
+        ts = event["ts"]
+
+        if cache is not None and not cache.add(ts):
+            continue
+
+        t = EPOCH + datetime.timedelta(milliseconds=ts)
+        yield copy_row((ts, t.hour, t.day, t.isocalendar()[1], t.month, t.year, t.weekday()), ",")
+
+
+def user_rows(filepath, cache=None):
+    """
+    Generator over the copy rows for the users staging table. Duplicate
+    users within the file are skipped, keeping the first, as are those
+    already in the key cache, if given. The users seen are bounded by the
+    number of users, not the size of the file
+    """
+
+    seen = set()
+
+    for event in read_events(filepath):
+        user_id = event["userId"]
+
+        if user_id in seen:
+            continue
+
+        seen.add(user_id)
+
+        if cache is not None and not cache.add(user_id):
+            continue
+
+        yield copy_row((user_id, event.get("firstName"), event.get("lastName"),
+                        event.get("gender"), event.get("level")), ",")
+
+
+def event_chunks(filepath):
+    """
+    Generator over the events of a log file in lists of LOOKUP_CHUNK_SIZE
+    """
+
+    chunk = []
+
+    for event in read_events(filepath):
+        chunk.append(event)
+
+        if len(chunk) == LOOKUP_CHUNK_SIZE:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def chunk_dimensions(chunk, dimensions=None):
+    """
+    Return the locations and user agents of a chunk of events, resolved to
+    their ids by the dimension lookup if given
+    """
+
+    locations = [event.get("location") for event in chunk]
+    user_agents = [event.get("userAgent") for event in chunk]
+
+    if dimensions is None:
+        return locations, user_agents
+
+    return dimensions.resolve("locations", locations), dimensions.resolve("user_agents", user_agents)
+
+
+def songplay_rows(filepath, dimensions=None):
+    """
+    Generator over the copy rows for the songplays staging table, with the
+    location and user agent resolved by the dimension lookup, if given, a
+    chunk of events at a time
+    """
+
+    for chunk in event_chunks(filepath):
+        locations, user_agents = chunk_dimensions(chunk, dimensions)
+
+        for event, location, user_agent in zip(chunk, locations, user_agents):
+            yield copy_row((event["userId"], event["ts"], event["sessionId"], event.get("level"),
+                            location, user_agent, event.get("song"), event.get("artist"),
+                            event.get("length")), "\t")
+
+
+def songplay_rows_resolved(filepath, lookup, dimensions=None, matched=True):
+    """
+    Generator over the copy rows for the songplays table, with the song and
+    artist ids resolved by the lookup, and the location and user agent by
+    the dimension lookup, if given, a chunk of events at a time. Only the
+    rows with both ids are given, or with matched False only those missing
+    either id, followed by their song, artist and duration
+    """
+
+    for chunk in event_chunks(filepath):
+        song_ids, artist_ids = lookup.resolve([event.get("artist") for event in chunk],
+                                              [event.get("song") for event in chunk],
+                                              [event.get("length") for event in chunk])
+        locations, user_agents = chunk_dimensions(chunk, dimensions)
+
+        for event, song_id, artist_id, location, user_agent in zip(
+                chunk, song_ids, artist_ids, locations, user_agents):
+            row = (event["userId"], song_id, artist_id, event["ts"], event["sessionId"],
+                   event.get("level"), location, user_agent)
+
+            if song_id is not None and artist_id is not None:
+                if matched:
+                    yield copy_row(row, "\t")
+            elif not matched:
+                yield copy_row(row + (event.get("song"), event.get("artist"), event.get("length")), "\t")
+
+
+def stream_log_file(filepath, lookup=None, caches=None, dimensions=None):
+    """
+    Build the payload for an event log file with lazy file like objects in
+    place of the prepared data. The file is read once per table as the copy
+    consumes the rows, so nothing is read until the payload is loaded, and
+    with the lookup twice for the songplays, once for those it resolves and
+    once for those it doesn't. The caches, if given, are the time and users key caches, and dimensions the
+    dimension lookup of the compact schema
+    """
+
+    caches = caches or {}
+    suffix = "" if dimensions is None else "_compact"
+
+    if lookup is not None:
+        songplays = [("songplays_resolved" + suffix,
+                      IteratorFile(songplay_rows_resolved(filepath, lookup, dimensions))),
+                     ("songplays_unmatched" + suffix,
+                      IteratorFile(songplay_rows_resolved(filepath, lookup, dimensions, False)))]
+    else:
+        songplays = [("songplays" + suffix, IteratorFile(songplay_rows(filepath, dimensions)))]
+
+    return [("time", IteratorFile(time_rows(filepath, caches.get("time")))),
+            ("users", IteratorFile(user_rows(filepath, caches.get("users"))))] + songplays
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import json
+import time
+import hashlib
+import argparse
+import psycopg2
+
+from sql_queries import manifest_table_create, manifest_select
+from etl import (DSN, VALUES_MAX_ROWS, BINARY_MIN_ROWS, PayloadLoader, configure_transforms,
+                 transform_log_file, get_files, make_key_caches, rewarm_key_caches,
+                 make_dimension_lookup, count_rows, commit)
+from rollups import refresh as refresh_rollups
+from metrics import run_metrics
+
+# default seconds between polls of the log directory
+WATCH_INTERVAL = 1.0
+
+# default seconds a file must be unchanged before a last line without a
+# trailing newline is taken as complete, if it parses
+SETTLE_SECONDS = 5.0
+
+# most files loaded in one micro batch
+WATCH_BATCH_FILES = 100
+
+# the integer fields a NextSong event can't be loaded without, the user id
+# is written as a string in the logs
+EVENT_KEY_FIELDS = ("ts", "userId", "sessionId")
+
+
+class LogTail:
+    """
+    The offset up to which a log file has been loaded, with the sha256 of
+    the loaded bytes. Once a file is loaded to its end the hash matches
+    file_hash in etl.py, so its manifest entry is the same as a batch run
+    would record
+    """
+
+    def __init__(self, filepath, offset=0, digest=None):
+        self.filepath = filepath
+        self.offset = offset
+        self.digest = digest if digest is not None else hashlib.sha256()
+
+    def read(self, size, mtime, settle=SETTLE_SECONDS):
+        """
+        Read the complete lines appended since the last read, of a file now
+        size bytes long. A trailing line without a newline is left for the
+        next read, unless the file has been unchanged for settle seconds and
+        the line is a whole json event. Returns the data and the manifest
+        entry to record once it is loaded, or None if there is nothing new
+        """
+
+        with open(self.filepath, "rb") as f:
+            f.seek(self.offset)
+            data = f.read(size - self.offset)
+
+        end = data.rfind(b"\n") + 1
+
+        if end < len(data) and not (time.time() - mtime >= settle and complete_line(data[end:])):
+            data = data[:end]
+
+        if not data:
+            return None
+
+        self.offset += len(data)
+        self.digest.update(data)
+
+        return data, (self.filepath, self.offset, mtime, self.digest.hexdigest())
+
+
+def complete_line(line):
+    """
+    Return True if the line is a whole json event
+    """
+
+    try:
+        json.loads(line)
+    except ValueError:
+        return False
+
+    return True
+
+
+def parse_event(line):
+    """
+    Return a log line as an event, or None if it is not a json object
+    """
+
+    try:
+        event = json.loads(line)
+    except ValueError:
+        return None
+
+    return event if isinstance(event, dict) else None
+
+
+def key_field(value):
+    """
+    Return True if a key field of an event holds an integer, or the string
+    of one
+    """
+
+    if isinstance(value, str):
+        return value.isdigit()
+
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def songplay_lines(data, filepath):
+    """
+    Return the NextSong events of a chunk of log data from the given file as
+    json lines, or an empty string if there are none. Blank lines and other
+    pages are dropped before the transform, which expects the columns of a
+    NextSong event. Bad lines, which are not json objects, or NextSong
+    events missing a key field, are skipped and logged, as they would
+    otherwise fail the batch every time it is read again
+    """
+
+    lines = []
+    skipped = 0
+
+    for line in data.decode("utf-8", "replace").splitlines():
+        if not line.strip():
+            continue
+
+        event = parse_event(line)
+
+        if event is None or (event.get("page") == "NextSong" and
+                             not all(key_field(event.get(field)) for field in EVENT_KEY_FIELDS)):
+            skipped += 1
+        elif event.get("page") == "NextSong":
+            lines.append(line)
+
+    if skipped:
+        print("Skipped {} bad lines in {}".format(skipped, filepath))
+
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+def read_manifest(cursor):
+    """
+    Return the manifest entries by file path, as (size, mtime, hash)
+    """
+
+    cursor.execute(manifest_select)
+    return {row[0]: row[1:] for row in cursor.fetchall()}
+
+
+def resume_tail(filepath, offset, recorded):
+    """
+    Rebuild the tail of a file from its manifest entry, hashing the bytes
+    already loaded. If they no longer match the recorded hash the file was
+    rewritten, and it is loaded again from the start
+    """
+
+    digest = hashlib.sha256()
+
+    with open(filepath, "rb") as f:
+        data = f.read(offset)
+
+    digest.update(data)
+
+    if len(data) != offset or digest.hexdigest() != recorded:
+        print("{} was rewritten, loading it from the start".format(filepath))
+        return LogTail(filepath)
+
+    return LogTail(filepath, offset, digest)
+
+
+def poll(tails, manifest, filepath, settle, batch_files):
+    """
+    Check the log directory for new or appended files, returning a list of
+    (data, manifest entry, mtime) for up to batch_files of them
+    """
+
+    batch = []
+
+    for datafile in sorted(get_files(filepath)):
+        stat = os.stat(datafile)
+        tail = tails.get(datafile)
+
+        if tail is None:
+            if datafile in manifest:
+                size, mtime, recorded = manifest.pop(datafile)
+                tail = resume_tail(datafile, min(size, stat.st_size), recorded)
+            else:
+                tail = LogTail(datafile)
+
+            tails[datafile] = tail
+
+        if stat.st_size < tail.offset:
+            print("{} was truncated, loading it from the start".format(datafile))
+            tail = tails[datafile] = LogTail(datafile)
+
+        if stat.st_size == tail.offset:
+            continue
+
+        read = tail.read(stat.st_size, stat.st_mtime, settle)
+
+        if read is not None:
+            batch.append(read + (stat.st_mtime,))
+
+        if len(batch) >= batch_files:
+            break
+
+    return batch
+
+
+def load_batch(loader, batch):
+    """
+    Transform and load a micro batch of new log data, along with its
+    manifest entries, then refresh the rollups. Records the latency from
+    each file being written to its rows and rollups being committed.
+    Returns the number of songplays loaded
+    """
+
+    payload = []
+
+    for data, entry, mtime in batch:
+        events = songplay_lines(data, entry[0])
+
+        # nothing to transform, the entry is still recorded
+        if events:
+            payload.extend(transform_log_file(io.StringIO(events)))
+
+    loader.load([entry for data, entry, mtime in batch], payload)
+
+    refresh_rollups(loader.cursor)
+    commit(loader.conn)
+
+    committed = time.time()
+
+    for data, entry, mtime in batch:
+        run_metrics.observe("watch.latency", committed - mtime)
+
+    return sum(count_rows(data) for table, data in payload if table.startswith("songplays"))
+
+
+def watch(filepath, interval=WATCH_INTERVAL, settle=SETTLE_SECONDS, batch_files=WATCH_BATCH_FILES,
+          report=None, once=False):
+    """
+    Load new and appended log files as they land, polling every interval
+    seconds, on a single connection held for the life of the watch. A batch
+    which fails is rolled back and logged, and read again on the next poll.
+    Stops on an interrupt, or after the first poll with once set
+    """
+
+    conn = psycopg2.connect(DSN)
+    loader = PayloadLoader(conn)
+
+    loader.cursor.execute(manifest_table_create)
+    manifest = read_manifest(loader.cursor)
+    conn.commit()
+
+    tails = {}
+    print("Watching {} every {}s".format(filepath, interval))
+
+    try:
+        while True:
+            start = time.time()
+            batch = poll(tails, manifest, filepath, settle, batch_files)
+
+            if batch:
+                try:
+                    songplays = load_batch(loader, batch)
+                except (Exception, psycopg2.Error) as error:
+                    print("Error while loading batch: ", error)
+                    conn.rollback()
+
+                    # carry on from what was committed, the files are read
+                    # again from their manifest offsets on the next poll, and
+                    # the keys of the rolled back rows are dropped from the
+                    # key caches so they are loaded again
+                    loader = PayloadLoader(conn)
+                    committed = read_manifest(loader.cursor)
+                    conn.commit()
+                    rewarm_key_caches()
+
+                    for data, entry, mtime in batch:
+                        del tails[entry[0]]
+
+                        if entry[0] in committed:
+                            manifest[entry[0]] = committed[entry[0]]
+                else:
+                    latency = run_metrics.summary("watch.latency")
+
+                    print("Loaded {} files, {} songplays. Latency {:.2f}s, p50 {:.2f}s, p95 {:.2f}s".format(
+                        len(batch), songplays, time.time() - min(mtime for data, entry, mtime in batch),
+                        latency["p50"], latency["p95"]))
+
+                    if report is not None:
+                        run_metrics.write_report(report)
+
+            if once:
+                break
+
+            time.sleep(max(0.0, interval - (time.time() - start)))
+    except KeyboardInterrupt:
+        print("Stopped watching {}".format(filepath))
+    finally:
+        conn.close()
+
+
+def main():
+    """
+    Watch the log directory and load new log files as they land, in micro
+    batches. The song files must already be loaded by etl.py
+    """
+
+    parser = argparse.ArgumentParser(description="Watch mode for new sparkify log files")
+
+    parser.add_argument("filepath", nargs="?", default="data/log_data", help="log directory to watch")
+    parser.add_argument("--interval", type=float, default=WATCH_INTERVAL,
+                        help="seconds between polls of the log directory")
+    parser.add_argument("--settle", type=float, default=SETTLE_SECONDS,
+                        help="seconds a file must be unchanged before a last line without a "
+                             "newline is loaded")
+    parser.add_argument("--batch-files", type=int, default=WATCH_BATCH_FILES,
+                        help="most files loaded in one micro batch")
+    parser.add_argument("--binary", action="store_true",
+                        help="copy the batches too large for a multi row insert in the binary "
+                             "format rather than csv")
+    parser.add_argument("--key-cache", action="store_true",
+                        help="drop time and users rows whose keys were already loaded")
+    parser.add_argument("--report", default=None,
+                        help="rewrite the per stage timings and latencies as json to this file "
+                             "after every batch")
+    parser.add_argument("--once", action="store_true",
+                        help="poll once, load anything new and exit")
+
+    args = parser.parse_args()
+
+    caches = make_key_caches(warm=True) if args.key_cache else None
+
+    # micro batches are small, so always pick the write strategy by size
+    configure_transforms(None, args.binary, caches, (VALUES_MAX_ROWS, BINARY_MIN_ROWS),
+                         make_dimension_lookup())
+
+    watch(args.filepath, args.interval, args.settle, args.batch_files, args.report, args.once)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,17 @@
 #!/usr/bin/env python3
 
+import re
+import argparse
 import configparser
 import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+from sql_queries import create_table_queries, drop_table_queries, table_profiles
+
+# profile applied by default, the tables as declared in sql_queries.py
+DEFAULT_PROFILE = "plain"
+
+# a column line of a create table query, name, type with any identity, the
+# constraints and the separating comma. Encodings go before the constraints
+column_line = re.compile(r"^(\s+)(\w+) (\w+(?: identity\(\d+,\d+\))?)(.*?)(,?)\s*$")
 
 
 def drop_tables(cur, conn):
@@ -15,12 +24,72 @@ def drop_tables(cur, conn):
         conn.commit()
 
 
-def create_tables(cur, conn):
+def table_design(query, design):
+    """
+    Apply the physical design of a table, from a profile in sql_queries.py,
+    to its create table query. Adds an encoding to each column of a type in
+    the design's encodings, other than the first sort key column, and the
+    distribution and sort key after the column list
+    """
+
+    if not design:
+        return query
+
+    sortkey = design.get("sortkey")
+    encode = design.get("encode")
+    lines = []
+
+    for line in query.strip().split("\n"):
+        match = column_line.match(line)
+
+        if match and isinstance(encode, dict) and match.group(3).split()[0] in encode \
+                and not (isinstance(sortkey, list) and match.group(2) == sortkey[0]):
+            line = "{}{} {} ENCODE {}{}{}".format(
+                match.group(1), match.group(2), match.group(3), encode[match.group(3).split()[0]],
+                match.group(4).rstrip(), match.group(5))
+
+        lines.append(line)
+
+    if "diststyle" in design:
+        lines.append("DISTSTYLE {}".format(design["diststyle"]))
+
+    if "distkey" in design:
+        lines.append("DISTKEY ({})".format(design["distkey"]))
+
+    if sortkey == "AUTO":
+        lines.append("SORTKEY AUTO")
+    elif sortkey:
+        lines.append("SORTKEY ({})".format(", ".join(sortkey)))
+
+    if encode == "AUTO":
+        lines.append("ENCODE AUTO")
+
+    return "\n" + "\n".join(lines) + "\n"
+
+
+def profile_create_queries(profile=DEFAULT_PROFILE):
     """
-    Run all the create table queries
+    Return the create table queries with the physical designs of the named
+    profile applied
     """
 
+    designs = table_profiles[profile]
+    queries = []
+
     for query in create_table_queries:
+        table = re.search(r"CREATE TABLE IF NOT EXISTS (\w+)", query).group(1)
+        queries.append(table_design(query, designs.get(table)))
+
+    return queries
+
+
+def create_tables(cur, conn, profile=DEFAULT_PROFILE):
+    """
+    Run all the create table queries, with the physical designs of the
+    named profile
+    """
+
+    for query in profile_create_queries(profile):
         cur.execute(query)
         conn.commit()
 
@@ -30,6 +99,13 @@ def main():
     Main entry, drop then create tables
     """
 
+    parser = argparse.ArgumentParser(description="Create the sparkify warehouse tables")
+
+    parser.add_argument("--profile", choices=sorted(table_profiles), default=DEFAULT_PROFILE,
+                        help="distribution, sort key and encoding profile of the tables")
+
+    args = parser.parse_args()
+
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
 
@@ -39,7 +115,7 @@ def main():
     cur = conn.cursor()
 
     drop_tables(cur, conn)
-    create_tables(cur, conn)
+    create_tables(cur, conn, args.profile)
 
     conn.close()
 
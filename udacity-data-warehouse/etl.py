@@ -1,12 +1,23 @@
 #!/usr/bin/env python3
 
 import sys
+import time
 import argparse
+import datetime
 import configparser
 import psycopg2
 
-from sql_queries import copy_table_queries, insert_table_queries
-from create_tables import create_tables, drop_tables
+from sql_queries import *
+from create_tables import DEFAULT_PROFILE, create_tables, drop_tables, profile_create_queries
+from scheduler import run_graph, print_summary
+import local
+
+# default number of statements run at once by the scheduler
+LOAD_JOBS = 4
+
+# run against the local postgres stand in from the LOCAL section of dwh.cfg
+# rather than the cluster, set by --local
+use_local = False
 
 
 def connect():
@@ -18,6 +29,17 @@ def connect():
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
 
+    if use_local:
+        local_config = config['LOCAL']
+
+        conn = local.connect("host={} dbname={} user={} password={} port={}".format(
+            local_config['HOST'], local_config['DB_NAME'], local_config['DB_USER'],
+            local_config['DB_PASSWORD'], local_config['DB_PORT']), local_config['DATA'])
+
+        cur = conn.cursor()
+        print("Connected to local {}, reading s3 from {}".format(local_config['HOST'], local_config['DATA']))
+        return conn, cur
+
     conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(
         *config['CLUSTER'].values()))
 
@@ -48,6 +70,25 @@ def load_tables(queries):
     return True
 
 
+def load_graph(graph, jobs=LOAD_JOBS, done=()):
+    """
+    Run a graph of load queries with the scheduler, running independent
+    queries concurrently on up to jobs connections. The nodes in done are
+    taken as already loaded. Returns True only if every query succeeded
+    """
+
+    try:
+        start = time.perf_counter()
+        results = run_graph(graph, connect, jobs, done)
+        print_summary(graph, results, time.perf_counter() - start, done)
+
+    except (Exception, psycopg2.Error) as error:
+        print("Error while loading table: ", error)
+        return False
+
+    return all(result["status"] == "done" for result in results.values())
+
+
 def verify_table(cur, conn, table):
     """
     Run a basic verification of the given table. Simple get its size
@@ -110,9 +151,16 @@ def verify_final_mode(args):
 def create_mode(args):
     """
     Initially drop then create all the required tables in both staging 
-    and final
+    and final, with the physical designs of the chosen profile. A dry run
+    only prints the create table queries
     """
 
+    if getattr(args, "dry_run", False):
+        for query in profile_create_queries(args.profile):
+            print(query.strip() + ";\n")
+
+        return True
+
     try:
         print("Dropping any existing tables...")
 
@@ -121,7 +169,7 @@ def create_mode(args):
 
         print("Creating tables...")
 
-        create_tables(cur, conn)
+        create_tables(cur, conn, args.profile)
         conn.close()
     except (Exception, psycopg2.Error) as error:
         print("Error while creating tables: ", error)
@@ -150,11 +198,12 @@ def drop_mode(args):
 
 def staging_insert_mode(args):
     """
-    Copy from the csv files into the staging tables
+    Copy from the csv files into the staging tables, or from the manifests
+    of the files packed by pack.py
     """
 
     print("Copying data into staging tables...")
-    return load_tables(copy_table_queries)
+    return load_tables(packed_copy_table_queries if args.packed else copy_table_queries)
 
 
 def final_insert_mode(args):
@@ -163,18 +212,110 @@ def final_insert_mode(args):
     """
 
     print("Copying data into final tables...")
-    return load_tables(insert_table_queries)
+    return load_graph(insert_table_graph, args.jobs, copy_table_graph)
+
+
+def stage_events_since(cur, conn, watermark, until):
+    """
+    Stage the events after the watermark, copying the log files a day at a
+    time from the watermark day through the until day. Days with no log
+    files are skipped. The events of the watermark day already loaded are
+    then removed from staging
+    """
+
+    day = datetime.datetime.utcfromtimestamp(watermark / 1000).date()
+
+    while day <= until:
+        prefix = log_day_prefix.format(day)
+
+        try:
+            cur.execute(staging_events_copy_prefix.format(prefix))
+            conn.commit()
+            print("Staged {}".format(prefix))
+        except psycopg2.Error as error:
+            conn.rollback()
+
+            if "does not exist" not in str(error):
+                raise
+
+            print("No log files for {}".format(day))
+
+        day += datetime.timedelta(days=1)
+
+    cur.execute(staging_events_delete_loaded, (watermark,))
+    conn.commit()
+
+
+def incremental_mode(args):
+    """
+    Load only the events since the last load, merging the dimensions by
+    key and appending the new songplays. The first load, with no watermark
+    yet, stages everything and replaces the songplays. The full and final
+    loads record the watermark, so a later incremental load only adds to
+    them. The songs are only staged again on the first load or when asked
+    for
+    """
+
+    songs = args.songs
+
+    try:
+        conn, cur = connect()
+        create_tables(cur, conn)
+
+        cur.execute(watermark_select)
+        row = cur.fetchone()
+
+        cur.execute(staging_events_truncate)
+        conn.commit()
+
+        if row is None:
+            print("No previous load, staging all events...")
+            cur.execute(songplay_table_truncate)
+            cur.execute(staging_events_copy)
+            conn.commit()
+            songs = True
+        else:
+            print("Staging events after {}...".format(
+                datetime.datetime.utcfromtimestamp(row[0] / 1000)))
+            stage_events_since(cur, conn, row[0], args.until)
+
+        if songs:
+            print("Staging songs...")
+            cur.execute(staging_songs_truncate)
+            cur.execute(staging_songs_copy)
+            conn.commit()
+
+        conn.close()
+    except (Exception, psycopg2.Error) as error:
+        print("Error while staging tables: ", error)
+        return False
+
+    # the staged tables are loaded, as are the songs and artists unless
+    # they were staged again
+    graph = dict(merge_table_graph)
+    done = ["staging_events", "staging_songs"]
+
+    if not songs:
+        del graph["artists"], graph["songs"]
+        done.extend(["artists", "songs"])
+
+    print("Merging into final tables...")
+    return load_graph(graph, args.jobs, done)
 
 
 def etl_mode(args):
     """
     Run the full pipeline, creating tables, inserting to the
-    staging area, then inserting into the final tables
+    staging area, then inserting into the final tables. The staging
+    copies and final inserts are scheduled together, so each final
+    insert starts as soon as the staging tables it reads are loaded
     """
 
     # run the entire process
-    if create_mode(args) and staging_insert_mode(args) and final_insert_mode(args):
-        return True
+    if create_mode(args):
+        print("Copying data into staging and final tables...")
+        copies = packed_copy_table_graph if args.packed else copy_table_graph
+        return load_graph(dict(copies, **insert_table_graph), args.jobs)
 
     return False
 
@@ -189,6 +330,8 @@ def main():
         parser.print_help(sys.stderr)
 
     parser = argparse.ArgumentParser(description="Project 3 ETL Script")
+    parser.add_argument("--local", action="store_true",
+                        help="run against a local postgres, loading the staging tables from local files")
     subparsers = parser.add_subparsers(title="available commands", metavar="mode")
 
     parser_verify = subparsers.add_parser("verify", help="run some simple verification routines")
@@ -202,6 +345,9 @@ def main():
     parser_verify_final.set_defaults(func=verify_final_mode)
 
     parser_create = subparsers.add_parser("create", help="create the database tables (drops tables first)")
+    parser_create.add_argument("--profile", choices=sorted(table_profiles), default=DEFAULT_PROFILE,
+                               help="distribution, sort key and encoding profile of the tables")
+    parser_create.add_argument("--dry-run", action="store_true", help="print the create table queries only")
     parser_create.set_defaults(func=create_mode)
 
     parser_drop = subparsers.add_parser("drop", help="drop the database tables")
@@ -211,19 +357,39 @@ def main():
     load_subparsers = parser_load.add_subparsers(title="available subcommands", metavar="mode")
 
     parser_staging = load_subparsers.add_parser("staging", help="load data into the staging tables")
+    parser_staging.add_argument("--packed", action="store_true",
+                                help="copy the files packed by pack.py, from the manifests in dwh.cfg")
     parser_staging.set_defaults(func=staging_insert_mode)
 
     parser_final = load_subparsers.add_parser("final", help="load data from staging to final tables")
+    parser_final.add_argument("--jobs", type=int, default=LOAD_JOBS, help="number of inserts run at once")
     parser_final.set_defaults(func=final_insert_mode)
 
     parser_final = subparsers.add_parser("full", help="run the complete etl pipeline")
+    parser_final.add_argument("--jobs", type=int, default=LOAD_JOBS, help="number of statements run at once")
+    parser_final.add_argument("--profile", choices=sorted(table_profiles), default=DEFAULT_PROFILE,
+                              help="distribution, sort key and encoding profile of the tables")
+    parser_final.add_argument("--packed", action="store_true",
+                              help="copy the files packed by pack.py, from the manifests in dwh.cfg")
     parser_final.set_defaults(func=etl_mode)
 
+    parser_incremental = subparsers.add_parser("incremental", help="load only the events since the last load")
+    parser_incremental.add_argument("--jobs", type=int, default=LOAD_JOBS, help="number of merges run at once")
+    parser_incremental.add_argument("--songs", action="store_true", help="stage and merge the songs again")
+    parser_incremental.add_argument("--until", type=lambda day: datetime.datetime.strptime(day, "%Y-%m-%d").date(),
+                                    default=datetime.datetime.utcnow().date(),
+                                    help="last day of logs to stage, YYYY-MM-DD (default: today)")
+    parser_incremental.set_defaults(func=incremental_mode)
+
     if len(sys.argv) == 1:
         parser.print_help(sys.stderr)
         sys.exit(1)
 
     args = parser.parse_args()
+
+    global use_local
+    use_local = args.local
+
     return args.func(args)
 
 
@@ -0,0 +1,334 @@
+import io
+import os
+import gzip
+import re
+import json
+import psycopg2
+import psycopg2.extensions
+
+from sql_queries import local_columns_select, local_copy
+
+# rows written to postgres per copy while loading a staging table
+LOCAL_COPY_ROWS = 50000
+
+# redshift stores text columns as varchar(256)
+TEXT_BYTES = 256
+
+# a redshift copy from s3, the table, the s3 path and the options
+copy_statement = re.compile(r"^\s*COPY\s+(\w+)\s+FROM\s+'(s3://[^']*)'(.*)$", re.IGNORECASE | re.DOTALL)
+
+# the json option of a copy, 'auto', 'auto ignorecase' or a jsonpaths file
+json_option = re.compile(r"\bjson\s+'([^']*)'", re.IGNORECASE)
+
+# the steps of a jsonpaths expression, $['key'], $["key"], $.key or [0]
+json_path_step = re.compile(r"\[\s*'([^']*)'\s*\]|\[\s*\"([^\"]*)\"\s*\]|\.(\w+)|\[\s*(\d+)\s*\]")
+
+# Rewrites of the redshift only parts of the queries in sql_queries.py to
+# their postgres equivalents. Primary and foreign keys are only
+# informational in redshift, so they are dropped rather than enforced, as
+# are the physical design attributes of the profiles
+local_rewrites = [
+    (re.compile(r"identity\(0,1\)", re.IGNORECASE), "GENERATED BY DEFAULT AS IDENTITY (START WITH 0 MINVALUE 0)"),
+    (re.compile(r",\s*(PRIMARY|FOREIGN) KEY \([^)]*\)( REFERENCES \w+ \([^)]*\))?", re.IGNORECASE), ""),
+    (re.compile(r" ENCODE \w+", re.IGNORECASE), ""),
+    (re.compile(r"^(DISTSTYLE \w+|DISTKEY \(\w+\)|SORTKEY (AUTO|\([^)]*\))|ENCODE AUTO)\n", re.MULTILINE), ""),
+    (re.compile(r"EXTRACT\(weekday FROM", re.IGNORECASE), "EXTRACT(dow FROM")
+]
+
+
+def local_query(query):
+    """
+    Return the postgres version of a redshift query
+    """
+
+    for pattern, replacement in local_rewrites:
+        query = pattern.sub(replacement, query)
+
+    return query
+
+
+class LocalConnection(psycopg2.extensions.connection):
+    """
+    A connection to the local postgres stand in for the cluster. Holds the
+    directory the s3 paths of the copies are read from, and hands out
+    LocalCursor cursors
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = LocalCursor
+        self.data_dir = None
+        self.queries = {}
+
+
+class LocalCursor(psycopg2.extensions.cursor):
+    """
+    Runs the redshift queries on postgres. Copies from s3 are loaded from the
+    connection's data directory, everything else is rewritten to postgres
+    """
+
+    def execute(self, query, vars=None):
+        copy = copy_statement.match(query)
+
+        if copy is not None:
+            return copy_local(self, self.connection.data_dir, *copy.groups())
+
+        if query not in self.connection.queries:
+            self.connection.queries[query] = local_query(query)
+
+        return super().execute(self.connection.queries[query], vars)
+
+
+def connect(dsn, data_dir):
+    """
+    Connect to the local postgres, reading the s3 paths from data_dir
+    """
+
+    conn = psycopg2.connect(dsn, connection_factory=LocalConnection)
+    conn.data_dir = data_dir
+
+    return conn
+
+
+def local_path(data_dir, s3_path):
+    """
+    Map an s3 path to the local data directory, the bucket is dropped, so
+    s3://udacity-dend/log_data is data_dir/log_data
+    """
+
+    key = s3_path[len("s3://"):].partition("/")[2]
+    return os.path.join(data_dir, *key.split("/"))
+
+
+def prefix_files(data_dir, s3_path):
+    """
+    Return the files under the local data directory matching an s3 prefix,
+    as copy matches every object whose key starts with the prefix
+    """
+
+    prefix = local_path(data_dir, s3_path)
+    parent = os.path.dirname(prefix)
+    files = []
+
+    for root, dirs, names in os.walk(parent, followlinks=True):
+        for name in names:
+            path = os.path.join(root, name)
+
+            if path.startswith(prefix):
+                files.append(path)
+
+    if not files:
+        raise psycopg2.Error("The specified S3 prefix '{}' does not exist".format(s3_path))
+
+    return sorted(files)
+
+
+def manifest_files(data_dir, s3_path):
+    """
+    Return the files listed in a copy manifest. A missing file is an error
+    if its entry is mandatory, otherwise it is skipped
+    """
+
+    with open(local_path(data_dir, s3_path), encoding="utf-8") as f:
+        entries = json.load(f)["entries"]
+
+    files = []
+
+    for entry in entries:
+        path = local_path(data_dir, entry["url"])
+
+        if os.path.exists(path):
+            files.append(path)
+        elif entry.get("mandatory", False):
+            raise psycopg2.Error("Manifest file {} of manifest {} not found".format(entry["url"], s3_path))
+
+    return files
+
+
+def json_objects(path, compressed=False):
+    """
+    Generator over the json objects of a file, either one per line or
+    concatenated, as copy accepts both. Reads gzipped files if compressed
+    """
+
+    with (gzip.open(path, "rt", encoding="utf-8") if compressed else open(path, encoding="utf-8")) as f:
+        text = f.read()
+
+    decoder = json.JSONDecoder()
+    position = 0
+
+    while True:
+        while position < len(text) and text[position].isspace():
+            position += 1
+
+        if position == len(text):
+            break
+
+        value, position = decoder.raw_decode(text, position)
+        yield value
+
+
+def parse_json_path(expression):
+    """
+    Split a jsonpaths expression into its steps, keys and array indexes
+    """
+
+    if not expression.startswith("$"):
+        raise ValueError("invalid jsonpaths expression {}".format(expression))
+
+    steps = []
+    position = 1
+
+    while position < len(expression):
+        match = json_path_step.match(expression, position)
+
+        if match is None:
+            raise ValueError("invalid jsonpaths expression {}".format(expression))
+
+        key = next(group for group in match.groups() if group is not None)
+        steps.append(int(key) if match.group(4) is not None else key)
+        position = match.end()
+
+    return steps
+
+
+def json_path_value(value, steps):
+    """
+    Follow the steps of a jsonpaths expression into a json value, None if
+    any step is missing
+    """
+
+    for step in steps:
+        if isinstance(step, int) and isinstance(value, list) and step < len(value):
+            value = value[step]
+        elif isinstance(step, str) and isinstance(value, dict) and step in value:
+            value = value[step]
+        else:
+            return None
+
+    return value
+
+
+def json_extractor(data_dir, option, columns):
+    """
+    Return a function taking a json object to the list of values of the
+    columns, for the json option of a copy. With 'auto' the fields are
+    matched to the column names, case sensitive unless 'auto ignorecase'.
+    Otherwise the option is the s3 path of a jsonpaths file, with an
+    expression per column in order
+    """
+
+    if option.lower() == "auto":
+        return lambda record: [record.get(column) for column in columns]
+
+    if option.lower() == "auto ignorecase":
+        return lambda record: [
+            {key.lower(): value for key, value in record.items()}.get(column) for column in columns]
+
+    with open(local_path(data_dir, option), encoding="utf-8") as f:
+        expressions = json.load(f)["jsonpaths"]
+
+    if len(expressions) != len(columns):
+        raise psycopg2.Error("Number of jsonpaths and the number of columns should match. "
+                             "JSONPath size: {}, Number of columns in table or column list: {}".format(
+                                 len(expressions), len(columns)))
+
+    paths = [parse_json_path(expression) for expression in expressions]
+
+    return lambda record: [json_path_value(record, steps) for steps in paths]
+
+
+def column_value(value, max_bytes, truncate):
+    """
+    Convert a json value for a column, as copy would, max_bytes is None for
+    columns other than text. Empty strings and nested values are null
+    outside text columns, and text longer than the column is an error unless
+    truncating
+    """
+
+    if value is None:
+        return None
+
+    if max_bytes is None:
+        return None if value == "" or isinstance(value, (dict, list)) else value
+
+    text = value if isinstance(value, str) else json.dumps(value)
+    encoded = text.encode("utf-8")
+
+    if len(encoded) <= max_bytes:
+        return text
+
+    if not truncate:
+        raise psycopg2.DataError("value too long for type character varying({})".format(max_bytes))
+
+    return encoded[:max_bytes].decode("utf-8", "ignore")
+
+
+def copy_local(cursor, data_dir, table, s3_path, options):
+    """
+    Load a staging table from the local copies of the s3 files, as a
+    redshift json copy would, from a prefix or the files of a manifest,
+    gzipped or not, writing the rows to postgres with COPY in batches of
+    LOCAL_COPY_ROWS
+    """
+
+    option = json_option.search(options)
+
+    if option is None:
+        raise psycopg2.Error("only json copies can be run locally")
+
+    cursor.execute(local_columns_select, (table,))
+
+    columns = cursor.fetchall()
+    names = [name for name, data_type, length in columns]
+    sizes = [length or TEXT_BYTES if data_type in ("text", "character varying") else None
+             for name, data_type, length in columns]
+
+    extract = json_extractor(data_dir, option.group(1), names)
+
+    # the keyword options, without the quoted paths
+    keywords = re.sub(r"'[^']*'", "''", options)
+    truncate = re.search(r"\btruncatecolumns\b", keywords, re.IGNORECASE) is not None
+    compressed = re.search(r"\bgzip\b", keywords, re.IGNORECASE) is not None
+
+    if re.search(r"\bmanifest\b", keywords, re.IGNORECASE):
+        files = manifest_files(data_dir, s3_path)
+    else:
+        files = prefix_files(data_dir, s3_path)
+
+    buffer = io.StringIO()
+    rows = 0
+
+    for path in files:
+        for record in json_objects(path, compressed):
+            buffer.write("\t".join(copy_text(column_value(value, size, truncate))
+                                   for value, size in zip(extract(record), sizes)) + "\n")
+            rows += 1
+
+            if rows % LOCAL_COPY_ROWS == 0:
+                copy_buffer(cursor, table, buffer)
+
+    copy_buffer(cursor, table, buffer)
+
+
+def copy_text(value):
+    """
+    Format a value for the text format of COPY
+    """
+
+    if value is None:
+        return "\\N"
+
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def copy_buffer(cursor, table, buffer):
+    """
+    Write a buffer of rows in the text format to a table, then empty the
+    buffer
+    """
+
+    buffer.seek(0)
+    cursor.copy_expert(local_copy.format(table), buffer)
+    buffer.seek(0)
+    buffer.truncate()
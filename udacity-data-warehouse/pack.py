@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+import os
+import gzip
+import json
+import argparse
+import configparser
+import psycopg2
+
+from sql_queries import slice_count_select
+from local import json_objects
+
+# default uncompressed bytes of a packed file, the file count is rounded up
+# to a multiple of the slice count, so files are at most this size
+PACK_TARGET_BYTES = 128 * 1024 * 1024
+
+# gzip compression level of the packed files, the default of 9 costs far
+# more time than it saves space
+GZIP_LEVEL = 6
+
+
+def json_files(input_dir):
+    """
+    Return the json files under a directory, in path order, so the log
+    files stay in time order
+    """
+
+    files = []
+
+    for root, dirs, names in os.walk(input_dir, followlinks=True):
+        for name in names:
+            if name.endswith(".json"):
+                files.append(os.path.join(root, name))
+
+    return sorted(files)
+
+
+def json_lines(files):
+    """
+    Generator over the records of the json files as json lines, encoded.
+    Each file may hold a single object, as the song files do, or a record
+    per line, as the log files do
+    """
+
+    for path in files:
+        for record in json_objects(path):
+            yield (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def file_count(total_bytes, slices, target_bytes=PACK_TARGET_BYTES):
+    """
+    Return the number of packed files, the least multiple of the slice
+    count that keeps each file within target_bytes
+    """
+
+    per_slice = max(1, -(-total_bytes // (slices * target_bytes)))
+    return slices * per_slice
+
+
+def pack(input_dir, output_dir, url, slices, target_bytes=PACK_TARGET_BYTES):
+    """
+    Combine the json files under input_dir into gzipped json lines files
+    in output_dir, their count a multiple of slices and their uncompressed
+    sizes as even as whole records allow, along with a COPY manifest of the
+    files under the s3 prefix url. The records are read twice, once to size
+    the files and once to write them, so only one input file is held in
+    memory at a time, never the whole directory. Returns the manifest
+    """
+
+    files = json_files(input_dir)
+    total = sum(len(line) for line in json_lines(files))
+    count = file_count(total, slices, target_bytes)
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    entries = []
+    written = 0
+    lines = json_lines(files)
+    line = next(lines, None)
+
+    for i in range(count):
+        name = "part-{:05d}.json.gz".format(i)
+        path = os.path.join(output_dir, name)
+
+        # cut at the record boundary nearest the file's share of the total
+        end = total * (i + 1) // count
+
+        with gzip.open(path, "wb", compresslevel=GZIP_LEVEL) as f:
+            while line is not None and written + len(line) // 2 < end:
+                f.write(line)
+                written += len(line)
+                line = next(lines, None)
+
+        entries.append({"url": "{}/{}".format(url.rstrip("/"), name),
+                        "mandatory": True,
+                        "meta": {"content_length": os.path.getsize(path)}})
+
+    manifest = {"entries": entries}
+
+    with open(os.path.join(output_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    print("Packed {} files, {} bytes, into {} files of about {} bytes for {} slices".format(
+        len(files), total, count, total // count, slices))
+
+    return manifest
+
+
+def cluster_slices():
+    """
+    Return the number of slices of the cluster in dwh.cfg
+    """
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(
+        *config['CLUSTER'].values()))
+
+    cur = conn.cursor()
+    cur.execute(slice_count_select)
+    slices = cur.fetchone()[0]
+    conn.close()
+
+    return slices
+
+
+def main():
+    """
+    Pack a directory of song or log files for a parallel staging COPY
+    """
+
+    parser = argparse.ArgumentParser(description="Pack json files into gzipped json lines files for COPY")
+
+    parser.add_argument("input", help="directory of song or log json files")
+    parser.add_argument("output", help="directory to write the packed files and manifest to")
+    parser.add_argument("url", help="s3 prefix the output directory will be uploaded to")
+    parser.add_argument("--slices", type=int, default=None,
+                        help="slice count of the cluster (default: read from the cluster in dwh.cfg)")
+    parser.add_argument("--target-bytes", type=int, default=PACK_TARGET_BYTES,
+                        help="largest uncompressed size of a packed file")
+
+    args = parser.parse_args()
+
+    slices = args.slices if args.slices is not None else cluster_slices()
+    pack(args.input, args.output, args.url, slices, args.target_bytes)
+
+
+if __name__ == "__main__":
+    main()
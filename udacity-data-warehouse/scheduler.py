@@ -0,0 +1,155 @@
+import time
+import queue
+import concurrent.futures
+import psycopg2
+
+
+def check_graph(graph, done=()):
+    """
+    Check every dependency of the graph is either a node of the graph or
+    already done, and that the graph has no cycles. Returns the nodes in
+    an order they can be run one at a time
+    """
+
+    for name, (query, dependencies) in graph.items():
+        for dependency in dependencies:
+            if dependency not in graph and dependency not in done:
+                raise ValueError("{} depends on unknown node {}".format(name, dependency))
+
+    order = []
+    remaining = dict(graph)
+
+    while remaining:
+        ready = [name for name, (query, dependencies) in remaining.items()
+                 if all(dependency not in remaining for dependency in dependencies)]
+
+        if not ready:
+            raise ValueError("dependency cycle between {}".format(", ".join(remaining)))
+
+        for name in ready:
+            order.append(name)
+            del remaining[name]
+
+    return order
+
+
+def critical_path(graph, results, done=()):
+    """
+    Return the nodes of the longest chain of dependent nodes by run time,
+    and its total run time
+    """
+
+    longest = {}
+
+    for name in check_graph(graph, done):
+        if name not in results or "seconds" not in results[name]:
+            continue
+
+        before = max((longest[dependency] for dependency in graph[name][1] if dependency in longest),
+                     key=lambda path: path[1], default=([], 0.0))
+
+        longest[name] = (before[0] + [name], before[1] + results[name]["seconds"])
+
+    return max(longest.values(), key=lambda path: path[1], default=([], 0.0))
+
+
+def run_node(connections, name, query):
+    """
+    Run the query of a node in a transaction of its own, on a connection
+    from the pool. A failed node is rolled back, so the connection can be
+    reused. Returns the node result
+    """
+
+    conn = connections.get()
+    start = time.perf_counter()
+
+    try:
+        cur = conn.cursor()
+        cur.execute(query)
+        conn.commit()
+
+        result = {"status": "done", "seconds": time.perf_counter() - start}
+        print("{}: done in {:.2f}s".format(name, result["seconds"]))
+    except (Exception, psycopg2.Error) as error:
+        conn.rollback()
+
+        result = {"status": "failed", "seconds": time.perf_counter() - start, "error": str(error).strip()}
+        print("{}: failed after {:.2f}s: {}".format(name, result["seconds"], result["error"]))
+    finally:
+        connections.put(conn)
+
+    return result
+
+
+def run_graph(graph, connect, jobs=4, done=()):
+    """
+    Run the queries of a graph of nodes, as declared in sql_queries.py,
+    with up to jobs nodes at once, each on its own connection from the
+    connect function. A node starts as soon as the nodes it depends on are
+    done, dependencies on the nodes in done count as already done. When a
+    node fails the nodes depending on it are skipped, the rest still run.
+    Returns the result of each node
+    """
+
+    check_graph(graph, done)
+
+    connections = queue.Queue()
+
+    for i in range(min(jobs, len(graph))):
+        conn, cur = connect()
+        connections.put(conn)
+
+    results = {}
+    running = {}
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        while len(results) < len(graph):
+            for name, (query, dependencies) in graph.items():
+                if name in results or name in running.values():
+                    continue
+
+                pending = [dependency for dependency in dependencies if dependency not in done]
+                states = [results[dependency]["status"] for dependency in pending if dependency in results]
+
+                if any(state != "done" for state in states):
+                    results[name] = {"status": "skipped"}
+                    print("{}: skipped, a dependency did not complete".format(name))
+                elif len(states) == len(pending):
+                    running[executor.submit(run_node, connections, name, query)] = name
+
+            if not running:
+                continue
+
+            finished, unfinished = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in finished:
+                results[running.pop(future)] = future.result()
+
+    while not connections.empty():
+        connections.get().close()
+
+    return results
+
+
+def print_summary(graph, results, seconds, done=()):
+    """
+    Print the time of each node, the critical path and the wall time of a
+    graph run
+    """
+
+    print("Node timings:")
+
+    for name in graph:
+        result = results[name]
+
+        if "seconds" in result:
+            print("  {:<16} {:<8} {:8.2f}s".format(name, result["status"], result["seconds"]))
+        else:
+            print("  {:<16} {:<8}".format(name, result["status"]))
+
+    path, path_seconds = critical_path(graph, results, done)
+
+    print("Critical path: {} ({:.2f}s)".format(" -> ".join(path), path_seconds))
+    print("Wall time {:.2f}s, {:.2f}s of statements".format(
+        seconds, sum(result.get("seconds", 0.0) for result in results.values())))
@@ -17,6 +17,7 @@ user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+state_table_drop = "DROP TABLE IF EXISTS etl_state"
 
 # CREATE STAGING TABLES
 
@@ -125,6 +126,16 @@ CREATE TABLE IF NOT EXISTS time (
 )
 """)
 
+# The high water mark of the incremental loads, the latest staging_events ts
+# loaded
+state_table_create = ("""
+CREATE TABLE IF NOT EXISTS etl_state (
+    name text NOT NULL,
+    value bigint NOT NULL,
+    PRIMARY KEY (name)
+)
+""")
+
 # COPY TO STAGING TABLES
 
 staging_events_copy = ("""
@@ -142,6 +153,69 @@ COPY staging_songs
     JSON 'auto' truncatecolumns
 """).format(config["S3"]["SONG_DATA"], config["IAM_ROLE"]["ARN"])
 
+# Copies of the files packed by pack.py, gzipped json lines files listed in
+# a manifest, evenly sized and a multiple of the slice count in number
+staging_events_copy_manifest = ("""
+COPY staging_events 
+    FROM {} 
+    iam_role {} 
+    region 'us-west-2' json {}
+    MANIFEST GZIP
+""").format(config["S3"].get("LOG_MANIFEST", "''"), config["IAM_ROLE"]["ARN"], config["S3"]["LOG_JSONPATH"])
+
+staging_songs_copy_manifest = ("""
+COPY staging_songs 
+    FROM {} 
+    iam_role {} 
+    region 'us-west-2'
+    JSON 'auto' truncatecolumns
+    MANIFEST GZIP
+""").format(config["S3"].get("SONG_MANIFEST", "''"), config["IAM_ROLE"]["ARN"])
+
+# The number of slices in the cluster, the packed file count is a multiple
+# of it
+slice_count_select = "SELECT COUNT(*) FROM stv_slices"
+
+# Copy of the log files under an S3 prefix, takes the prefix, used to stage
+# a single day of logs
+staging_events_copy_prefix = ("""
+COPY staging_events 
+    FROM '{}' 
+    iam_role {} 
+    region 'us-west-2' json {}
+""").format("{}", config["IAM_ROLE"]["ARN"], config["S3"]["LOG_JSONPATH"])
+
+# The log files are stored by day, as log_data/2018/11/2018-11-01-events.json
+log_day_prefix = config["S3"]["LOG_DATA"].strip("'") + "/{0:%Y}/{0:%m}/{0:%Y-%m-%d}"
+
+staging_events_truncate = "TRUNCATE staging_events"
+staging_songs_truncate = "TRUNCATE staging_songs"
+
+# The first incremental load, with no watermark, stages every event, so the
+# songplays are loaded again from scratch
+songplay_table_truncate = "TRUNCATE songplays"
+
+# INCREMENTAL LOAD
+
+watermark_select = "SELECT value FROM etl_state WHERE name = 'events_ts'"
+
+# The days staged from the watermark day overlap the last load, takes the
+# watermark
+staging_events_delete_loaded = "DELETE FROM staging_events WHERE ts <= %s"
+
+# Moves the watermark on to the latest staged event, appended to the
+# songplays insert of both the full and the incremental loads, so it is
+# committed along with the songplays. Nothing changes if staging is empty
+watermark_update = ("""
+DELETE FROM etl_state
+    WHERE name = 'events_ts'
+        AND EXISTS (SELECT 1 FROM staging_events);
+INSERT INTO etl_state (name, value)
+    SELECT 'events_ts', MAX(ts)
+    FROM staging_events
+    HAVING COUNT(*) > 0
+""")
+
 # INSERT (STAGING -> FINAL)
 
 songplay_table_insert = ("""
@@ -168,8 +242,8 @@ INSERT INTO songplays (
         ON songs.artist_name = events.artist
         AND songs.title = events.song 
         AND songs.duration = events.length
-    WHERE events.page = 'NextSong'
-""")
+    WHERE events.page = 'NextSong';
+""") + watermark_update
 
 user_table_insert = ("""
 INSERT INTO users (
@@ -240,18 +314,244 @@ INSERT INTO time (
         SELECT DISTINCT ts,'1970-01-01'::date + ts/1000 * interval '1 second' as start_time
         FROM staging_events
         WHERE page = 'NextSong'
-    )
+    ) AS event_times
+""")
+
+# MERGE (STAGING -> FINAL)
+
+# Incremental versions of the inserts. The dimensions are merged by deleting
+# the rows for the staged keys and inserting them again, so a key is only
+# ever loaded once, and reloading the same data changes nothing. Each merge
+# is run as a single transaction
+user_table_merge = ("""
+DELETE FROM users
+    USING staging_events events
+    WHERE users.user_id = events.user_id
+        AND events.page = 'NextSong';
+INSERT INTO users (
+        user_id, 
+        first_name, 
+        last_name, 
+        gender, 
+        level)
+    SELECT 
+        user_id, 
+        first_name, 
+        last_name, 
+        gender, 
+        level
+    FROM (
+        SELECT user_id, first_name, last_name, gender, level,
+            ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY ts DESC) AS latest
+        FROM staging_events
+        WHERE page = 'NextSong'
+    ) AS staged_users
+    WHERE latest = 1
+""")
+
+time_table_merge = ("""
+DELETE FROM time
+    WHERE start_time IN (
+        SELECT '1970-01-01'::date + ts/1000 * interval '1 second'
+        FROM staging_events
+        WHERE page = 'NextSong'
+    );
+""") + time_table_insert
+
+song_table_merge = ("""
+DELETE FROM songs
+    USING staging_songs
+    WHERE songs.song_id = staging_songs.song_id;
+INSERT INTO songs (
+        song_id, 
+        artist_id, 
+        title, 
+        year, 
+        duration)
+    SELECT 
+        song_id,
+        artist_id,
+        title,
+        year,
+        duration
+    FROM (
+        SELECT song_id, artist_id, title, year, duration,
+            ROW_NUMBER() OVER (PARTITION BY song_id ORDER BY title, year) AS n
+        FROM staging_songs
+    ) AS staged
+    WHERE n = 1
+""")
+
+artist_table_merge = ("""
+DELETE FROM artists
+    USING staging_songs
+    WHERE artists.artist_id = staging_songs.artist_id;
+INSERT INTO artists (
+        artist_id, 
+        name, 
+        location, 
+        latitude, 
+        longitude)
+    SELECT
+        artist_id,
+        artist_name,
+        artist_location,
+        artist_latitude,
+        artist_longitude
+    FROM (
+        SELECT artist_id, artist_name, artist_location, artist_latitude, artist_longitude,
+            ROW_NUMBER() OVER (PARTITION BY artist_id ORDER BY artist_name) AS n
+        FROM staging_songs
+    ) AS staged
+    WHERE n = 1
+""")
+
+# Only events after the watermark are staged, so the songplays are
+# appended. They are matched against the final songs and artists, as the
+# songs are not restaged on every load
+songplay_table_append = ("""
+INSERT INTO songplays (
+        user_id, 
+        song_id, 
+        artist_id, 
+        start_time, 
+        session_id, 
+        level, 
+        location, 
+        user_agent)
+    SELECT 
+        events.user_id, 
+        songs.song_id, 
+        songs.artist_id, 
+        events.ts, 
+        events.session_id, 
+        events.level, 
+        events.location, 
+        events.user_agent
+    FROM staging_events events
+    JOIN songs 
+        ON songs.title = events.song 
+        AND songs.duration = events.length
+    JOIN artists 
+        ON artists.artist_id = songs.artist_id
+        AND artists.name = events.artist
+    WHERE events.page = 'NextSong';
+""") + watermark_update
+
+# LOCAL STAND IN
+
+# The columns of a staging table, to load the local copies of the s3 files
+# into, takes the table name
+local_columns_select = ("""
+SELECT column_name, data_type, character_maximum_length
+    FROM information_schema.columns
+    WHERE table_schema = current_schema() AND table_name = %s
+    ORDER BY ordinal_position
 """)
 
+# Bulk load of the rows converted from the json files, takes the table
+local_copy = "COPY {} FROM STDIN"
+
 # QUERY LISTS
 
 create_table_queries = [staging_events_table_create, staging_songs_table_create,
-                        user_table_create, artist_table_create, song_table_create, time_table_create, songplay_table_create]
+                        user_table_create, artist_table_create, song_table_create, time_table_create, songplay_table_create,
+                        state_table_create]
 
 drop_table_queries = [staging_events_table_drop, staging_songs_table_drop,
-                      songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
+                      songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop,
+                      state_table_drop]
 
 copy_table_queries = [staging_events_copy, staging_songs_copy]
 
+packed_copy_table_queries = [staging_events_copy_manifest, staging_songs_copy_manifest]
+
 insert_table_queries = [songplay_table_insert, user_table_insert,
                         song_table_insert, artist_table_insert, time_table_insert]
+
+# QUERY GRAPHS
+
+# The load statements with the nodes each depends on, for the scheduler to
+# run independent statements concurrently, in the form:
+# node -> (query, [nodes it depends on])
+# The inserts of a full load only read from staging, so only depend on the
+# staging tables. Redshift does not enforce the foreign keys, so they need
+# no ordering between the inserts
+copy_table_graph = {
+    "staging_events": (staging_events_copy, []),
+    "staging_songs": (staging_songs_copy, [])
+}
+
+packed_copy_table_graph = {
+    "staging_events": (staging_events_copy_manifest, []),
+    "staging_songs": (staging_songs_copy_manifest, [])
+}
+
+insert_table_graph = {
+    "users": (user_table_insert, ["staging_events"]),
+    "time": (time_table_insert, ["staging_events"]),
+    "artists": (artist_table_insert, ["staging_songs"]),
+    "songs": (song_table_insert, ["staging_songs"]),
+    "songplays": (songplay_table_insert, ["staging_events", "staging_songs"])
+}
+
+# The merges of an incremental load. The songplays append resolves its ids
+# against the final songs and artists, so it follows their merges, and
+# those of users and time, so the rows it appends never reference keys not
+# yet merged. The artists and songs are only merged when the songs are staged
+merge_table_graph = {
+    "users": (user_table_merge, ["staging_events"]),
+    "time": (time_table_merge, ["staging_events"]),
+    "artists": (artist_table_merge, ["staging_songs"]),
+    "songs": (song_table_merge, ["staging_songs", "artists"]),
+    "songplays": (songplay_table_append, ["staging_events", "users", "songs", "artists", "time"])
+}
+
+# PHYSICAL DESIGN PROFILES
+
+# The distribution, sort key and column encodings applied to the create
+# table queries by create_tables.py, by profile then table, in the form:
+# table -> {"diststyle": style, "distkey": column, "sortkey": [columns],
+#           "encode": {column type: encoding}}
+# Columns are encoded by type, except the first sort key column, which is
+# left raw so its zone maps stay exact. Tables missing from a profile are
+# created as declared above
+
+# az64 for the numeric and time types it supports, zstd for the rest
+column_encodings = {
+    "integer": "az64",
+    "bigint": "az64",
+    "timestamp": "az64",
+    "float": "zstd",
+    "text": "zstd"
+}
+
+# songplays start_time is epoch milliseconds and time start_time a timestamp,
+# so the time join cannot be co-located. Instead songplays is distributed on
+# song_id with songs, the largest dimension, and the small users and artists
+# are copied to every node. The fact and time tables are sorted on start_time
+# for time range scans
+star_profile = {
+    "staging_events": {"diststyle": "EVEN", "encode": column_encodings},
+    "staging_songs": {"distkey": "song_id", "encode": column_encodings},
+    "users": {"diststyle": "ALL", "sortkey": ["user_id"], "encode": column_encodings},
+    "artists": {"diststyle": "ALL", "sortkey": ["artist_id"], "encode": column_encodings},
+    "songs": {"distkey": "song_id", "sortkey": ["song_id"], "encode": column_encodings},
+    "time": {"distkey": "start_time", "sortkey": ["start_time"], "encode": column_encodings},
+    "songplays": {"distkey": "song_id", "sortkey": ["start_time"], "encode": column_encodings},
+    "etl_state": {"diststyle": "ALL"}
+}
+
+# Leaves the distribution, sort keys and encodings to redshift's automatic
+# table optimization
+auto_profile = {
+    table: {"diststyle": "AUTO", "sortkey": "AUTO", "encode": "AUTO"}
+    for table in ["staging_events", "staging_songs", "users", "artists", "songs", "time", "songplays",
+                  "etl_state"]
+}
+
+table_profiles = {
+    "plain": {},
+    "star": star_profile,
+    "auto": auto_profile
+}
@@ -0,0 +1,73 @@
+import os
+import re
+
+# sql_queries.py reads dwh.cfg from the working directory
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+from sql_queries import create_table_queries
+from create_tables import profile_create_queries
+
+
+def table_query(profile, table):
+    """
+    Return the create table query of a table for a profile
+    """
+
+    for query in profile_create_queries(profile):
+        if re.search(r"CREATE TABLE IF NOT EXISTS {} \(".format(table), query):
+            return query
+
+    raise KeyError(table)
+
+
+def column_line(query, column):
+    """
+    Return the definition line of a column in a create table query
+    """
+
+    return next(line.strip() for line in query.split("\n") if re.match(r"\s+{} ".format(column), line))
+
+
+def test_plain_is_unchanged():
+    assert profile_create_queries("plain") == create_table_queries
+
+
+def test_star_copies_small_dimensions():
+    for table in ["users", "artists"]:
+        assert "\nDISTSTYLE ALL\n" in table_query("star", table)
+
+
+def test_star_songplays_keys():
+    query = table_query("star", "songplays")
+
+    assert "\nDISTKEY (song_id)\n" in query
+    assert "\nSORTKEY (start_time)\n" in query
+    assert "DISTSTYLE" not in query
+
+
+def test_star_encodings():
+    query = table_query("star", "songplays")
+
+    assert column_line(query, "songplay_id") == "songplay_id integer identity(0,1) ENCODE az64,"
+    assert column_line(query, "user_id") == "user_id integer ENCODE az64 NOT NULL,"
+    assert column_line(query, "song_id") == "song_id text ENCODE zstd,"
+    assert column_line(query, "level") == "level text ENCODE zstd NOT NULL,"
+
+    # the leading sort key column is left raw
+    assert "ENCODE" not in column_line(query, "start_time")
+    assert "ENCODE" not in column_line(table_query("star", "time"), "start_time")
+    assert "ENCODE" not in column_line(table_query("star", "users"), "user_id")
+
+
+def test_star_encodes_by_type():
+    query = table_query("star", "staging_songs")
+
+    assert column_line(query, "year") == "year integer ENCODE az64"
+    assert column_line(query, "duration") == "duration float ENCODE zstd,"
+    assert column_line(query, "artist_latitude") == "artist_latitude float ENCODE zstd,"
+
+
+def test_auto_clauses():
+    for query in profile_create_queries("auto"):
+        assert query.endswith("\nDISTSTYLE AUTO\nSORTKEY AUTO\nENCODE AUTO\n")
+        assert " ENCODE az64" not in query and " ENCODE zstd" not in query